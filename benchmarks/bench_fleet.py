@@ -0,0 +1,114 @@
+import argparse
+import asyncio
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime
+
+import httpx
+import pytz
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import sessionmaker
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT_DIR)
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from client.generated.fast_api_client.client import Client
+from client.db import database, migrations, models
+from client import fleet, writebehind
+from loadgen import free_port, start_server, wait_until_up
+
+
+def use_database(path: str):
+    """Point the client modules at a scratch database instead of client/db/client.db."""
+    database.engine = database.create_engine(f"sqlite+aiosqlite:///{path}",
+                                             database.ENGINE_PROFILES[database.ENGINE_PROFILE])
+    database.SessionLocal = sessionmaker(bind=database.engine, class_=AsyncSession, expire_on_commit=False)
+
+
+def per_sensor_tick(sensors: list[models.Sensor], levels: list[float]) -> list[dict]:
+    """One tick the way client_main's generators produce readings, one python call per sensor."""
+    events = []
+    for i, sensor in enumerate(sensors):
+        sensor_type = fleet.SENSOR_TYPES[sensor.sensor_type]
+        now = datetime.now(pytz.UTC)
+        time_fraction = (now.hour * 3600 + now.minute * 60 + now.second) / (24 * 60 * 60)
+        levels[i] += random.uniform(-sensor_type.variation, sensor_type.variation)
+        levels[i] = max(min(levels[i], sensor_type.maximum), sensor_type.minimum)
+        events.append({
+            "sensor_uuid": sensor.sensor_uuid,
+            "event_uuid": uuid.uuid4().hex,
+            "value": sensor_type.diurnal_amplitude * math.sin(2 * math.pi * time_fraction) + levels[i]
+            + random.uniform(-sensor_type.noise_level, sensor_type.noise_level),
+            "time": now,
+            "unit": sensor_type.unit,
+            "transmitted": False
+        })
+    return events
+
+
+async def per_sensor_registration(http: httpx.AsyncClient, names: list[tuple[str, str]]):
+    for sensor_type, name in names:
+        (await http.post("/createSensor", json={"type": sensor_type, "name": name})).raise_for_status()
+
+
+async def main(args):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        use_database(os.path.join(tmp_dir, "client.db"))
+        async with database.engine.begin() as connection:
+            await connection.run_sync(migrations.upgrade_schema, models.Base.metadata)
+
+        port = free_port()
+        server = start_server(os.path.join(tmp_dir, "server.db"), port, 1)
+        base_url = f"http://127.0.0.1:{port}"
+        try:
+            await wait_until_up(base_url)
+            async with httpx.AsyncClient(base_url=base_url, timeout=60) as http:
+                names = [(sensor_type, f"single_{name}")
+                         for sensor_type, name in fleet.fleet_names(["temperature", "humidity"], args.sensors)]
+                start = time.perf_counter()
+                await per_sensor_registration(http, names)
+                single_seconds = time.perf_counter() - start
+            start = time.perf_counter()
+            sensors = await fleet.get_fleet_sensors(Client(base_url), ["temperature", "humidity"], args.sensors)
+            batch_seconds = time.perf_counter() - start
+        finally:
+            server.terminate()
+            server.wait()
+        print(f"register {args.sensors} sensors: /createSensor {single_seconds:.2f} s, "
+              f"/createSensors {batch_seconds:.2f} s ({single_seconds / batch_seconds:.0f}x)")
+
+        sensor_fleet = fleet.SensorFleet(sensors, seed=1)
+        levels = [fleet.SENSOR_TYPES[sensor.sensor_type].start for sensor in sensors]
+        buffer = writebehind.EventWriteBuffer()
+        variants = {"per sensor": lambda now: per_sensor_tick(sensors, levels),
+                    "vectorized": lambda now: sensor_fleet.events(now, sensor_fleet.step(now))}
+        generate_seconds = dict.fromkeys(variants, 0.0)
+        write_seconds = dict.fromkeys(variants, 0.0)
+        # the variants take turns, so both write into a database of the same size
+        for _ in range(args.ticks):
+            for name, generate in variants.items():
+                now = datetime.now(pytz.UTC)
+                start = time.perf_counter()
+                events = generate(now)
+                generate_seconds[name] += time.perf_counter() - start
+                start = time.perf_counter()
+                await buffer.write_batch(events)
+                write_seconds[name] += time.perf_counter() - start
+        print(f"{'per tick of ' + str(args.sensors) + ' sensors':<36} {'generate ms':>12} {'write ms':>10}")
+        for name in variants:
+            print(f"{name:<36} {generate_seconds[name] / args.ticks * 1000:>12.1f} "
+                  f"{write_seconds[name] / args.ticks * 1000:>10.1f}")
+        await database.engine.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fleet registration and per tick generation of many sensors.")
+    parser.add_argument("--sensors", type=int, default=10000, help="Sensors in the fleet.")
+    parser.add_argument("--ticks", type=int, default=10, help="Ticks generated and written per variant.")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,92 @@
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta
+
+import pytz
+from sqlalchemy import insert
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.orm import sessionmaker
+
+# make the server modules importable the same way server_main.py sees them
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT_DIR)
+sys.path.append(os.path.join(ROOT_DIR, "server"))
+
+import db.models as models
+
+import apimodels
+import ingest
+
+
+def make_request(size: int, sensor_uuid: str) -> apimodels.SensorEventDataRequest:
+    start = datetime.now(pytz.UTC)
+    return apimodels.SensorEventDataRequest(events=[
+        apimodels.EventRemote(
+            event_uuid=uuid.uuid4().hex,
+            value=20.0 + i % 10,
+            unit="degree",
+            timestamp=(start + timedelta(milliseconds=i)).isoformat(),
+            sensor_uuid=sensor_uuid
+        )
+        for i in range(size)
+    ])
+
+
+async def ingest_per_row(session: AsyncSession, request: apimodels.SensorEventDataRequest):
+    # the ingestion loop post_sensor_data used before the batched path
+    for event in request.events:
+        stmt = insert(models.Event).values(
+            event_uuid=event.event_uuid,
+            value=event.value,
+            unit=event.unit,
+            sensor_uuid=event.sensor_uuid,
+            timestamp=datetime.fromisoformat(event.timestamp)
+        ).prefix_with("OR IGNORE")
+        await session.execute(stmt)
+    await session.commit()
+
+
+async def ingest_batched(session: AsyncSession, request: apimodels.SensorEventDataRequest):
+    await ingest.insert_events(session, ingest.event_rows(request.events))
+    await session.commit()
+
+
+async def measure(ingest_function, size: int) -> float:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        engine = create_async_engine(f"sqlite+aiosqlite:///{os.path.join(tmp_dir, 'bench.db')}")
+        async with engine.begin() as conn:
+            await conn.run_sync(models.Base.metadata.create_all)
+        session_factory = sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+        sensor_uuid = uuid.uuid4().hex
+        async with session_factory() as session:
+            await session.execute(insert(models.Sensor).values(
+                sensor_uuid=sensor_uuid, sensor_type="temperature", sensor_name="bench"))
+            await session.commit()
+        request = make_request(size, sensor_uuid)
+        async with session_factory() as session:
+            start = time.perf_counter()
+            await ingest_function(session, request)
+            elapsed = time.perf_counter() - start
+        await engine.dispose()
+    return size / elapsed
+
+
+async def main(sizes: list[int]):
+    print(f"{'events':>8} {'per-row ev/s':>14} {'batched ev/s':>14} {'speedup':>8}")
+    for size in sizes:
+        before = await measure(ingest_per_row, size)
+        after = await measure(ingest_batched, size)
+        print(f"{size:>8} {before:>14.0f} {after:>14.0f} {after / before:>7.1f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare per-row and batched /sensordata ingestion.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 1_000, 100_000],
+                        help="Batch sizes to benchmark.")
+    args = parser.parse_args()
+    asyncio.run(main(args.sizes))
@@ -0,0 +1,117 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta
+
+import httpx
+import pytz
+
+# make the server modules importable the same way server_main.py sees them
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT_DIR)
+sys.path.append(os.path.join(ROOT_DIR, "server"))
+
+TMP_DIR = tempfile.TemporaryDirectory()
+# the server modules read their configuration when they are imported, the bench uploads faster than a client may
+os.environ["SERVER_DATABASE_URL"] = f"sqlite+aiosqlite:///{os.path.join(TMP_DIR.name, 'latest.db')}"
+os.environ["SERVER_CLIENT_EVENT_RATE"] = "0"
+
+from sqlalchemy.future import select
+
+import db.database as database
+import db.models as models
+import latest
+import server_main
+
+
+async def per_sensor_queries(sensor_uuids: list[str]) -> list[tuple]:
+    """The newest event and average with two queries per sensor, like a dashboard without the batch read."""
+    states = []
+    async with database.SessionLocal() as session:
+        for sensor_uuid in sensor_uuids:
+            event = await session.scalar(
+                select(models.Event).where(models.Event.sensor_uuid == sensor_uuid)
+                .order_by(models.Event.timestamp.desc()).limit(1)
+            )
+            average = await session.scalar(
+                select(models.Averages).where(models.Averages.sensor_uuid == sensor_uuid)
+                .order_by(models.Averages.calculation_timestamp.desc()).limit(1)
+            )
+            states.append((event, average))
+    return states
+
+
+async def populate(http: httpx.AsyncClient, sensors: int, events: int) -> list[str]:
+    response = await http.post("/createSensors", json={"sensors": [
+        {"type": "temperature", "name": f"latest_{i}"} for i in range(sensors)
+    ]})
+    sensor_uuids = [sensor["uuid"] for sensor in response.json()]
+    start = datetime.now(pytz.UTC) - timedelta(seconds=events)
+    batch = []
+    for second in range(events):
+        timestamp = (start + timedelta(seconds=second)).isoformat()
+        for sensor_uuid in sensor_uuids:
+            batch.append({"event_uuid": uuid.uuid4().hex, "value": 20.0 + second % 5, "unit": "degree",
+                          "timestamp": timestamp, "sensor_uuid": sensor_uuid})
+            if len(batch) == 10000:
+                (await http.post("/sensordata", json={"events": batch})).raise_for_status()
+                batch = []
+    if batch:
+        (await http.post("/sensordata", json={"events": batch})).raise_for_status()
+    # the averages are stored in the background
+    while server_main.average_aggregator.pending():
+        await asyncio.sleep(0.1)
+    await server_main.write_pipeline.queue.join()
+    return sensor_uuids
+
+
+async def main(args):
+    async with server_main.lifespan(server_main.app):
+        transport = httpx.ASGITransport(app=server_main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=300) as http:
+            sensor_uuids = await populate(http, args.sensors, args.events)
+            results = {}
+
+            start = time.perf_counter()
+            await per_sensor_queries(sensor_uuids)
+            results["per sensor queries"] = time.perf_counter() - start
+
+            start = time.perf_counter()
+            for _ in range(args.rounds):
+                json.dumps(server_main.latest_state.read(sensor_uuids))
+            results["latest state read + json"] = (time.perf_counter() - start) / args.rounds
+
+            start = time.perf_counter()
+            for _ in range(args.rounds):
+                response = await http.post("/sensors/latest", json={})
+            results["POST /sensors/latest (all)"] = (time.perf_counter() - start) / args.rounds
+            assert len(response.json()["sensors"]) == len(sensor_uuids)
+
+            start = time.perf_counter()
+            for _ in range(args.rounds):
+                await http.post("/sensors/latest", json={"sensor_uuids": sensor_uuids})
+            results["POST /sensors/latest (listed)"] = (time.perf_counter() - start) / args.rounds
+
+            start = time.perf_counter()
+            async with database.SessionLocal() as session:
+                await latest.LatestState().load(session)
+            results["load at startup"] = time.perf_counter() - start
+
+    print(f"{args.sensors} sensors, {args.events} events each")
+    print(f"{'':>32} {'total ms':>10} {'us/sensor':>10}")
+    for name, seconds in results.items():
+        print(f"{name:>32} {seconds * 1000:>10.2f} {seconds * 1e6 / args.sensors:>10.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Latest state of many sensors: per sensor queries vs. the cache.")
+    parser.add_argument("--sensors", type=int, default=5000)
+    parser.add_argument("--events", type=int, default=10, help="Events per sensor.")
+    parser.add_argument("--rounds", type=int, default=20, help="Repetitions of the in-memory reads.")
+    asyncio.run(main(parser.parse_args()))
+    TMP_DIR.cleanup()
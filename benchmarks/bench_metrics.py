@@ -0,0 +1,83 @@
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime
+
+from sqlalchemy import insert, select
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.orm import sessionmaker
+
+# make the server modules importable the same way server_main.py sees them
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT_DIR)
+sys.path.append(os.path.join(ROOT_DIR, "server"))
+
+import db.models as models
+
+import metrics
+
+
+def per_call_ns(function, iterations: int) -> float:
+    start = time.perf_counter_ns()
+    for _ in range(iterations):
+        function()
+    return (time.perf_counter_ns() - start) / iterations
+
+
+def bench_primitives(iterations: int):
+    registry = metrics.Registry()
+    counter = registry.register(metrics.Counter("bench_total", "Benchmark counter."))
+    histogram = registry.register(metrics.Histogram("bench_seconds", "Benchmark histogram.", ("route",)))
+    labels = ("/sensordata",)
+    print(f"{'counter inc':<28} {per_call_ns(counter.inc, iterations):>10.0f} ns")
+    print(f"{'histogram observe':<28} {per_call_ns(lambda: histogram.observe(0.003, labels), iterations):>10.0f} ns")
+    for route in range(20):
+        histogram.observe(0.003, (f"/route{route}",))
+    print(f"{'render 20 histograms':<28} {per_call_ns(registry.render, 1000) / 1000:>10.0f} us")
+
+
+async def statements_per_second(instrumented: bool, statements: int) -> float:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        engine = create_async_engine(f"sqlite+aiosqlite:///{os.path.join(tmp_dir, 'bench.db')}")
+        if instrumented:
+            metrics.instrument_engine(engine)
+        async with engine.begin() as conn:
+            await conn.run_sync(models.Base.metadata.create_all)
+        session_factory = sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+        sensor_uuid = uuid.uuid4().hex
+        async with session_factory() as session:
+            start = time.perf_counter()
+            # small statements, where the per statement overhead of the listeners weighs most
+            for i in range(statements // 2):
+                await session.execute(insert(models.Event).values(
+                    event_uuid=uuid.uuid4().hex, value=float(i), unit="degree",
+                    timestamp=datetime.now(), sensor_uuid=sensor_uuid))
+                await session.execute(select(models.Event.value).where(models.Event.sensor_uuid == sensor_uuid)
+                                      .limit(1))
+            await session.commit()
+            elapsed = time.perf_counter() - start
+        await engine.dispose()
+    return statements / elapsed
+
+
+async def bench_engine(statements: int, rounds: int):
+    plain = max([await statements_per_second(False, statements) for _ in range(rounds)])
+    instrumented = max([await statements_per_second(True, statements) for _ in range(rounds)])
+    print(f"{'statements/s plain':<28} {plain:>10.0f}")
+    print(f"{'statements/s instrumented':<28} {instrumented:>10.0f}")
+    print(f"{'overhead per statement':<28} {(1 / instrumented - 1 / plain) * 1e6:>10.1f} us "
+          f"({(plain / instrumented - 1) * 100:.1f}%)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cost of the metrics instrumentation.")
+    parser.add_argument("--iterations", type=int, default=1_000_000, help="Calls per metric primitive.")
+    parser.add_argument("--statements", type=int, default=10_000, help="SQL statements per engine run.")
+    parser.add_argument("--rounds", type=int, default=3, help="Engine runs per variant, the best is reported.")
+    args = parser.parse_args()
+    bench_primitives(args.iterations)
+    asyncio.run(bench_engine(args.statements, args.rounds))
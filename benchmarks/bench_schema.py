@@ -0,0 +1,124 @@
+import argparse
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine, insert
+
+# make the server models importable the same way query_plans.py sees them, with the default text schema
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT_DIR)
+
+from server.db import models, migrations, types
+
+START = datetime(2024, 1, 1)
+
+
+def create_text_database(path: str, sensors: int, events: int):
+    """A server database with the text schema: events every second per sensor, an average per 10 events."""
+    engine = create_engine(f"sqlite:///{path}")
+    sensor_uuids = [uuid.uuid4().hex for _ in range(sensors)]
+    with engine.begin() as connection:
+        migrations.upgrade_schema(connection, models.Base.metadata)
+        connection.execute(insert(models.Sensor), [
+            {"sensor_uuid": sensor_uuid, "sensor_type": "temperature", "sensor_name": "bench"}
+            for sensor_uuid in sensor_uuids
+        ])
+    batch = []
+    for i in range(events):
+        batch.append({
+            "event_uuid": uuid.uuid4().hex, "value": random.randint(0, 40), "unit": "degree",
+            "timestamp": START + timedelta(seconds=i // sensors, microseconds=random.randint(0, 999999)),
+            "sensor_uuid": sensor_uuids[i % sensors],
+        })
+        if len(batch) == 10000 or i == events - 1:
+            with engine.begin() as connection:
+                connection.execute(insert(models.Event), batch)
+                connection.execute(insert(models.Averages), [
+                    {"average_uuid": uuid.uuid4().hex, "average": 20.0, "calculation_timestamp": row["timestamp"],
+                     "transmitted": True, "sensor_uuid": row["sensor_uuid"], "sequence": j}
+                    for j, row in enumerate(batch[::10])
+                ])
+            batch = []
+    engine.dispose()
+    return sensor_uuids
+
+
+def sizes(path: str) -> dict[str, int]:
+    """Bytes per table and index."""
+    with sqlite3.connect(path) as connection:
+        return dict(connection.execute("SELECT name, sum(pgsize) FROM dbstat GROUP BY name ORDER BY 2 DESC"))
+
+
+def query_latencies(path: str, compact: bool, sensor_uuids: list[str], event_uuids: list[str],
+                    rounds: int) -> dict[str, float]:
+    """Mean milliseconds of the hot event queries, with the parameters in the stored format."""
+    def key(value: str):
+        return bytes.fromhex(value) if compact else value
+
+    def timestamp(value: datetime):
+        return types.EpochMicros().process_bind_param(value, None) if compact else str(value)
+
+    hour_start = START + timedelta(minutes=10)
+    queries = {
+        "newest 10 of a sensor": ("SELECT value FROM events WHERE sensor_uuid = ? ORDER BY timestamp DESC LIMIT 10",
+                                  lambda i: (key(sensor_uuids[i % len(sensor_uuids)]),)),
+        "hour of a sensor": ("SELECT timestamp, value FROM events WHERE sensor_uuid = ? AND timestamp >= ? "
+                             "AND timestamp < ?",
+                             lambda i: (key(sensor_uuids[i % len(sensor_uuids)]), timestamp(hour_start),
+                                        timestamp(hour_start + timedelta(hours=1)))),
+        "event by uuid": ("SELECT value FROM events WHERE event_uuid = ?",
+                          lambda i: (key(event_uuids[i % len(event_uuids)]),)),
+    }
+    latencies = {}
+    with sqlite3.connect(path) as connection:
+        for name, (sql, parameters) in queries.items():
+            connection.execute(sql, parameters(0)).fetchall()
+            start = time.perf_counter()
+            for i in range(rounds):
+                connection.execute(sql, parameters(i)).fetchall()
+            latencies[name] = (time.perf_counter() - start) / rounds * 1000
+    return latencies
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="File size and query latency of the text vs. the compact schema.")
+    parser.add_argument("--sensors", type=int, default=100, help="Sensors the events are spread over.")
+    parser.add_argument("--events", type=int, default=500000, help="Events in the database.")
+    parser.add_argument("--rounds", type=int, default=200, help="Executions per query.")
+    args = parser.parse_args()
+    random.seed(1)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        text_path = os.path.join(tmp_dir, "text.db")
+        compact_path = os.path.join(tmp_dir, "compact.db")
+        sensor_uuids = create_text_database(text_path, args.sensors, args.events)
+        with sqlite3.connect(text_path) as connection:
+            event_uuids = [row[0] for row in connection.execute(
+                "SELECT event_uuid FROM events ORDER BY random() LIMIT ?", (args.rounds,))]
+
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-m", "server.db.migrations", text_path, compact_path],
+                       cwd=ROOT_DIR, check=True, stdout=subprocess.DEVNULL)
+        convert_seconds = time.perf_counter() - start
+
+        text_sizes, compact_sizes = sizes(text_path), sizes(compact_path)
+        print(f"{args.events} events of {args.sensors} sensors, converted in {convert_seconds:.1f} s "
+              f"({args.events / convert_seconds:.0f} events/s)")
+        print(f"{'table / index':<40} {'text KiB':>10} {'compact KiB':>12}")
+        for name in text_sizes:
+            print(f"{name:<40} {text_sizes[name] / 1024:>10.0f} {compact_sizes.get(name, 0) / 1024:>12.0f}")
+        text_total, compact_total = os.path.getsize(text_path), os.path.getsize(compact_path)
+        print(f"{'file':<40} {text_total / 1024:>10.0f} {compact_total / 1024:>12.0f} "
+              f"({compact_total / text_total:.0%})")
+
+        text_latencies = query_latencies(text_path, False, sensor_uuids, event_uuids, args.rounds)
+        compact_latencies = query_latencies(compact_path, True, sensor_uuids, event_uuids, args.rounds)
+        print(f"{'query':<40} {'text ms':>10} {'compact ms':>12}")
+        for name in text_latencies:
+            print(f"{name:<40} {text_latencies[name]:>10.3f} {compact_latencies[name]:>12.3f}")
@@ -0,0 +1,101 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+# startup cost of the client: import time of client_main, time of setup() and the peak RSS afterwards, each measured
+# in a fresh interpreter. Exits non-zero if the headless client gets slower or bigger than the limits, or imports
+# a module it should not need.
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# modules a headless client must not import before it needs them, the segment log needs NumPy
+HEADLESS_FORBIDDEN = ["matplotlib", "PyQt5", "client.plotting", "numpy", "client.generated.fast_api_client.models"]
+SEGMENTLOG_FORBIDDEN = [module for module in HEADLESS_FORBIDDEN if module != "numpy"]
+
+CHILD = """
+import json, resource, sys, time
+start = time.perf_counter()
+from client import client_main
+imported = time.perf_counter()
+client_main.setup(client_main.parse_args(sys.argv[1:]))
+for module in {extra_imports!r}:
+    __import__(module)
+initialized = time.perf_counter()
+print(json.dumps({{
+    "import_ms": (imported - start) * 1000,
+    "init_ms": (initialized - imported) * 1000,
+    # kilobytes on linux
+    "rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    "modules": sorted(sys.modules),
+}}))
+"""
+
+# interpreter and site packages alone, for reference
+BASELINE = """
+import json, resource
+print(json.dumps({"import_ms": 0, "init_ms": 0, "rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                  "modules": []}))
+"""
+
+
+def measure(code: str, argv: list[str]) -> dict:
+    result = subprocess.run([sys.executable, "-c", code, *argv], capture_output=True, text=True, check=True,
+                            cwd=ROOT_DIR, env={**os.environ, "PYTHONPATH": ROOT_DIR})
+    return json.loads(result.stdout.splitlines()[-1])
+
+
+def loaded(modules: list[str], name: str) -> bool:
+    return any(module == name or module.startswith(name + ".") for module in modules)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Startup time and memory of the client.")
+    parser.add_argument("--repeat", type=int, default=5, help="Fresh interpreters per mode, the median is reported.")
+    parser.add_argument("--max-import-ms", type=float, default=1000, help="Limit of the headless client_main import.")
+    parser.add_argument("--max-rss-mb", type=float, default=120, help="Limit of the headless RSS after setup().")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        client_args = ["--server-ip", "127.0.0.1"]
+        modes = {
+            "interpreter": (BASELINE, [], None),
+            "headless": (CHILD.format(extra_imports=[]), client_args + ["--headless"], HEADLESS_FORBIDDEN),
+            "headless segmentlog": (CHILD.format(extra_imports=[]), client_args + [
+                "--headless", "--event-store", "segmentlog", "--segment-dir", os.path.join(tmp_dir, "segments")
+            ], SEGMENTLOG_FORBIDDEN),
+            # what the client imports once its plot task starts
+            "with plots": (CHILD.format(extra_imports=["client.plotting"]), client_args, None),
+            # what the startup imported before the generated client and the plots were imported lazily
+            "eager imports": (CHILD.format(extra_imports=["client.plotting", "client.fleet",
+                                                          "client.generated.fast_api_client.models",
+                                                          "client.generated.fast_api_client.api.default"]),
+                              client_args, None),
+        }
+        report = {}
+        failures = []
+        for name, (code, argv, forbidden) in modes.items():
+            runs = [measure(code, argv) for _ in range(args.repeat)]
+            modules = runs[-1]["modules"]
+            report[name] = {
+                "import_ms": round(statistics.median(run["import_ms"] for run in runs), 1),
+                "init_ms": round(statistics.median(run["init_ms"] for run in runs), 1),
+                "rss_mb": round(statistics.median(run["rss_mb"] for run in runs), 1),
+                "modules": len(modules),
+                "loaded": [module for module in HEADLESS_FORBIDDEN if loaded(modules, module)],
+            }
+            if forbidden is not None:
+                unexpected = [module for module in forbidden if loaded(modules, module)]
+                if unexpected:
+                    failures.append(f"{name} imports {', '.join(unexpected)}")
+                if report[name]["import_ms"] > args.max_import_ms:
+                    failures.append(f"{name} import takes {report[name]['import_ms']} ms")
+                if report[name]["rss_mb"] > args.max_rss_mb:
+                    failures.append(f"{name} uses {report[name]['rss_mb']} MiB")
+
+    print(json.dumps(report, indent=2))
+    for failure in failures:
+        print("[FAIL]", failure)
+    sys.exit(1 if failures else 0)
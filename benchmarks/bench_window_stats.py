@@ -0,0 +1,84 @@
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+import numpy as np
+
+# make the server modules importable the same way server_main.py sees them
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT_DIR)
+sys.path.append(os.path.join(ROOT_DIR, "server"))
+
+import window_stats
+
+
+def generate_events(sensors: int, max_events: int) -> list[tuple[int, float, float]]:
+    """(sensor position, julian day, value) like the window queries load them, with varying window fill."""
+    events = []
+    for position in range(sensors):
+        for second in range(random.randint(1, max_events)):
+            events.append((position, 2460310.5 + second / 86400, random.gauss(20.0, 5.0)))
+    random.shuffle(events)
+    return events
+
+
+def per_sensor(sensors: int, events: list[tuple], alpha: float) -> list[list[float]]:
+    """The same statistics with one python pass per sensor, as a baseline."""
+    windows = [[] for _ in range(sensors)]
+    for position, day, value in events:
+        windows[position].append((day, value))
+    results = []
+    for window in windows:
+        sensor_values = [value for _, value in sorted(window)]
+        ewma = sensor_values[0]
+        for value in sensor_values[1:]:
+            ewma = alpha * value + (1 - alpha) * ewma
+        percentiles = np.percentile(sensor_values, [50, 95])
+        results.append([len(sensor_values), statistics.fmean(sensor_values), min(sensor_values),
+                        max(sensor_values), statistics.pstdev(sensor_values), *percentiles, ewma])
+    return results
+
+
+def vectorized(sensors: int, arrays: tuple, alpha: float) -> dict:
+    matrix, counts, _ = window_stats.value_matrix(sensors, *arrays)
+    return window_stats.calculate(matrix, counts, window_stats.STATISTICS, alpha)
+
+
+def best_seconds(function, rounds: int) -> float:
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Window statistics per sensor loop vs. one vectorized pass.")
+    parser.add_argument("--sensors", type=int, default=1000, help="Sensors aggregated together.")
+    parser.add_argument("--events", type=int, default=300, help="Maximum events in a sensor's window.")
+    parser.add_argument("--rounds", type=int, default=5, help="Runs per variant, the best is reported.")
+    args = parser.parse_args()
+    random.seed(1)
+    events = generate_events(args.sensors, args.events)
+    arrays = (np.array([event[0] for event in events], dtype=np.intp),
+              np.array([event[1] for event in events]), np.array([event[2] for event in events]))
+    alpha = window_stats.EWMA_ALPHA
+
+    # the normalized ewma of a finite window differs from the recursive one, only compare the exact statistics
+    expected = per_sensor(args.sensors, events, alpha)
+    actual = vectorized(args.sensors, arrays, alpha)
+    for position in range(args.sensors):
+        for column, statistic in enumerate(window_stats.STATISTICS[:-1]):
+            if not np.isclose(expected[position][column], actual[statistic][position]):
+                sys.exit(f"{statistic} of sensor {position} differs: {expected[position][column]} "
+                         f"!= {actual[statistic][position]}")
+
+    loop_seconds = best_seconds(lambda: per_sensor(args.sensors, events, alpha), args.rounds)
+    vectorized_seconds = best_seconds(lambda: vectorized(args.sensors, arrays, alpha), args.rounds)
+    print(f"{len(events)} events of {args.sensors} sensors, {len(window_stats.STATISTICS)} statistics")
+    print(f"{'per sensor loop':<20} {loop_seconds * 1000:>10.1f} ms")
+    print(f"{'vectorized':<20} {vectorized_seconds * 1000:>10.1f} ms ({loop_seconds / vectorized_seconds:.1f}x)")
@@ -0,0 +1,98 @@
+import argparse
+import gzip
+import os
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta
+
+import pytz
+
+# make the server modules importable the same way server_main.py sees them
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT_DIR)
+sys.path.append(os.path.join(ROOT_DIR, "server"))
+
+import apimodels
+import ingest
+import wireformat
+from client import wireformat as client_wireformat
+from client.db import models as client_models
+
+
+def make_events(count: int, sensors: int) -> list[client_models.Event]:
+    sensor_uuids = [uuid.uuid4().hex for _ in range(sensors)]
+    start = datetime.now(pytz.UTC).replace(tzinfo=None)
+    return [
+        client_models.Event(
+            event_uuid=uuid.uuid4().hex,
+            value=20.0 + (i % 100) / 10,
+            unit="degree",
+            time=start + timedelta(milliseconds=i),
+            sensor_uuid=sensor_uuids[i % sensors],
+            transmitted=False
+        )
+        for i in range(count)
+    ]
+
+
+def json_body(events: list[client_models.Event]) -> bytes:
+    # what the generated client sends
+    return apimodels.SensorEventDataRequest(events=[
+        apimodels.EventRemote(
+            event_uuid=event.event_uuid,
+            value=event.value,
+            unit=event.unit,
+            sensor_uuid=event.sensor_uuid,
+            timestamp=event.time.isoformat()
+        )
+        for event in events
+    ]).model_dump_json().encode()
+
+
+def decode_json(body: bytes, content_encoding: str | None) -> list[dict]:
+    if content_encoding == "gzip":
+        body = gzip.decompress(body)
+    return ingest.event_rows(apimodels.SensorEventDataRequest.model_validate_json(body).events)
+
+
+def decode_columnar(body: bytes, content_encoding: str | None) -> list[dict]:
+    # without the server's size limit, the bench decodes uploads of any number of events
+    return wireformat.decode(wireformat.decompress(body, content_encoding, sys.maxsize))[0]
+
+
+def server_cpu_seconds(decode, body: bytes, content_encoding: str | None, repeat: int) -> float:
+    start = time.process_time()
+    for _ in range(repeat):
+        decode(body, content_encoding)
+    return (time.process_time() - start) / repeat
+
+
+def main(count: int, sensors: int, repeat: int):
+    events = make_events(count, sensors)
+    raw_json = json_body(events)
+    raw_columnar = client_wireformat.encode(events)
+    variants = [
+        ("json", raw_json, None, decode_json),
+        ("json+gzip", gzip.compress(raw_json, compresslevel=6), "gzip", decode_json),
+    ]
+    for compression in reversed(client_wireformat.COMPRESSIONS):
+        body, headers = client_wireformat.compress(raw_columnar, compression)
+        name = "columnar" if compression == "none" else f"columnar+{compression}"
+        variants.append((name, body, headers.get("Content-Encoding"), decode_columnar))
+
+    print(f"{count} events, {sensors} sensors")
+    print(f"{'format':>16} {'bytes':>10} {'bytes/event':>12} {'server cpu ms':>14}")
+    for name, body, content_encoding, decode in variants:
+        assert len(decode(body, content_encoding)) == count
+        cpu = server_cpu_seconds(decode, body, content_encoding, repeat)
+        print(f"{name:>16} {len(body):>10} {len(body) / count:>12.1f} {cpu * 1000:>14.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the json and columnar /sensordata wire formats.")
+    parser.add_argument("--events", type=int, default=10_000, help="Events per request.")
+    parser.add_argument("--sensors", type=int, default=2, help="Sensors the events are spread over.")
+    parser.add_argument("--repeat", type=int, default=20, help="Decode repetitions to average the cpu time over.")
+    args = parser.parse_args()
+    main(args.events, args.sensors, args.repeat)
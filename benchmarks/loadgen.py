@@ -0,0 +1,315 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import httpx
+import pytz
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT_DIR)
+
+from client import scheduler, wireformat
+
+ENDPOINTS = ["/createSensor", "/sensordata", "/receivedAverages"]
+# server environment without admission control, for comparison
+NO_ADMISSION = {"SERVER_CLIENT_EVENT_RATE": "0", "SERVER_MAX_INGEST_IN_FLIGHT": "0"}
+
+
+def percentile(values: list[float], fraction: float) -> float | None:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def latency_percentiles(latencies: list[float]) -> dict:
+    if not latencies:
+        return {"p50_ms": None, "p95_ms": None, "p99_ms": None}
+    return {f"p{int(fraction * 100)}_ms": percentile(latencies, fraction) * 1000 for fraction in (0.50, 0.95, 0.99)}
+
+
+def db_size(db_path: str | None) -> int | None:
+    if db_path is None:
+        return None
+    return sum(os.path.getsize(path) for path in (db_path, db_path + "-wal") if os.path.exists(path))
+
+
+class Stats:
+    def __init__(self):
+        self.latencies = {endpoint: [] for endpoint in ENDPOINTS}
+        self.errors = {endpoint: 0 for endpoint in ENDPOINTS}
+        self.rejected = {endpoint: 0 for endpoint in ENDPOINTS}
+        self.status_codes = {}
+        self.events_generated = 0
+        self.events_acked = 0
+        self.drain_times = []
+        # uploads started after the reconnect storm, as (monotonic start, latency, status code)
+        self.storm_end = None
+        self.storm_uploads = []
+
+    async def request(self, http: httpx.AsyncClient, endpoint: str, **kwargs) -> httpx.Response | None:
+        """The response if it is a 200 or a rejection of the admission control (413, 429, 503), None otherwise."""
+        started_at = time.monotonic()
+        start = time.perf_counter()
+        try:
+            response = await http.post(endpoint, **kwargs)
+        except httpx.HTTPError:
+            self.errors[endpoint] += 1
+            return None
+        latency = time.perf_counter() - start
+        self.latencies[endpoint].append(latency)
+        self.status_codes[response.status_code] = self.status_codes.get(response.status_code, 0) + 1
+        if endpoint == "/sensordata" and self.storm_end is not None and started_at >= self.storm_end:
+            self.storm_uploads.append((started_at, latency, response.status_code))
+        if response.status_code in scheduler.REJECTED_STATUS_CODES:
+            self.rejected[endpoint] += 1
+            return response
+        if response.status_code != 200:
+            self.errors[endpoint] += 1
+            return None
+        return response
+
+
+class SimulatedClient:
+    """One fog node: M sensors producing events, synced in batches, with occasional uplink outages."""
+
+    def __init__(self, index: int, args, stats: Stats):
+        self.index = index
+        self.args = args
+        self.stats = stats
+        self.sensor_uuids = []
+        self.backlog = []
+        self.acked_sequences = {}
+        self.offline_until = 0.0
+        self.reconnected_at = None
+        self.sync_scheduler = scheduler.SyncScheduler(args.sync_period, backlog_interval=0)
+
+    async def register(self, http: httpx.AsyncClient):
+        for sensor in range(self.args.sensors):
+            response = await self.stats.request(http, "/createSensor",
+                                                json={"type": "temperature", "name": f"load_{self.index}_{sensor}"})
+            if response is not None:
+                self.sensor_uuids.append(response.json()["uuid"])
+
+    def generate(self, seconds: float):
+        now = datetime.now(pytz.UTC)
+        for sensor_uuid in self.sensor_uuids:
+            for _ in range(int(self.args.rate * seconds + random.random())):
+                self.backlog.append(SimpleNamespace(
+                    event_uuid=uuid.uuid4().hex,
+                    value=random.uniform(15, 30),
+                    unit="degree",
+                    time=now - timedelta(milliseconds=random.uniform(0, seconds * 1000)),
+                    sensor_uuid=sensor_uuid
+                ))
+                self.stats.events_generated += 1
+
+    async def sync(self, http: httpx.AsyncClient) -> float | None:
+        """Upload the oldest batch of the backlog, returns the delay the server asked for if it rejected it."""
+        batch = self.backlog[:self.args.batch_size]
+        if not batch:
+            return None
+        if self.args.wire_format == "columnar":
+            body, headers = wireformat.compress(wireformat.encode(batch, self.acked_sequences), self.args.compression)
+            response = await self.stats.request(http, "/sensordata", content=body, headers=headers)
+        else:
+            response = await self.stats.request(http, "/sensordata", json={"events": [
+                {"event_uuid": event.event_uuid, "value": event.value, "unit": event.unit,
+                 "timestamp": event.time.isoformat(), "sensor_uuid": event.sensor_uuid}
+                for event in batch
+            ], "acked_sequences": self.acked_sequences})
+        if response is None:
+            return None
+        if response.status_code != 200:
+            if self.args.ignore_retry_after:
+                return self.args.sync_period
+            # like the client's sync loop
+            return self.sync_scheduler.rejected(response.status_code, scheduler.retry_after(response.headers))
+        self.sync_scheduler.failures = 0
+        result = response.json()
+        received = set(result["received_event_uuids"])
+        self.backlog = [event for event in self.backlog if event.event_uuid not in received]
+        self.stats.events_acked += len(received)
+        # averages with a sequence are acknowledged with the next upload, like the client does
+        legacy_averages = []
+        for average in result["averages"]:
+            if average.get("sequence") is None:
+                legacy_averages.append(average["average_uuid"])
+            else:
+                sensor_uuid = average["sensor_uuid"]
+                self.acked_sequences[sensor_uuid] = max(self.acked_sequences.get(sensor_uuid, 0), average["sequence"])
+        if legacy_averages:
+            await self.stats.request(http, "/receivedAverages", json={"received": legacy_averages})
+        return None
+
+    async def run(self, base_url: str, start: float, deadline: float):
+        headers = {scheduler.CLIENT_HEADER: f"load_{self.index}"}
+        async with httpx.AsyncClient(base_url=base_url, timeout=self.args.timeout, headers=headers) as http:
+            await self.register(http)
+            last_tick = time.monotonic()
+            # spread the clients over the sync period
+            await asyncio.sleep(random.uniform(0, self.args.sync_period))
+            stormed = False
+            while time.monotonic() < deadline:
+                now = time.monotonic()
+                self.generate(now - last_tick)
+                last_tick = now
+                if self.args.storm_at is not None and not stormed and now >= start + self.args.storm_at:
+                    # every client loses its uplink at the same time and gets it back at the same moment
+                    stormed = True
+                    self.offline_until = start + self.args.storm_at + self.args.disconnect_seconds
+                    self.reconnected_at = self.offline_until
+                if now < self.offline_until:
+                    await asyncio.sleep(min(self.args.sync_period, self.offline_until - now))
+                    continue
+                if random.random() < self.args.disconnect_probability:
+                    self.offline_until = now + self.args.disconnect_seconds
+                    self.reconnected_at = self.offline_until
+                    continue
+                retry_after = await self.sync(http)
+                if self.reconnected_at is not None and len(self.backlog) <= self.args.batch_size:
+                    self.stats.drain_times.append(time.monotonic() - self.reconnected_at)
+                    self.reconnected_at = None
+                if retry_after is not None:
+                    await asyncio.sleep(retry_after)
+                # drain a backlog back to back, otherwise wait for the next period
+                elif len(self.backlog) < self.args.batch_size:
+                    await asyncio.sleep(self.args.sync_period)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(db_path: str, port: int, workers: int, environment: dict | None = None) -> subprocess.Popen:
+    env = dict(os.environ, SERVER_DATABASE_URL=f"sqlite+aiosqlite:///{db_path}", SERVER_WORKERS=str(workers),
+               **(environment or {}))
+    command = [sys.executable, "-m", "uvicorn", "server_main:app", "--port", str(port), "--log-level", "warning"]
+    if workers > 1:
+        command += ["--workers", str(workers)]
+    return subprocess.Popen(command, cwd=os.path.join(ROOT_DIR, "server"), env=env)
+
+
+async def wait_until_up(base_url: str, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(base_url=base_url) as http:
+        while time.monotonic() < deadline:
+            try:
+                await http.get("/sensors")
+                return
+            except httpx.HTTPError:
+                await asyncio.sleep(0.2)
+    raise RuntimeError("Server did not start")
+
+
+def storm_report(stats: Stats) -> dict:
+    """Uploads after the simultaneous reconnect: latency of all responses and of the accepted ones."""
+    accepted = [latency for _, latency, status_code in stats.storm_uploads if status_code == 200]
+    return {
+        "uploads": len(stats.storm_uploads),
+        "rejected": len(stats.storm_uploads) - len(accepted),
+        "all": latency_percentiles([latency for _, latency, _ in stats.storm_uploads]),
+        "accepted": latency_percentiles(accepted),
+    }
+
+
+async def run_load(args, base_url: str, db_path: str | None) -> dict:
+    stats = Stats()
+    size_before = db_size(db_path)
+    start = time.monotonic()
+    if args.storm_at is not None:
+        stats.storm_end = start + args.storm_at + args.disconnect_seconds
+    clients = [SimulatedClient(index, args, stats) for index in range(args.clients)]
+    await asyncio.gather(*(client.run(base_url, start, start + args.duration) for client in clients))
+    elapsed = time.monotonic() - start
+    size_after = db_size(db_path)
+    return {
+        "config": {key: value for key, value in vars(args).items() if key != "output"},
+        "elapsed_seconds": elapsed,
+        "events_generated": stats.events_generated,
+        "events_acked": stats.events_acked,
+        "events_per_second": stats.events_acked / elapsed,
+        "backlog_remaining": sum(len(client.backlog) for client in clients),
+        "status_codes": stats.status_codes,
+        "endpoints": {
+            endpoint: {
+                "requests": len(latencies),
+                "errors": stats.errors[endpoint],
+                "rejected": stats.rejected[endpoint],
+                **latency_percentiles(latencies),
+            }
+            for endpoint, latencies in stats.latencies.items()
+        },
+        "db_bytes_before": size_before,
+        "db_bytes_after": size_after,
+        "db_bytes_growth": size_after - size_before if db_path else None,
+        "backlog_drain_seconds": {
+            "count": len(stats.drain_times),
+            "p50": percentile(stats.drain_times, 0.50),
+            "max": max(stats.drain_times, default=None),
+        },
+        "reconnect_storm": storm_report(stats) if args.storm_at is not None else None,
+    }
+
+
+async def main(args):
+    if args.url:
+        return await run_load(args, args.url, args.db_path)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = os.path.join(tmp_dir, "load.db")
+        port = free_port()
+        server = start_server(db_path, port, args.workers, NO_ADMISSION if args.no_admission else None)
+        try:
+            base_url = f"http://127.0.0.1:{port}"
+            await wait_until_up(base_url)
+            return await run_load(args, base_url, db_path)
+        finally:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Headless load generator for the fog sync protocol.")
+    parser.add_argument("--clients", type=int, default=10, help="Simulated clients.")
+    parser.add_argument("--sensors", type=int, default=2, help="Sensors per client.")
+    parser.add_argument("--rate", type=float, default=1.0, help="Events per second per sensor.")
+    parser.add_argument("--sync-period", type=float, default=5.0, help="Seconds between syncs of a client.")
+    parser.add_argument("--batch-size", type=int, default=1000, help="Maximum events per /sensordata request.")
+    parser.add_argument("--duration", type=float, default=60.0, help="Seconds to generate load.")
+    parser.add_argument("--disconnect-probability", type=float, default=0.0,
+                        help="Chance per sync that a client loses its uplink.")
+    parser.add_argument("--disconnect-seconds", type=float, default=30.0, help="Length of an uplink outage.")
+    parser.add_argument("--storm-at", type=float, default=None,
+                        help="Reconnect storm: all clients lose their uplink this many seconds into the run and "
+                             "reconnect together --disconnect-seconds later, each with its backlog.")
+    parser.add_argument("--ignore-retry-after", action="store_true",
+                        help="Retry rejected uploads after the sync period instead of the server's Retry-After.")
+    parser.add_argument("--no-admission", action="store_true",
+                        help="Launch the server without per client and in-flight limits, for comparison.")
+    parser.add_argument("--wire-format", choices=["json", "columnar"], default="json")
+    parser.add_argument("--compression", choices=wireformat.COMPRESSIONS, default="gzip")
+    parser.add_argument("--timeout", type=float, default=30.0, help="HTTP timeout in seconds.")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn workers of the launched server.")
+    parser.add_argument("--url", help="Use a running server instead of launching one.")
+    parser.add_argument("--db-path", help="Database file of the running server given with --url, for size growth.")
+    parser.add_argument("--output", help="Write the json report to this file instead of stdout.")
+    args = parser.parse_args()
+
+    report = asyncio.run(main(args))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
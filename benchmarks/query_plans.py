@@ -0,0 +1,229 @@
+import os
+import re
+import sys
+import tempfile
+from datetime import datetime
+
+from sqlalchemy import create_engine, func, inspect, literal_column, text, update
+from sqlalchemy.future import select
+
+# regression check: the hot queries of server and client must be answered from the indexes. The statements are
+# built by the modules that run them, so a changed query is checked as it is
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT_DIR)
+# the server modules import the models the way server_main.py sees them
+sys.path.append(os.path.join(ROOT_DIR, "server"))
+
+import db.models as server_models
+from server.db import migrations as server_migrations
+from client.db import models as client_models, migrations as client_migrations
+from client import plotting, retention
+
+import aggregator
+import broadcaster
+import dedup
+import latest
+import registry
+import rolling
+import window_stats
+
+EVENT_RETENTION, AVERAGE_RETENTION = retention.default_policies(7, 30)
+
+ROWID = literal_column("rowid")
+SENSOR_UUID = "0" * 32
+OTHER_SENSOR_UUID = "1" * 32
+PLOT_FEED = plotting.PlotFeed([SENSOR_UUID, OTHER_SENSOR_UUID], 600)
+# a range of one sensor in an index, one line per sensor of a compound select
+SEARCH_EVENTS = "SEARCH events USING INDEX ix_events_sensor_timestamp (sensor_uuid=?)"
+SEARCH_AVERAGES = "SEARCH averages USING INDEX ix_averages_sensor_timestamp (sensor_uuid=?)"
+
+# name -> (statement, a regular expression the plan must match)
+SERVER_QUERIES = {
+    "rolling window warm up": (
+        rolling.newest_events_query({SENSOR_UUID: 10, OTHER_SENSOR_UUID: 10}),
+        "^" + re.escape(SEARCH_EVENTS) + "$"
+    ),
+    "websocket snapshot events": (
+        broadcaster.snapshot_query(server_models.Event, server_models.Event.timestamp, broadcaster.EVENT_POSITION,
+                                   SENSOR_UUID),
+        re.escape(SEARCH_EVENTS)
+    ),
+    "websocket event deltas": (
+        broadcaster.delta_query(server_models.Event, broadcaster.EVENT_POSITION, SENSOR_UUID, 100),
+        re.escape("SEARCH events USING INDEX ix_events_sensor (sensor_uuid=? AND rowid>?)")
+    ),
+    "websocket snapshot averages": (
+        broadcaster.snapshot_query(server_models.Averages, server_models.Averages.calculation_timestamp,
+                                   broadcaster.AVERAGE_POSITION, SENSOR_UUID),
+        re.escape(SEARCH_AVERAGES)
+    ),
+    "websocket average deltas": (
+        broadcaster.delta_query(server_models.Averages, broadcaster.AVERAGE_POSITION, SENSOR_UUID, 100),
+        re.escape("SEARCH averages USING INDEX ix_averages_sensor_sequence (sensor_uuid=? AND sequence>?)")
+    ),
+    # the queries of server_main.py, which can't be imported without starting the app
+    "untransmitted averages": (
+        select(server_models.Averages)
+        .where(server_models.Averages.transmitted == False,
+               server_models.Averages.sensor_uuid.in_([SENSOR_UUID, OTHER_SENSOR_UUID])),
+        "ix_averages_untransmitted_sensor"
+    ),
+    "piggybacked ack": (
+        update(server_models.Averages)
+        .where(server_models.Averages.sensor_uuid == SENSOR_UUID, server_models.Averages.transmitted == False,
+               server_models.Averages.sequence <= 10)
+        .values(transmitted=True),
+        "ix_averages_untransmitted_sensor"
+    ),
+    "next average sequence": (
+        aggregator.NEXT_SEQUENCE.params(sequence_sensor_uuid=SENSOR_UUID),
+        "ix_averages_sensor_sequence"
+    ),
+    "recent events warm up": (
+        dedup.newest_events_query(100000),
+        # the table in rowid order, backwards
+        "^SCAN events$"
+    ),
+    "sensor registry refresh": (
+        registry.new_sensors_query(100),
+        re.escape("SEARCH sensors USING INTEGER PRIMARY KEY (rowid>?)")
+    ),
+    "latest state events": (
+        latest.newest_event_query(None),
+        "ix_events_sensor_timestamp"
+    ),
+    "latest state events of listed sensors": (
+        latest.newest_event_query([SENSOR_UUID, OTHER_SENSOR_UUID]),
+        "ix_events_sensor_timestamp"
+    ),
+    "latest state averages": (
+        latest.newest_average_query(None),
+        "ix_averages_sensor_timestamp"
+    ),
+    "sensor aggregates": (
+        select(server_models.Aggregate)
+        .where(server_models.Aggregate.sensor_uuid.in_([SENSOR_UUID, OTHER_SENSOR_UUID])),
+        "sqlite_autoindex_aggregates_1"
+    ),
+}
+for window_name, window in window_stats.WINDOWS.items():
+    SERVER_QUERIES[f"window statistics {window_name}"] = (
+        window_stats.window_statement(window, 2).params(sensor_0=SENSOR_UUID, sensor_1=OTHER_SENSOR_UUID),
+        "ix_events_sensor_timestamp"
+    )
+
+CLIENT_QUERIES = {
+    "sync page": (
+        select(ROWID, client_models.Event)
+        .where(ROWID > 100, client_models.Event.transmitted == False)
+        .order_by(ROWID).limit(1000),
+        re.escape("USING INTEGER PRIMARY KEY (rowid>?)")
+    ),
+    "first untransmitted event": (
+        select(func.min(ROWID + 0)).where(client_models.Event.transmitted == False),
+        "ix_events_untransmitted"
+    ),
+    "plot first events": (
+        PLOT_FEED.events_query(datetime(2024, 1, 1), None, 100000),
+        "ix_events_sensor_time"
+    ),
+    "plot first averages": (
+        PLOT_FEED.averages_query(datetime(2024, 1, 1), None, 100000),
+        "ix_averages_sensor_timestamp"
+    ),
+    "plot new events": (
+        PLOT_FEED.events_query(datetime(2024, 1, 1), 100000),
+        re.escape("USING INTEGER PRIMARY KEY (rowid>?)")
+    ),
+    "plot new averages": (
+        PLOT_FEED.averages_query(datetime(2024, 1, 1), 100000),
+        re.escape("USING INTEGER PRIMARY KEY (rowid>?)")
+    ),
+    "plot untransmitted events": (
+        PLOT_FEED.untransmitted_query(datetime(2024, 1, 1)),
+        "ix_events_untransmitted"
+    ),
+    "retention boundary": (
+        select(client_models.Event.time).where(ROWID >= 100).order_by(ROWID).limit(1),
+        re.escape("USING INTEGER PRIMARY KEY (rowid>?)")
+    ),
+    "retention expired events": (
+        EVENT_RETENTION.expired_rows(100000, 100, 2000, False),
+        re.escape("USING INTEGER PRIMARY KEY (rowid>? AND rowid<?)")
+    ),
+    "retention expired averages": (
+        AVERAGE_RETENTION.expired_rows(100000, 100, 2000, False),
+        "ix_averages_sensor_sequence"
+    ),
+    "acked sequences": (
+        select(client_models.Sensor.sensor_uuid,
+               select(func.max(client_models.Averages.sequence))
+               .where(client_models.Averages.sensor_uuid == client_models.Sensor.sensor_uuid)
+               .scalar_subquery()),
+        "ix_averages_sensor_sequence"
+    ),
+}
+
+# tables as created by versions without indexes, to check the migration path
+SENSORS_TABLE = "CREATE TABLE sensors (sensor_uuid VARCHAR NOT NULL PRIMARY KEY, sensor_type VARCHAR, sensor_name VARCHAR)"
+SERVER_LEGACY_SCHEMA = [
+    SENSORS_TABLE,
+    "CREATE TABLE events (event_uuid VARCHAR NOT NULL PRIMARY KEY, value INTEGER, unit VARCHAR, timestamp DATETIME, "
+    "sensor_uuid VARCHAR REFERENCES sensors (sensor_uuid))",
+    "CREATE TABLE averages (average_uuid VARCHAR NOT NULL PRIMARY KEY, average FLOAT, calculation_timestamp DATETIME, "
+    "transmitted BOOLEAN, sensor_uuid VARCHAR REFERENCES sensors (sensor_uuid))",
+    # index of an older version, replaced by ix_averages_untransmitted_sensor
+    "CREATE INDEX ix_averages_untransmitted ON averages (sensor_uuid) WHERE transmitted = 0",
+]
+CLIENT_LEGACY_SCHEMA = [
+    SENSORS_TABLE,
+    "CREATE TABLE events (event_uuid VARCHAR NOT NULL PRIMARY KEY, value FLOAT, unit VARCHAR, transmitted BOOLEAN, "
+    "time DATETIME, sensor_uuid VARCHAR REFERENCES sensors (sensor_uuid))",
+    "CREATE TABLE averages (average_uuid VARCHAR NOT NULL PRIMARY KEY, average FLOAT, calculation_timestamp DATETIME, "
+    "sensor_uuid VARCHAR REFERENCES sensors (sensor_uuid))",
+]
+
+
+def query_plan(connection, statement) -> str:
+    sql = str(statement.compile(dialect=connection.dialect, compile_kwargs={"literal_binds": True}))
+    rows = connection.execute(text("EXPLAIN QUERY PLAN " + sql)).fetchall()
+    return "\n".join(row[-1] for row in rows)
+
+
+def check(name: str, legacy_schema: list[str], metadata, migrations, queries: dict) -> list[str]:
+    failures = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        engine = create_engine(f"sqlite:///{os.path.join(tmp_dir, 'plans.db')}")
+        with engine.begin() as connection:
+            for statement in legacy_schema:
+                connection.execute(text(statement))
+            migrations.upgrade_schema(connection, metadata)
+            existing_indexes = {index["name"] for table in metadata.sorted_tables
+                                for index in inspect(connection).get_indexes(table.name)}
+            for table in metadata.sorted_tables:
+                defined_indexes = {index.name for index in table.indexes}
+                for index in table.indexes:
+                    if index.name not in existing_indexes:
+                        failures.append(f"{name}: migration did not create {index.name}")
+                for index in inspect(connection).get_indexes(table.name):
+                    if index["name"] not in defined_indexes:
+                        failures.append(f"{name}: migration did not drop {index['name']}")
+            for query_name, (statement, expected) in queries.items():
+                plan = query_plan(connection, statement)
+                ok = re.search(expected, plan, re.MULTILINE) is not None and "TEMP B-TREE" not in plan
+                print(f"[{'ok' if ok else 'FAIL'}] {name} {query_name}: {plan.replace(chr(10), ' | ')}")
+                if not ok:
+                    failures.append(f"{name}: {query_name} does not match {expected} without sorting")
+        engine.dispose()
+    return failures
+
+
+if __name__ == "__main__":
+    # files of older versions have the text schema, the compact schema (SERVER_DB_SCHEMA, CLIENT_DB_SCHEMA) starts empty
+    failures = check("server", [] if server_models.COMPACT else SERVER_LEGACY_SCHEMA, server_models.Base.metadata,
+                     server_migrations, SERVER_QUERIES)
+    failures += check("client", [] if client_models.COMPACT else CLIENT_LEGACY_SCHEMA, client_models.Base.metadata,
+                      client_migrations, CLIENT_QUERIES)
+    for failure in failures:
+        print(failure)
+    sys.exit(1 if failures else 0)
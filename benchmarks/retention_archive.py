@@ -0,0 +1,138 @@
+import asyncio
+import csv
+import io
+import os
+import subprocess
+import sys
+import tempfile
+import uuid
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytz
+from sqlalchemy import insert, literal_column, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import sessionmaker
+
+# round trip check of the retention archives: every row the retention policies delete must be read back by
+# archive.read_archive() and exported by `python -m client.archive` with its values, filtered by time and sensor
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT_DIR)
+
+from client import archive, retention
+from client.db import database, migrations, models
+
+ROWID = literal_column("rowid")
+NOW = datetime(2024, 2, 1, tzinfo=pytz.UTC)
+SENSORS = [uuid.UUID(int=i).hex for i in range(1, 5)]
+EVENTS = 20000
+# several archive files per table
+ARCHIVE_FILE_ROWS = 3000
+
+
+def use_database(path: str):
+    """Point the client modules at a scratch database instead of client/db/client.db."""
+    database.engine = database.create_engine(f"sqlite+aiosqlite:///{path}",
+                                             database.ENGINE_PROFILES[database.ENGINE_PROFILE])
+    database.SessionLocal = sessionmaker(bind=database.engine, class_=AsyncSession, expire_on_commit=False)
+
+
+async def populate():
+    """20 days of events, every 10th not transmitted, and an average per 10 events with its sequence."""
+    start = NOW - timedelta(days=20)
+    step = timedelta(days=20) / EVENTS
+    events, averages = [], []
+    for i in range(EVENTS):
+        sensor_uuid = SENSORS[i % len(SENSORS)]
+        time = start + i * step
+        events.append({"event_uuid": uuid.uuid4().hex, "sensor_uuid": sensor_uuid, "time": time,
+                       "value": float(i), "unit": "degree", "transmitted": i % 10 != 0})
+        if i % 10 == 0:
+            averages.append({"average_uuid": uuid.uuid4().hex, "sensor_uuid": sensor_uuid, "average": float(i),
+                             "calculation_timestamp": time, "sequence": i // 10 + 1})
+    async with database.SessionLocal() as session:
+        async with session.begin():
+            await session.execute(insert(models.Sensor), [{"sensor_uuid": sensor_uuid, "sensor_type": "temperature",
+                                                           "sensor_name": sensor_uuid} for sensor_uuid in SENSORS])
+            await session.execute(insert(models.Event), events)
+            await session.execute(insert(models.Averages), averages)
+
+
+async def table_rows(table) -> dict[int, dict]:
+    """Rows by rowid, with naive UTC times like the archives."""
+    async with database.SessionLocal() as session:
+        result = await session.execute(select(ROWID.label("rowid"), *table.columns))
+    return {row.rowid: {name: value.replace(tzinfo=None) if isinstance(value, datetime) else value
+                        for name, value in row._mapping.items()} for row in result}
+
+
+def archived_rows(columns: dict[str, np.ndarray]) -> dict[int, dict]:
+    """The columns of read_archive() as rows by rowid."""
+    names = list(columns)
+    return {row[0]: dict(zip(names, row)) for row in zip(*(values.tolist() for values in columns.values()))}
+
+
+def check_table(name: str, time_column: str, deleted: dict[int, dict], directory: str) -> list[str]:
+    failures = []
+    everything = archived_rows(archive.read_archive(directory, name))
+    if everything != deleted:
+        failures.append(f"{name}: {len(deleted)} rows deleted, {len(everything)} read back, "
+                        f"{sum(everything.get(rowid) != row for rowid, row in deleted.items())} differ")
+
+    # a window of the time range and two of the sensors
+    start, end = NOW - timedelta(days=15), NOW - timedelta(days=12)
+    sensor_uuids = SENSORS[:2]
+    expected = {rowid: row for rowid, row in deleted.items()
+                if start.replace(tzinfo=None) <= row[time_column] < end.replace(tzinfo=None)
+                and row["sensor_uuid"] in sensor_uuids}
+    filtered = archived_rows(archive.read_archive(directory, name, start, end, sensor_uuids))
+    if not expected or filtered != expected:
+        failures.append(f"{name}: {len(expected)} rows in the window, {len(filtered)} read back")
+
+    exported = subprocess.run(
+        [sys.executable, "-m", "client.archive", directory, name, "--start", start.isoformat(),
+         "--end", end.isoformat(), *[argument for sensor_uuid in sensor_uuids
+                                     for argument in ("--sensor-uuid", sensor_uuid)]],
+        capture_output=True, text=True, check=True, cwd=ROOT_DIR, env={**os.environ, "PYTHONPATH": ROOT_DIR}
+    ).stdout
+    lines = list(csv.reader(io.StringIO(exported)))
+    if len(lines) != len(expected) + 1 or sorted(int(line[0]) for line in lines[1:]) != sorted(expected):
+        failures.append(f"{name}: {len(expected)} rows in the window, {len(lines) - 1} exported")
+    print(f"[{'FAIL' if failures else 'ok'}] {name}: {len(deleted)} deleted and read back, "
+          f"{len(expected)} in the filtered window")
+    return failures
+
+
+async def main() -> list[str]:
+    retention.ARCHIVE_FILE_ROWS = ARCHIVE_FILE_ROWS
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        use_database(os.path.join(tmp_dir, "client.db"))
+        async with database.engine.begin() as connection:
+            await connection.run_sync(migrations.upgrade_schema, models.Base.metadata)
+        await populate()
+        archive_dir = os.path.join(tmp_dir, "archive")
+        tables = [models.Event.__table__, models.Averages.__table__]
+        before = [await table_rows(table) for table in tables]
+        for policy in retention.default_policies(7, 10):
+            # timestamps are stored naive in utc, like RetentionTask passes the time
+            await policy.apply(NOW.replace(tzinfo=None), archive_dir)
+        after = [await table_rows(table) for table in tables]
+
+        # a crash between writing an archive file and deleting its rows archives them again with the next run
+        first_deleted = [row for rowid, row in sorted(before[0].items()) if rowid not in after[0]][:100]
+        archive.write_archive(archive_dir, tables[0], "time", [tuple(row.values()) for row in first_deleted])
+
+        failures = []
+        for table, time_column, rows_before, rows_after in zip(tables, ("time", "calculation_timestamp"),
+                                                               before, after):
+            deleted = {rowid: row for rowid, row in rows_before.items() if rowid not in rows_after}
+            failures += check_table(table.name, time_column, deleted, archive_dir)
+        await database.engine.dispose()
+    return failures
+
+
+if __name__ == "__main__":
+    failures = asyncio.run(main())
+    for failure in failures:
+        print(failure)
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,155 @@
+import argparse
+import os
+import random
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta
+
+import pytz
+
+# crash recovery check of the client's segment log: whatever a crash leaves behind, reopening the log must give
+# a gap-free prefix of the appended events, and never an event twice or one that was not appended
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT_DIR)
+
+from client import segmentlog
+
+SEGMENT_BYTES = 1000 * segmentlog.RECORD.itemsize
+START = datetime(2024, 1, 1, tzinfo=pytz.UTC)
+
+
+def make_events(first: int, count: int) -> list[dict]:
+    """Events whose value is their position in the log, so a reader can tell which ones it got."""
+    sensor_uuid = uuid.UUID(int=1).hex
+    return [{"event_uuid": uuid.uuid4().hex, "sensor_uuid": sensor_uuid, "time": START + timedelta(seconds=i),
+             "value": float(i), "unit": "degree", "transmitted": False} for i in range(first, first + count)]
+
+
+def recovered_values(directory: str) -> list[float]:
+    log = segmentlog.SegmentLog(directory, SEGMENT_BYTES)
+    return log.read(log.cursor, log.pending())["value"].tolist()
+
+
+def is_prefix(values: list[float], cursor: int, appended: int) -> bool:
+    return values == [float(i) for i in range(cursor, cursor + len(values))] and cursor + len(values) <= appended
+
+
+def last_segment(directory: str) -> str:
+    return sorted(path for path in os.listdir(directory) if path.endswith(".log"))[-1]
+
+
+def truncated_mid_record(directory: str) -> str | None:
+    log = segmentlog.SegmentLog(directory, SEGMENT_BYTES)
+    log.append(make_events(0, 1500))
+    log.close()
+    path = os.path.join(directory, last_segment(directory))
+    # the file ends in the middle of record 1200, as if the write of the file had been cut off
+    with open(path, "r+b") as f:
+        f.truncate(200 * segmentlog.RECORD.itemsize + 30)
+    values = recovered_values(directory)
+    if values != [float(i) for i in range(1200)]:
+        return f"expected events 0..1199, recovered {len(values)}"
+    log = segmentlog.SegmentLog(directory, SEGMENT_BYTES)
+    log.append(make_events(1200, 500))
+    log.close()
+    values = recovered_values(directory)
+    if values != [float(i) for i in range(1700)]:
+        return f"appending after the truncated segment lost events, recovered {len(values)}"
+    return None
+
+
+def torn_record(directory: str) -> str | None:
+    log = segmentlog.SegmentLog(directory, SEGMENT_BYTES)
+    log.append(make_events(0, 800))
+    log.close()
+    # record 500 half written, the records after it still hold a complete previous write
+    with open(os.path.join(directory, last_segment(directory)), "r+b") as f:
+        f.seek(500 * segmentlog.RECORD.itemsize + 40)
+        f.write(os.urandom(20))
+    values = recovered_values(directory)
+    if values != [float(i) for i in range(500)]:
+        return f"expected events 0..499, recovered {len(values)}"
+    log = segmentlog.SegmentLog(directory, SEGMENT_BYTES)
+    log.append(make_events(500, 1))
+    log.close()
+    # the record after the new one was cleared on recovery, it must not come back
+    values = recovered_values(directory)
+    if values != [float(i) for i in range(501)]:
+        return f"a record behind the torn one came back, recovered {len(values)}"
+    return None
+
+
+def recycled_segments(directory: str) -> str | None:
+    log = segmentlog.SegmentLog(directory, SEGMENT_BYTES)
+    appended = 0
+    for _ in range(10):
+        log.append(make_events(appended, 700))
+        appended += 700
+        log.ack(appended - 100)
+    log.close()
+    files = [path for path in os.listdir(directory) if path.endswith(".log")]
+    if len(files) > 2 + segmentlog.SPARE_SEGMENTS:
+        return f"acknowledged segments were not recycled, {len(files)} files"
+    values = recovered_values(directory)
+    # records of the files' previous uses must not count as records of their new segments
+    if values != [float(i) for i in range(appended - 100, appended)]:
+        return f"expected the 100 unacknowledged events, recovered {len(values)}"
+    return None
+
+
+def killed_writer(directory: str, seed: int) -> str | None:
+    """A writer process appending as fast as it can is killed at a random moment."""
+    writer = subprocess.Popen([sys.executable, __file__, "--write", directory, "--seed", str(seed)],
+                              stdout=subprocess.PIPE, text=True)
+    # the writer reports the end of the log after every append, and acks some of it
+    first_report = writer.stdout.readline()
+    if not first_report:
+        return "the writer did not start"
+    time.sleep(random.Random(seed).uniform(0.05, 0.5))
+    writer.send_signal(signal.SIGKILL)
+    reported = [first_report] + writer.stdout.read().splitlines()
+    writer.wait()
+    appended = int(reported[-1].split()[0])
+    log = segmentlog.SegmentLog(directory, SEGMENT_BYTES)
+    values = log.read(log.cursor, log.pending())["value"].tolist()
+    if not is_prefix(values, log.cursor, appended + 1000):
+        return f"recovered events are no gap-free run from the cursor {log.cursor}"
+    # the process died, not the machine: everything appended before the last report is in the page cache
+    if log.end < appended:
+        return f"{appended - log.end} events reported as appended were lost"
+    return None
+
+
+def write_until_killed(directory: str, seed: int):
+    rng = random.Random(seed)
+    log = segmentlog.SegmentLog(directory, SEGMENT_BYTES)
+    while True:
+        log.append(make_events(log.end, rng.randint(1, 1000)))
+        log.ack(log.end - rng.randint(0, min(log.end, 2000)))
+        print(log.end, flush=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Crash recovery check of the client's segment log.")
+    parser.add_argument("--kills", type=int, default=20, help="Writer processes killed at random moments.")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--write", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.write:
+        write_until_killed(args.write, args.seed)
+    checks = {"truncated mid record": truncated_mid_record, "torn record": torn_record,
+              "recycled segments": recycled_segments}
+    checks.update({f"killed writer {seed}": lambda directory, seed=seed: killed_writer(directory, seed)
+                   for seed in range(args.seed, args.seed + args.kills)})
+    failures = []
+    for name, check in checks.items():
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            failure = check(tmp_dir)
+        print(f"[{'FAIL' if failure else 'ok'}] {name}{': ' + failure if failure else ''}")
+        if failure:
+            failures.append(name)
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,25 @@
+import importlib
+
+# Lazy access to the generated OpenAPI client (client/generated): a module is imported on its first use, so the
+# startup does not import the endpoint and model modules before the first request needs them.
+GENERATED_PACKAGE = "client.generated.fast_api_client"
+ENDPOINTS = {
+    "createSensor": "api.default.create_sensor_create_sensor_post",
+    "createSensors": "api.default.create_sensors_create_sensors_post",
+    "postSensorData": "api.default.post_sensor_data_sensordata_post",
+    "postReceivedAverages": "api.default.post_received_averages_received_averages_post",
+}
+
+
+def __getattr__(name: str):
+    if name == "Client":
+        value = importlib.import_module(f"{GENERATED_PACKAGE}.client").Client
+    elif name in ENDPOINTS:
+        value = importlib.import_module(f"{GENERATED_PACKAGE}.{ENDPOINTS[name]}")
+    else:
+        models = importlib.import_module(f"{GENERATED_PACKAGE}.models")
+        if not hasattr(models, name):
+            raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+        value = getattr(models, name)
+    globals()[name] = value
+    return value
@@ -0,0 +1,91 @@
+import argparse
+import csv
+import glob
+import os
+import sys
+from datetime import datetime
+
+import numpy as np
+import pytz
+
+# archive files of the rows deleted by the retention policies, one compressed file of columns per chunk of rows
+
+
+def column_array(values: list) -> np.ndarray:
+    sample = next((value for value in values if value is not None), None)
+    if isinstance(sample, datetime):
+        return np.array(values, dtype="datetime64[us]")
+    if isinstance(sample, bool):
+        return np.array(values, dtype=bool)
+    if isinstance(sample, int) and None not in values:
+        return np.array(values, dtype=np.int64)
+    if isinstance(sample, (int, float)):
+        return np.array(values, dtype=np.float64)
+    return np.array(["" if value is None else str(value) for value in values], dtype=str)
+
+
+def naive_utc(time: datetime) -> np.datetime64:
+    # the archived times are naive UTC like the database's
+    if time.tzinfo is not None:
+        time = time.astimezone(pytz.UTC).replace(tzinfo=None)
+    return np.datetime64(time, "us")
+
+
+def write_archive(directory: str, table, time_column: str, rows: list):
+    """Write rows (rowid first, then the table's columns) as one compressed file of columns."""
+    os.makedirs(directory, exist_ok=True)
+    names = ["rowid"] + [column.name for column in table.columns]
+    columns = {name: column_array([row[i] for row in rows]) for i, name in enumerate(names)}
+    path = os.path.join(directory, f"{table.name}-{rows[0][0]:012d}-{rows[-1][0]:012d}.npz")
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez_compressed(f, _time_column=np.array(time_column), **columns)
+        f.flush()
+        os.fsync(f.fileno())
+    # a crash leaves no half written archive behind
+    os.replace(tmp_path, path)
+
+
+def read_archive(directory: str, table_name: str, start: datetime = None, end: datetime = None,
+                 sensor_uuids: list[str] = None) -> dict[str, np.ndarray]:
+    """Archived rows of a table as columns in rowid order, optionally only those of some sensors in [start, end)."""
+    parts = []
+    for path in sorted(glob.glob(os.path.join(directory, f"{table_name}-*.npz"))):
+        with np.load(path) as archive:
+            times = archive[str(archive["_time_column"])]
+            mask = np.ones(len(times), dtype=bool)
+            if start is not None:
+                mask &= times >= naive_utc(start)
+            if end is not None:
+                mask &= times < naive_utc(end)
+            if sensor_uuids is not None:
+                mask &= np.isin(archive["sensor_uuid"], sensor_uuids)
+            if mask.any():
+                parts.append({name: archive[name][mask] for name in archive.files if not name.startswith("_")})
+    if not parts:
+        return {}
+    columns = {name: np.concatenate([part[name] for part in parts]) for name in parts[0]}
+    # rows archived again after a crash before their deletion are in two files
+    _, first = np.unique(columns["rowid"], return_index=True)
+    return {name: values[first] for name, values in columns.items()}
+
+
+def export_csv(columns: dict[str, np.ndarray], file):
+    """Write the columns of read_archive() as csv, a header and one line per archived row."""
+    if not columns:
+        return
+    writer = csv.writer(file)
+    writer.writerow(columns)
+    writer.writerows(zip(*(values.tolist() for values in columns.values())))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the rows archived by the retention policies as csv.")
+    parser.add_argument("directory", help="The --archive-dir of the client.")
+    parser.add_argument("table", choices=["events", "averages"])
+    parser.add_argument("--start", type=datetime.fromisoformat, help="Oldest time to export, UTC without an offset.")
+    parser.add_argument("--end", type=datetime.fromisoformat, help="Export the rows before this time.")
+    parser.add_argument("--sensor-uuid", action="append", dest="sensor_uuids",
+                        help="Export only the rows of this sensor, may be given several times.")
+    args = parser.parse_args()
+    export_csv(read_archive(args.directory, args.table, args.start, args.end, args.sensor_uuids), sys.stdout)
@@ -2,127 +2,295 @@ import argparse
 import math
 import random
 import asyncio
+import socket
+import time
 import uuid
 from datetime import datetime
 
 import pytz
-from matplotlib import pyplot as plt
-from matplotlib.dates import DateFormatter
-from sqlalchemy import insert, select, update
-
-# Fix for matplotlib not updating
-import matplotlib
-
-matplotlib.use("Qt5Agg")
+from sqlalchemy import func, insert, select, update
 
 import sys
 import os
 # Ensure the parent directory is in the path --> fix import issues
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from client.generated.fast_api_client.client import Client
-from client.generated.fast_api_client.api.default import (
-    create_sensor_create_sensor_post as createSensor,
-    post_sensor_data_sensordata_post as postSensorData,
-    post_received_averages_received_averages_post as postReceivedAverages
-)
-from client.generated.fast_api_client.models import SensorRegisterRemote, SensorRemote, SensorEventDataRequest, \
-    EventRemote, AverageReceivedAck
-from client.db import database, models
+from client.db import database, migrations, models
+# the generated client (api), the fleet, the segment log and the plots are imported when a run mode needs them,
+# a headless client never imports the plotting stack
+from client import api, metrics, retention, scheduler, streaming, wireformat, writebehind
 
-# Argument parsing
-parser = argparse.ArgumentParser(description="Client for connecting to the cloud server.")
-parser.add_argument("--server-ip", type=str, required=True, help="The IP address of the cloud server.")
-parser.add_argument("--server-port", type=int, required=False, help="The IP address of the cloud server.", default=8000)
-args = parser.parse_args()
+# set by setup()
+args = None
+client = None
+wire_format = "columnar"
+compression = wireformat.COMPRESSIONS[0]
+sync_page_size = 1000
+event_log = None
+event_buffer = None
+stream_uploader = None
 
-client = Client(f"http://{args.server_ip}:{args.server_port}")
+
+# Argument parsing
+def parse_args(argv: list[str] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Client for connecting to the cloud server.")
+    parser.add_argument("--server-ip", type=str, required=True, help="The IP address of the cloud server.")
+    parser.add_argument("--server-port", type=int, required=False, help="The IP address of the cloud server.",
+                        default=8000)
+    parser.add_argument("--wire-format", choices=["columnar", "json"], default="columnar",
+                        help="Encoding of uploaded sensor data, falls back to json if the server does not support "
+                             "columnar.")
+    parser.add_argument("--compression", choices=wireformat.COMPRESSIONS, default=wireformat.COMPRESSIONS[0],
+                        help="Compression of columnar uploads, steps down to the next one if the server does not "
+                             "support it.")
+    parser.add_argument("--write-batch-size", type=int, default=500,
+                        help="Generated events written to the local db in one transaction.")
+    parser.add_argument("--write-delay", type=float, default=1.0,
+                        help="Seconds generated events may wait in memory before they are written to the local db.")
+    parser.add_argument("--write-capacity", type=int, default=10_000,
+                        help="Generated events buffered in memory before the generators wait for the db.")
+    parser.add_argument("--event-store", choices=["sqlite", "segmentlog"], default="sqlite",
+                        help="Keep unsent events in the events table of the local db, or in append-only memory mapped "
+                             "segment files that are reused once the server acknowledged them.")
+    parser.add_argument("--segment-dir", type=str, default=os.path.join(database.BASE_DIR, "segments"),
+                        help="Directory of the segment files and their cursor.")
+    parser.add_argument("--segment-size", type=int, default=16, help="Size of a segment file in MiB.")
+    parser.add_argument("--headless", action="store_true",
+                        help="Run without plots and without importing the plotting stack, for fog nodes without a "
+                             "display.")
+    parser.add_argument("--plot-window", type=float, default=900,
+                        help="Seconds of history shown in the plots.")
+    parser.add_argument("--sync-mode", choices=["stream", "batch"], default="stream",
+                        help="Upload events over a persistent websocket as they are written, or only in periodic "
+                             "batches. The periodic batch sync always takes over while the stream is down.")
+    parser.add_argument("--sync-interval", type=float, default=15,
+                        help="Seconds between batch syncs, shorter while a backlog is drained.")
+    parser.add_argument("--sync-max-interval", type=float, default=60,
+                        help="The batch sync interval grows up to this many seconds while there is nothing to send.")
+    parser.add_argument("--sync-max-backoff", type=float, default=300,
+                        help="Upper bound in seconds of the randomized exponential backoff after failed syncs.")
+    parser.add_argument("--sync-page-size", type=int, default=1000,
+                        help="Maximum events per batch sync request, oldest first. Halved while the server rejects "
+                             "the requests as too large.")
+    parser.add_argument("--client-id", type=str, default=socket.gethostname(),
+                        help="Name of this client for the server's per client upload limits.")
+    parser.add_argument("--event-retention-days", type=float, default=7,
+                        help="Transmitted events older than this many days are deleted from the local db, "
+                             "0 keeps them.")
+    parser.add_argument("--average-retention-days", type=float, default=30,
+                        help="Averages older than this many days are deleted from the local db, 0 keeps them.")
+    parser.add_argument("--retention-interval", type=float, default=3600,
+                        help="Seconds between applying the retention policies.")
+    parser.add_argument("--archive-dir", type=str, default=None,
+                        help="Write expired rows to compressed column files in this directory before deleting them.")
+    parser.add_argument("--fleet-size", type=int, default=0,
+                        help="Simulate this many sensors, advanced together once per tick. 0 runs the two classic "
+                             "sensors.")
+    parser.add_argument("--fleet-types", type=str, default="temperature,humidity",
+                        help="Comma separated sensor types the fleet cycles through, of the types in fleet.py.")
+    parser.add_argument("--fleet-tick", type=float, default=2.0,
+                        help="Seconds between two readings of every fleet sensor.")
+    parser.add_argument("--metrics-file", type=str, default=None,
+                        help="Write sync metrics in prometheus text format to this file after every sync cycle.")
+    return parser.parse_args(argv)
+
+
+def setup(arguments: argparse.Namespace):
+    """Create the server client and the local event storage, without connecting to anything."""
+    global args, client, wire_format, compression, sync_page_size, event_log, event_buffer
+    args = arguments
+    client = api.Client(f"http://{args.server_ip}:{args.server_port}",
+                        headers={scheduler.CLIENT_HEADER: args.client_id})
+    wire_format = args.wire_format
+    compression = args.compression
+    sync_page_size = args.sync_page_size
+    if args.event_store == "segmentlog":
+        from client import segmentlog
+        # like the durable db profile, every append is flushed to storage
+        event_log = segmentlog.SegmentLog(args.segment_dir, args.segment_size * 1024 * 1024,
+                                          sync=database.ENGINE_PROFILE == "durable")
+    event_buffer = writebehind.EventWriteBuffer(args.write_batch_size, args.write_delay, args.write_capacity,
+                                                event_log)
+    metrics.buffer_pending.function = lambda: len(event_buffer.pending)
 
 
 # Data generation functions
 async def generate_sensor_data(sensor: models.Sensor, value_generator: callable, unit: str):
     while True:
-        async with database.SessionLocal() as session:
-            async with session.begin():
-                session.add(models.Event(
-                    sensor_uuid=sensor.sensor_uuid,
-                    event_uuid=uuid.uuid4().hex,
-                    value=value_generator(),
-                    time=datetime.now(pytz.UTC),
-                    unit=unit,
-                    transmitted=False
-                ))
+        await event_buffer.append({
+            "sensor_uuid": sensor.sensor_uuid,
+            "event_uuid": uuid.uuid4().hex,
+            "value": value_generator(),
+            "time": datetime.now(pytz.UTC),
+            "unit": unit,
+            "transmitted": False
+        })
         await asyncio.sleep(random.uniform(1, 3))
 
 
-async def periodical_cloud_sync(period_in_secs: int):
+async def post_events(events: list[models.Event] | None, acked_sequences: dict[str, int],
+                      records=None) -> "api.AveragesResponse":
+    """Upload events, or the segment log records instead if given."""
+    global wire_format, compression
+    if wire_format == "columnar":
+        if records is None:
+            columnar = wireformat.encode(events, acked_sequences)
+        else:
+            columnar = event_log.encode(records, acked_sequences)
+    while wire_format == "columnar":
+        body, headers = wireformat.compress(columnar, compression)
+        response = await client.get_async_httpx_client().post("/sensordata", content=body, headers=headers)
+        if response.status_code == 415 and compression != "none":
+            # server lacks the compression (zstandard is optional), negotiate down to the next one
+            fallback = wireformat.COMPRESSIONS[wireformat.COMPRESSIONS.index(compression) + 1]
+            print(f"Server does not accept {compression} compressed sensor data, falling back to {fallback}")
+            compression = fallback
+        elif response.status_code in (415, 422):
+            # server predates the columnar format, negotiate down to json
+            print("Server does not accept columnar sensor data, falling back to json")
+            wire_format = "json"
+        else:
+            if response.status_code in scheduler.REJECTED_STATUS_CODES:
+                raise scheduler.UploadRejected(response.status_code, scheduler.retry_after(response.headers))
+            response.raise_for_status()
+            return api.AveragesResponse.from_dict(response.json())
+    if records is not None:
+        events = event_log.to_events(records)
+    response = await api.postSensorData.asyncio_detailed(
+        client=client,
+        body=api.SensorEventDataRequest(
+            events=[api.EventRemote(
+                event_uuid=event.event_uuid,
+                value=event.value,
+                unit=event.unit,
+                sensor_uuid=event.sensor_uuid,
+                timestamp=event.time.isoformat()
+            ) for event in events],
+            acked_sequences=api.SensorEventDataRequestAckedSequences.from_dict(acked_sequences)
+        )
+    )
+    if response.status_code in scheduler.REJECTED_STATUS_CODES:
+        raise scheduler.UploadRejected(response.status_code, scheduler.retry_after(response.headers))
+    if response.status_code != 200:
+        raise RuntimeError(f"Upload failed with status {response.status_code}")
+    return response.parsed
+
+
+async def sync_page() -> int:
+    """Upload the oldest page of untransmitted events after the sync cursor, returns the number of events sent."""
+    async with database.SessionLocal() as session:
+        async with session.begin():
+            cursor = await scheduler.load_cursor(session)
+            page = await scheduler.read_page(session, cursor, sync_page_size)
+            acked_sequences = await streaming.acked_sequences(session)
+            metrics.sync_backlog.set(await session.scalar(
+                select(func.count()).select_from(models.Event).where(models.Event.transmitted == False)
+            ))
+        print(f"Sending {len(page)} untransmitted events to cloud server, event write buffer:", event_buffer.stats())
+        sensor_data_response = await post_events([event for _, event in page], acked_sequences)
+        metrics.events_uploaded.inc(len(sensor_data_response.received_event_uuids))
+        metrics.averages_received.inc(len(sensor_data_response.averages))
+        # mark sensor_data_response.received_event_uuids in db as transmitted and move the cursor past them
+        async with session.begin():
+            await session.execute(
+                update(models.Event)
+                .where(models.Event.event_uuid.in_(sensor_data_response.received_event_uuids))
+                .values(transmitted=True)
+            )
+            await scheduler.save_cursor(session,
+                                        scheduler.acked_rowid(cursor, page, sensor_data_response.received_event_uuids))
+
+        await store_averages(session, sensor_data_response)
+    return len(page)
+
+
+async def sync_log_page() -> int:
+    """Upload the oldest unacknowledged records of the segment log, returns the number of events sent."""
+    records = event_log.read(event_log.cursor, sync_page_size)
+    async with database.SessionLocal() as session:
+        async with session.begin():
+            acked_sequences = await streaming.acked_sequences(session)
+        metrics.sync_backlog.set(event_log.pending())
+        print(f"Sending {len(records)} events of the segment log to cloud server, event write buffer:",
+              event_buffer.stats())
+        sensor_data_response = await post_events(None, acked_sequences, records)
+        metrics.events_uploaded.inc(len(sensor_data_response.received_event_uuids))
+        metrics.averages_received.inc(len(sensor_data_response.averages))
+        if len(records):
+            event_log.ack(event_log.acked_offset(records, sensor_data_response.received_event_uuids))
+        await store_averages(session, sensor_data_response)
+    return len(records)
+
+
+async def store_averages(session, sensor_data_response: "api.AveragesResponse"):
+    # save sensor_data_response.averages to db
+    if sensor_data_response.averages:
+        async with session.begin():
+            # ignore on conflict in case of retransmitted averages because of lost acks
+            await session.execute(insert(models.Averages).prefix_with("OR IGNORE"), [{
+                "average_uuid": avg.average_uuid,
+                "average": avg.average,
+                "calculation_timestamp": datetime.fromisoformat(avg.average_timestamp),
+                "sensor_uuid": avg.sensor_uuid,
+                "sequence": avg.sequence if isinstance(avg.sequence, int) else None
+            } for avg in sensor_data_response.averages])
+    # averages with a sequence are acknowledged with the next upload,
+    # servers that don't send sequences still need the separate ack request
+    received_uuids = [x.average_uuid for x in sensor_data_response.averages
+                      if not isinstance(x.sequence, int)]
+    if received_uuids:
+        await api.postReceivedAverages.asyncio(
+            client=client,
+            body=api.AverageReceivedAck(
+                received=received_uuids
+            )
+        )
+
+
+async def periodical_cloud_sync(sync_scheduler: scheduler.SyncScheduler):
+    global sync_page_size
+    delay = sync_scheduler.interval
     while True:
+        await asyncio.sleep(delay)
+        if stream_uploader is not None and stream_uploader.connected:
+            delay = sync_scheduler.interval
+            continue
+        start = time.perf_counter()
         try:
-            await asyncio.sleep(period_in_secs)
-            print("Sending untransmitted sensor data to cloud server")
-            async with database.SessionLocal() as session:
-                async with session.begin():
-                    event_query_result = await session.execute(
-                        select(models.Event)
-                        .where(models.Event.transmitted == False)
-                    )
-                events = event_query_result.scalars().all()
-                events = [EventRemote(
-                    event_uuid=event.event_uuid,
-                    value=event.value,
-                    unit=event.unit,
-                    sensor_uuid=event.sensor_uuid,
-                    timestamp=event.time.isoformat()
-                ) for event in events]
-                sensor_data_response = await postSensorData.asyncio(
-                    client=client,
-                    body=SensorEventDataRequest(
-                        events=events
-                    )
-                )
-                # mark sensor_data_response.received_event_uuids in db as transmitted
-                async with session.begin():
-                    await session.execute(
-                        update(models.Event)
-                        .where(models.Event.event_uuid.in_(sensor_data_response.received_event_uuids))
-                        .values(transmitted=True)
-                    )
-
-                # save sensor_data_response.averages to db
-                for avg in sensor_data_response.averages:
-                    async with session.begin():
-                        # ignore on conflict in case of retransmitted averages because of lost acks
-                        stmt = insert(models.Averages).values(
-                            average_uuid=avg.average_uuid,
-                            average=avg.average,
-                            calculation_timestamp=datetime.fromisoformat(avg.average_timestamp),
-                            sensor_uuid=avg.sensor_uuid
-                        ).prefix_with("OR IGNORE")
-                        await session.execute(stmt)
-                received_uuids = [x.average_uuid for x in sensor_data_response.averages]
-                await postReceivedAverages.asyncio(
-                    client=client,
-                    body=AverageReceivedAck(
-                        received=received_uuids
-                    )
-                )
+            sent = await sync_page() if event_log is None else await sync_log_page()
+            delay = sync_scheduler.succeeded(sent, sync_page_size)
+            metrics.sync_duration.observe(time.perf_counter() - start, ("ok",))
+        except scheduler.UploadRejected as e:
+            if e.status_code == 413 and sync_page_size > 1:
+                sync_page_size //= 2
+                delay = sync_scheduler.backlog_interval
+            else:
+                delay = sync_scheduler.rejected(e.status_code, e.retry_after)
+            metrics.sync_duration.observe(time.perf_counter() - start, ("rejected",))
+            metrics.sync_failures.inc(labels=(f"http_{e.status_code}",))
+            print(f"Server rejected the upload, retrying in {delay:.1f}s with pages of {sync_page_size}:", str(e))
         except Exception as e:
-            print("Failed to communicate with server:", str(e))
+            delay = sync_scheduler.failed()
+            metrics.sync_duration.observe(time.perf_counter() - start, ("failed",))
+            metrics.sync_failures.inc(labels=(type(e).__name__,))
+            print(f"Failed to communicate with server, retrying in {delay:.1f}s:", str(e))
+        if args.metrics_file:
+            metrics.write_file(args.metrics_file)
 
 
 # Sensor registration functions
-async def register_sensor_on_server(sensor_type: str, sensor_name: str) -> SensorRemote:
+async def register_sensor_on_server(sensor_type: str, sensor_name: str) -> "api.SensorRemote":
     print("Registering sensor on server:", sensor_name)
-    return await createSensor.asyncio(
+    return await api.createSensor.asyncio(
         client=client,
-        body=SensorRegisterRemote(
+        body=api.SensorRegisterRemote(
             type=sensor_type,
             name=sensor_name
         )
     )
 
 
-async def store_sensor_to_db(sensor: SensorRemote):
+async def store_sensor_to_db(sensor: "api.SensorRemote"):
     print("Storing new sensor to db:", sensor.name)
     async with database.SessionLocal() as session:
         async with session.begin():
@@ -133,7 +301,7 @@ async def store_sensor_to_db(sensor: SensorRemote):
             ))
 
 
-def convert_sensor_remote_to_sensor(sensor_remote: SensorRemote) -> models.Sensor:
+def convert_sensor_remote_to_sensor(sensor_remote: "api.SensorRemote") -> models.Sensor:
     return models.Sensor(
         sensor_uuid=sensor_remote.uuid,
         sensor_type=sensor_remote.type,
@@ -157,86 +325,27 @@ async def get_sensor(sensor_type: str, sensor_name: str) -> models.Sensor:
 
 
 # Plot functions
-async def plots(tempSensor, humSensor):
-    plt.ion()
-    fig, ax1, ax2, temp_transmitted_line, temp_non_transmitted_line, temp_avg_line, hum_transmitted_line, hum_non_transmitted_line, hum_avg_line = initialize_plots()
-    while True:
-        async with database.SessionLocal() as session:
-            temp_events = await session.execute(
-                select(models.Event).where(models.Event.sensor_uuid == tempSensor.sensor_uuid))
-            temp_averages = await session.execute(
-                select(models.Averages).where(models.Averages.sensor_uuid == tempSensor.sensor_uuid))
-            temp_events = temp_events.scalars().all()
-            temp_averages = temp_averages.scalars().all()
-
-            hum_events = await session.execute(
-                select(models.Event).where(models.Event.sensor_uuid == humSensor.sensor_uuid))
-            hum_averages = await session.execute(
-                select(models.Averages).where(models.Averages.sensor_uuid == humSensor.sensor_uuid))
-            hum_events = hum_events.scalars().all()
-            hum_averages = hum_averages.scalars().all()
-
-        update_plot(ax1, temp_transmitted_line, temp_non_transmitted_line, temp_avg_line, temp_events, temp_averages)
-        update_plot(ax2, hum_transmitted_line, hum_non_transmitted_line, hum_avg_line, hum_events, hum_averages)
-        plt.pause(0.01)
-        await asyncio.sleep(5)
-
-
-def initialize_plots():
-    fig, (ax1, ax2) = plt.subplots(2, 1, figsize=(12, 12))
-    fig.suptitle('Client', fontsize=16)
-    # Temperature plot
-    ax1.set_title('Temperature Sensor Data')
-    ax1.set_xlabel('Time')
-    ax1.set_ylabel('Value')
-    ax1.grid(True)
-    ax1.xaxis.set_major_formatter(DateFormatter('%H:%M:%S'))
-
-    temp_transmitted_line, = ax1.plot([], [], label='Transmitted Events', marker='o')
-    temp_non_transmitted_line, = ax1.plot([], [], label='Non-Transmitted Events', linestyle='dotted', marker='o')
-    temp_avg_line, = ax1.plot([], [], label='Averages', marker='x')
-    ax1.legend()
-
-    # Humidity plot
-    ax2.set_title('Humidity Sensor Data')
-    ax2.set_xlabel('Time')
-    ax2.set_ylabel('Value')
-    ax2.grid(True)
-    ax2.xaxis.set_major_formatter(DateFormatter('%H:%M:%S'))
-
-    hum_transmitted_line, = ax2.plot([], [], label='Transmitted Events', marker='o')
-    hum_non_transmitted_line, = ax2.plot([], [], label='Non-Transmitted Events', linestyle='dotted', marker='o')
-    hum_avg_line, = ax2.plot([], [], label='Averages', marker='x')
-    ax2.legend()
-
-    plt.tight_layout()
-    return fig, ax1, ax2, temp_transmitted_line, temp_non_transmitted_line, temp_avg_line, hum_transmitted_line, hum_non_transmitted_line, hum_avg_line
-
-
-def update_plot(ax, transmitted_line, non_transmitted_line, avg_line, events: list[models.Event],
-                averages: list[models.Averages]):
-    avg_times = [avg.calculation_timestamp for avg in averages]
-    avg_values = [avg.average for avg in averages]
-
-    transmitted_times = [event.time for event in events if event.transmitted]
-    transmitted_values = [event.value for event in events if event.transmitted]
-    non_transmitted_times = [event.time for event in events if not event.transmitted]
-    non_transmitted_values = [event.value for event in events if not event.transmitted]
-
-    transmitted_line.set_data(transmitted_times, transmitted_values)
-    non_transmitted_line.set_data(non_transmitted_times, non_transmitted_values)
-    avg_line.set_data(avg_times, avg_values)
-
-    ax.relim()
-    ax.autoscale_view()
-    ax.figure.canvas.draw()
-    ax.figure.canvas.flush_events()
+async def plots(sensors: list[tuple[str, str]]):
+    """Plot the (sensor uuid, title) pairs."""
+    # matplotlib and Qt are only imported when plotting, never in headless mode
+    from client import plotting
+    plot_process = plotting.PlotProcess(sensors, args.plot_window)
+    feed = plotting.PlotFeed([sensor_uuid for sensor_uuid, _ in sensors], args.plot_window)
+    plot_process.start()
+    try:
+        # rendering happens in the plot process, this loop only forwards the new rows
+        while plot_process.is_alive():
+            async with database.SessionLocal() as session:
+                plot_process.send(await feed.poll(session))
+            await asyncio.sleep(2)
+    finally:
+        plot_process.stop()
 
 
 # Table creation function
 async def create_tables():
     async with database.engine.begin() as conn:
-        await conn.run_sync(models.Base.metadata.create_all)
+        await conn.run_sync(migrations.upgrade_schema, models.Base.metadata)
 
 
 # AI generated sensor value simulation code
@@ -279,21 +388,70 @@ def generate_humidity(variation=0.1, noise_level=1.0, min_humidity=5.0, max_humi
 
 # Main functions
 async def run():
+    global stream_uploader
     await create_tables()
+    if args.fleet_size:
+        from client import fleet
     try:
-        temp_sensor = await get_sensor("temperature", "temp_sensor")
-        hum_sensor = await get_sensor("humidity", "hum_sensor")
+        if args.fleet_size:
+            sensors = await fleet.get_fleet_sensors(client, args.fleet_types.split(","), args.fleet_size)
+        else:
+            temp_sensor = await get_sensor("temperature", "temp_sensor")
+            hum_sensor = await get_sensor("humidity", "hum_sensor")
+            sensors = [temp_sensor, hum_sensor]
     except Exception as e:
         print("Failed to register sensors, server must be available for initial setup", str(e))
         return
 
-    await asyncio.gather(
-        generate_sensor_data(temp_sensor, generate_temperature, "degree"),
-        generate_sensor_data(hum_sensor, generate_humidity, "percent"),
-        periodical_cloud_sync(15),
-        plots(temp_sensor, hum_sensor)
-    )
+    if args.fleet_size:
+        # one plot per sensor type, of its first sensor
+        plotted = {}
+        for sensor in sensors:
+            plotted.setdefault(sensor.sensor_type, (sensor.sensor_uuid, f"{sensor.sensor_name} Sensor Data"))
+        tasks = [fleet.SensorFleet(sensors).run(event_buffer, args.fleet_tick)]
+        plotted = list(plotted.values())
+    else:
+        tasks = [
+            generate_sensor_data(temp_sensor, generate_temperature, "degree"),
+            generate_sensor_data(hum_sensor, generate_humidity, "percent")
+        ]
+        plotted = [(temp_sensor.sensor_uuid, 'Temperature Sensor Data'),
+                   (hum_sensor.sensor_uuid, 'Humidity Sensor Data')]
+    if not args.headless:
+        tasks.append(plots(plotted))
+    tasks.append(periodical_cloud_sync(scheduler.SyncScheduler(args.sync_interval, max_interval=args.sync_max_interval,
+                                                               max_backoff=args.sync_max_backoff)))
+    policies = retention.default_policies(args.event_retention_days, args.average_retention_days)
+    if policies:
+        tasks.append(retention.RetentionTask(policies, args.retention_interval, args.archive_dir).run())
+    if args.sync_mode == "stream":
+        if event_log is not None:
+            print("Streaming upload reads the events table, using the batch sync with the segment log")
+        elif streaming.StreamUploader.available():
+            stream_uploader = streaming.StreamUploader(
+                f"ws://{args.server_ip}:{args.server_port}/ws/ingest",
+                [sensor.sensor_uuid for sensor in sensors]
+            )
+            event_buffer.flush_listeners.append(stream_uploader.notify)
+            tasks.append(stream_uploader.run())
+        else:
+            print("Streaming upload requires the websockets package, using the batch sync")
+
+    event_writer = asyncio.create_task(event_buffer.run())
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        # don't lose the buffered events on shutdown, the writer finishes its flush instead of being cancelled
+        await event_buffer.close()
+        await event_writer
+        if event_log is not None:
+            event_log.close()
 
 
-if __name__ == "__main__":
+def main(argv: list[str] | None = None):
+    setup(parse_args(argv))
     asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main()
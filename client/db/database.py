@@ -1,4 +1,5 @@
 import os
+from sqlalchemy import event
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
@@ -6,7 +7,54 @@ from sqlalchemy.orm import sessionmaker
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DATABASE_URL = f"sqlite+aiosqlite:///{os.path.join(BASE_DIR, 'client.db')}"
 
-engine = create_async_engine(DATABASE_URL, connect_args={"check_same_thread": False, 'timeout': 15})
+# sqlite pragmas applied to every new connection, the profile is selected with CLIENT_DB_PROFILE.
+# auto_vacuum only takes effect in new files, it lets retention.py return deleted pages to the file system
+ENGINE_PROFILES = {
+    # write ahead log: readers don't block the writer, fsync only on checkpoints
+    "tuned": {
+        "auto_vacuum": "INCREMENTAL",
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "cache_size": -65536,  # negative values are KiB
+        "mmap_size": 268435456,
+        "busy_timeout": 15000,
+    },
+    # same as tuned but every commit is fsynced, survives power loss without losing the last transactions
+    "durable": {
+        "auto_vacuum": "INCREMENTAL",
+        "journal_mode": "WAL",
+        "synchronous": "FULL",
+        "cache_size": -65536,
+        "mmap_size": 268435456,
+        "busy_timeout": 15000,
+    },
+    # sqlite defaults with rollback journal
+    "default": {
+        "auto_vacuum": "INCREMENTAL",
+        "journal_mode": "DELETE",
+        "busy_timeout": 15000,
+    },
+}
+ENGINE_PROFILE = os.environ.get("CLIENT_DB_PROFILE", "tuned")
+# storage of the uuid and timestamp columns, "text" or "compact" (blobs and integers, see db/types.py).
+# A database file keeps the schema it was created with, db/migrations.py converts a text database.
+SCHEMA = os.environ.get("CLIENT_DB_SCHEMA", "text")
+
+
+def create_engine(url: str, profile: dict):
+    new_engine = create_async_engine(url, connect_args={"check_same_thread": False, 'timeout': 15})
+
+    @event.listens_for(new_engine.sync_engine, "connect")
+    def apply_profile(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma, value in profile.items():
+            cursor.execute(f"PRAGMA {pragma}={value}")
+        cursor.close()
+
+    return new_engine
+
+
+engine = create_engine(DATABASE_URL, ENGINE_PROFILES[ENGINE_PROFILE])
 SessionLocal = sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
 
 Base = declarative_base()
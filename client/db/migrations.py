@@ -0,0 +1,125 @@
+import argparse
+import os
+
+from sqlalchemy import Column, Integer, MetaData, Table, create_engine, func, insert, inspect, literal_column, \
+    select, text, update
+
+# column types that differ between the text and the compact schema
+SCHEMA_TYPES = {"VARCHAR", "DATETIME", "BLOB", "BIGINT"}
+# rows copied per transaction by convert(), the source database stays writable in between
+COPY_BATCH_SIZE = 10000
+# tables that only get new rows (and flipped transmitted flags), convert() copies the rest completely on every run
+APPEND_TABLES = ("events", "averages")
+ROWID = literal_column("rowid")
+
+
+def upgrade_schema(connection, metadata):
+    """Create missing tables, columns and indexes, so database files of older versions keep working.
+
+    Indexes named ix_* that the models no longer define are dropped, they only slow down the writes.
+    """
+    metadata.create_all(connection)
+    inspector = inspect(connection)
+    for table in metadata.sorted_tables:
+        existing_columns = {column["name"]: column["type"].compile(dialect=connection.dialect)
+                            for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            column_type = column.type.compile(dialect=connection.dialect)
+            if column.name not in existing_columns:
+                connection.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+            elif {column_type, existing_columns[column.name]} <= SCHEMA_TYPES \
+                    and column_type != existing_columns[column.name]:
+                raise RuntimeError(f"{table.name}.{column.name} is {existing_columns[column.name]} in the database "
+                                   f"but {column_type} in the models, the file has the other storage schema")
+        # create_all skips the indexes of tables that already exist
+        for index in table.indexes:
+            index.create(connection, checkfirst=True)
+        defined_indexes = {index.name for index in table.indexes}
+        for index in inspector.get_indexes(table.name):
+            if index["name"].startswith("ix_") and index["name"] not in defined_indexes:
+                connection.execute(text(f"DROP INDEX {index['name']}"))
+
+
+def copy_rows(source, destination, source_table: Table, table: Table, after: int, batch_size: int) -> int:
+    """Copy the rows after a rowid in batches, keeping their rowids. Returns the number of rows copied."""
+    columns = [column for column in table.columns if column.name in source_table.c]
+    # the rowid is not a column of the models, but cursors and watermarks refer to it
+    target = Table(table.name, MetaData(), Column("rowid", Integer),
+                   *[Column(column.name, column.type) for column in columns])
+    copied = 0
+    while True:
+        with source.begin() as connection:
+            rows = connection.execute(
+                select(ROWID, *[source_table.c[column.name] for column in columns])
+                .where(ROWID > after).order_by(ROWID).limit(batch_size)
+            ).all()
+        if not rows:
+            return copied
+        with destination.begin() as connection:
+            connection.execute(insert(target), [dict(zip(target.c.keys(), row)) for row in rows])
+        after = rows[-1][0]
+        copied += len(rows)
+
+
+def copy_transmitted(source, destination, source_table: Table, table: Table, batch_size: int) -> int:
+    """Take over the transmitted flags set in the source after the rows were copied, they never go back."""
+    with destination.begin() as connection:
+        pending = connection.execute(select(ROWID).where(table.c.transmitted == False)).scalars().all()
+    updated = 0
+    for start in range(0, len(pending), batch_size):
+        with source.begin() as connection:
+            transmitted = connection.execute(
+                select(ROWID).where(ROWID.in_(pending[start:start + batch_size]), source_table.c.transmitted == True)
+            ).scalars().all()
+        if transmitted:
+            with destination.begin() as connection:
+                connection.execute(update(table).where(ROWID.in_(transmitted)).values(transmitted=True))
+            updated += len(transmitted)
+    return updated
+
+
+def convert(source_path: str, destination_path: str, metadata, batch_size: int = COPY_BATCH_SIZE):
+    """Copy a database file into a file with the schema of `metadata`, e.g. a text database into a compact one.
+
+    The source may be in use meanwhile, it is read in short transactions. Run it again after stopping the program
+    using the source: the append-only tables continue after the rows copied before, the transmitted flags set in
+    between are taken over, and the other (small) tables are copied again completely.
+    """
+    source = create_engine(f"sqlite:///{source_path}", connect_args={"timeout": 15})
+    destination = create_engine(f"sqlite:///{destination_path}")
+    with destination.begin() as connection:
+        upgrade_schema(connection, metadata)
+    source_metadata = MetaData()
+    source_metadata.reflect(source)
+    for table in metadata.sorted_tables:
+        source_table = source_metadata.tables.get(table.name)
+        if source_table is None:
+            continue
+        if table.name in APPEND_TABLES:
+            with destination.begin() as connection:
+                after = connection.scalar(select(func.coalesce(func.max(ROWID), 0)).select_from(table))
+            copied = copy_rows(source, destination, source_table, table, after, batch_size)
+            if "transmitted" in table.c:
+                updated = copy_transmitted(source, destination, source_table, table, batch_size)
+                print(f"{table.name}: {copied} rows copied, {updated} transmitted flags updated")
+                continue
+        else:
+            with destination.begin() as connection:
+                connection.execute(table.delete())
+            copied = copy_rows(source, destination, source_table, table, 0, batch_size)
+        print(f"{table.name}: {copied} rows copied")
+    source.dispose()
+    destination.dispose()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Copy a database file into a new file with the compact schema.")
+    parser.add_argument("source", help="Database file with the text schema.")
+    parser.add_argument("destination", help="Database file to create or continue, start with it and "
+                                            "CLIENT_DB_SCHEMA=compact.")
+    parser.add_argument("--batch-size", type=int, default=COPY_BATCH_SIZE, help="Rows copied per transaction.")
+    args = parser.parse_args()
+    # the models take the storage schema from the environment when they are imported
+    os.environ["CLIENT_DB_SCHEMA"] = "compact"
+    from client.db import models
+    convert(args.source, args.destination, models.Base.metadata, args.batch_size)
@@ -1,28 +1,56 @@
-from sqlalchemy import Boolean, Column, ForeignKey, Integer, String, DateTime, Float
+from sqlalchemy import Boolean, Column, ForeignKey, Integer, String, Float, Index
 
-from client.db.database import Base
+from client.db.database import Base, SCHEMA
+from client.db.types import SCHEMA_TYPES
+
+# hex text and datetime text, or blobs and integers with the compact schema
+UuidType, Timestamp = SCHEMA_TYPES[SCHEMA]
+COMPACT = SCHEMA == "compact"
 
 
 class Event(Base):
     __tablename__ = "events"
-    event_uuid = Column(String, primary_key=True)
+    event_uuid = Column(UuidType, primary_key=True)
     value = Column(Float)
     unit = Column(String)
     transmitted = Column(Boolean)
-    time = Column(DateTime)
-    sensor_uuid = Column(String, ForeignKey("sensors.sensor_uuid"))
+    time = Column(Timestamp)
+    sensor_uuid = Column(UuidType, ForeignKey("sensors.sensor_uuid"))
+
+    __table_args__ = (
+        # events of a sensor by time (plots)
+        Index("ix_events_sensor_time", "sensor_uuid", "time"),
+        # events waiting for the cloud sync, only contains the untransmitted rows
+        Index("ix_events_untransmitted", "time", sqlite_where=transmitted == False),
+    )
 
 
 class Sensor(Base):
     __tablename__ = "sensors"
-    sensor_uuid = Column(String, primary_key=True)
+    sensor_uuid = Column(UuidType, primary_key=True)
     sensor_type = Column(String)
     sensor_name = Column(String)
 
 
 class Averages(Base):
     __tablename__ = "averages"
-    average_uuid = Column(String, primary_key=True)
+    average_uuid = Column(UuidType, primary_key=True)
     average = Column(Float)
-    calculation_timestamp = Column(DateTime)
-    sensor_uuid = Column(String, ForeignKey("sensors.sensor_uuid"))
+    calculation_timestamp = Column(Timestamp)
+    sensor_uuid = Column(UuidType, ForeignKey("sensors.sensor_uuid"))
+    # per sensor position assigned by the server, None for averages of servers without piggybacked acks
+    sequence = Column(Integer)
+
+    __table_args__ = (
+        # averages of a sensor by time (plots)
+        Index("ix_averages_sensor_timestamp", "sensor_uuid", "calculation_timestamp"),
+        # highest stored sequence of a sensor (acknowledgements)
+        Index("ix_averages_sensor_sequence", "sensor_uuid", "sequence"),
+    )
+
+
+class SyncState(Base):
+    __tablename__ = "sync_state"
+    name = Column(String, primary_key=True)
+    # all events up to this rowid are transmitted
+    last_rowid = Column(Integer)
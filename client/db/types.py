@@ -0,0 +1,44 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import BigInteger, DateTime, LargeBinary, String
+from sqlalchemy.types import TypeDecorator
+
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+
+
+class HexBlob(TypeDecorator):
+    """Hex uuid strings stored as 16 byte blobs instead of 32 characters, in the table and in every index."""
+    impl = LargeBinary
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        return None if value is None else bytes.fromhex(value)
+
+    def literal_processor(self, dialect):
+        return lambda value: f"X'{bytes.fromhex(value).hex()}'"
+
+    def process_result_value(self, value, dialect):
+        return None if value is None else value.hex()
+
+
+class EpochMicros(TypeDecorator):
+    """Datetimes stored as integer microseconds since the epoch instead of 26 characters of text.
+
+    Like the text format, the time zone is dropped and the datetimes are read back naive.
+    """
+    impl = BigInteger
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        return None if value is None else (value.replace(tzinfo=None) - EPOCH) // MICROSECOND
+
+    def process_result_value(self, value, dialect):
+        return None if value is None else EPOCH + value * MICROSECOND
+
+
+# storage schema -> column types of the uuids and timestamps
+SCHEMA_TYPES = {
+    "text": (String, DateTime),
+    "compact": (HexBlob, EpochMicros),
+}
@@ -0,0 +1,136 @@
+import asyncio
+import os
+import time
+from datetime import datetime
+
+import numpy as np
+import pytz
+from sqlalchemy import insert, select
+
+from client import api
+from client.db import database, models
+
+# sensors registered per /createSensors request
+REGISTER_BATCH_SIZE = 1000
+
+
+class SensorType:
+    """Random walk of a sensor type: a daily sine plus a slowly drifting level plus noise, like client_main's."""
+
+    def __init__(self, unit: str, start: float, start_spread: float, variation: float, noise_level: float,
+                 minimum: float, maximum: float, diurnal_amplitude: float):
+        self.unit = unit
+        self.start = start
+        self.start_spread = start_spread
+        self.variation = variation
+        self.noise_level = noise_level
+        self.minimum = minimum
+        self.maximum = maximum
+        self.diurnal_amplitude = diurnal_amplitude
+
+
+SENSOR_TYPES = {
+    "temperature": SensorType("degree", start=22.0, start_spread=3.0, variation=0.05, noise_level=0.5,
+                              minimum=-10.0, maximum=45.0, diurnal_amplitude=10.0),
+    # humidity falls while the temperature rises
+    "humidity": SensorType("percent", start=50.0, start_spread=10.0, variation=0.1, noise_level=1.0,
+                           minimum=5.0, maximum=95.0, diurnal_amplitude=-10.0),
+}
+
+
+def fleet_names(sensor_types: list[str], size: int) -> list[tuple[str, str]]:
+    """(type, name) of every fleet sensor, the types take turns."""
+    return [(sensor_types[i % len(sensor_types)], f"{sensor_types[i % len(sensor_types)]}_{i:05d}")
+            for i in range(size)]
+
+
+async def register_sensors(client, missing: list[tuple[str, str]]) -> list[models.Sensor]:
+    """Register (type, name) pairs on the server, REGISTER_BATCH_SIZE per request."""
+    remotes = []
+    for start in range(0, len(missing), REGISTER_BATCH_SIZE):
+        response = await api.createSensors.asyncio_detailed(client=client, body=api.SensorBatchRegisterRemote(
+            sensors=[api.SensorRegisterRemote(type=sensor_type, name=name)
+                     for sensor_type, name in missing[start:start + REGISTER_BATCH_SIZE]]
+        ))
+        if response.status_code == 404:
+            print("Server does not support batch registration, registering the sensors one at a time")
+            for sensor_type, name in missing[start:]:
+                remotes.append(await api.createSensor.asyncio(
+                    client=client, body=api.SensorRegisterRemote(type=sensor_type, name=name)
+                ))
+            break
+        if response.status_code != 200:
+            raise RuntimeError(f"Sensor registration failed with status {response.status_code}")
+        remotes += response.parsed
+    return [models.Sensor(sensor_uuid=remote.uuid, sensor_type=remote.type, sensor_name=remote.name)
+            for remote in remotes]
+
+
+async def get_fleet_sensors(client, sensor_types: list[str], size: int) -> list[models.Sensor]:
+    """The fleet's sensors from the db, registering the missing ones on the server in batches."""
+    for sensor_type in sensor_types:
+        if sensor_type not in SENSOR_TYPES:
+            raise ValueError(f"Unknown sensor type {sensor_type}, known types: {', '.join(SENSOR_TYPES)}")
+    names = fleet_names(sensor_types, size)
+    async with database.SessionLocal() as session:
+        stored = {(sensor.sensor_type, sensor.sensor_name): sensor
+                  for sensor in (await session.execute(select(models.Sensor))).scalars()}
+    missing = [name for name in names if name not in stored]
+    if missing:
+        print(f"Registering {len(missing)} fleet sensors on the server")
+        registered = await register_sensors(client, missing)
+        async with database.SessionLocal() as session:
+            async with session.begin():
+                await session.execute(insert(models.Sensor), [
+                    {"sensor_uuid": sensor.sensor_uuid, "sensor_type": sensor.sensor_type,
+                     "sensor_name": sensor.sensor_name}
+                    for sensor in registered
+                ])
+        stored.update({(sensor.sensor_type, sensor.sensor_name): sensor for sensor in registered})
+    return [stored[name] for name in names]
+
+
+class SensorFleet:
+    """Simulated sensors with independent random walks, advanced together in one vectorized step per tick."""
+
+    def __init__(self, sensors: list[models.Sensor], seed: int = None):
+        self.sensor_uuids = [sensor.sensor_uuid for sensor in sensors]
+        types = [SENSOR_TYPES[sensor.sensor_type] for sensor in sensors]
+        self.units = [sensor_type.unit for sensor_type in types]
+        self.rng = np.random.default_rng(seed)
+        self.variation = np.array([sensor_type.variation for sensor_type in types])
+        self.noise_level = np.array([sensor_type.noise_level for sensor_type in types])
+        self.minimum = np.array([sensor_type.minimum for sensor_type in types])
+        self.maximum = np.array([sensor_type.maximum for sensor_type in types])
+        self.diurnal_amplitude = np.array([sensor_type.diurnal_amplitude for sensor_type in types])
+        start_spread = np.array([sensor_type.start_spread for sensor_type in types])
+        self.level = np.array([sensor_type.start for sensor_type in types]) \
+            + self.rng.uniform(-start_spread, start_spread)
+
+    def step(self, now: datetime) -> np.ndarray:
+        """Advance every sensor's walk by one reading and return the readings."""
+        time_fraction = (now.hour * 3600 + now.minute * 60 + now.second) / (24 * 60 * 60)
+        self.level += self.rng.uniform(-self.variation, self.variation)
+        np.clip(self.level, self.minimum, self.maximum, out=self.level)
+        noise = self.rng.uniform(-self.noise_level, self.noise_level)
+        return self.diurnal_amplitude * np.sin(2 * np.pi * time_fraction) + self.level + noise
+
+    def events(self, now: datetime, values: np.ndarray) -> list[dict]:
+        # random 128 bit ids like uuid4().hex, for all sensors at once
+        event_uuids = os.urandom(16 * len(self.sensor_uuids)).hex()
+        return [{
+            "sensor_uuid": sensor_uuid,
+            "event_uuid": event_uuids[i * 32:(i + 1) * 32],
+            "value": value,
+            "time": now,
+            "unit": unit,
+            "transmitted": False
+        } for i, (sensor_uuid, unit, value) in enumerate(zip(self.sensor_uuids, self.units, values.tolist()))]
+
+    async def run(self, event_buffer, tick_seconds: float):
+        """One reading of every sensor per tick, written to the db as one batch."""
+        while True:
+            start = time.perf_counter()
+            now = datetime.now(pytz.UTC)
+            await event_buffer.write_batch(self.events(now, self.step(now)))
+            await asyncio.sleep(max(0.0, tick_seconds - (time.perf_counter() - start)))
@@ -0,0 +1,143 @@
+import bisect
+import os
+import threading
+
+# latency buckets in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(labelnames: tuple, labels: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(labelnames, labels)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.values = {}
+
+    def inc(self, amount: float = 1, labels: tuple = ()):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        lines += [f"{self.name}{_format_labels(self.labelnames, labels)} {value}"
+                  for labels, value in self.values.items()]
+        return lines
+
+
+class Gauge:
+    """A value that is set directly, or read from `function` on every scrape."""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), function=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.function = function
+        self.values = {}
+
+    def set(self, value: float, labels: tuple = ()):
+        self.values[labels] = value
+
+    def inc(self, amount: float = 1, labels: tuple = ()):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, amount: float = 1, labels: tuple = ()):
+        self.inc(-amount, labels)
+
+    def render(self) -> list[str]:
+        if self.function is not None:
+            self.values[()] = self.function()
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge"]
+        lines += [f"{self.name}{_format_labels(self.labelnames, labels)} {value}"
+                  for labels, value in self.values.items()]
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        # per label set: [counts per bucket + overflow, sum]
+        self.values = {}
+        # observations from the aiosqlite threads and the event loop must not interleave
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, labels: tuple = ()):
+        with self.lock:
+            series = self.values.get(labels)
+            if series is None:
+                series = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            snapshot = [(labels, list(counts), total) for labels, (counts, total) in self.values.items()]
+        for labels, counts, total in snapshot:
+            label_text = _format_labels(self.labelnames, labels)
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                bucket_labels = _format_labels(self.labelnames, labels, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{self.name}_sum{label_text} {total}")
+            lines.append(f"{self.name}_count{label_text} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(line for metric in self.metrics for line in metric.render()) + "\n"
+
+
+registry = Registry()
+
+sync_duration = registry.register(Histogram(
+    "fog_client_sync_duration_seconds", "Duration of a complete cloud sync cycle.", ("outcome",)))
+sync_backlog = registry.register(Gauge(
+    "fog_client_sync_backlog_events", "Untransmitted events found at the start of the last sync cycle."))
+events_uploaded = registry.register(Counter(
+    "fog_client_events_uploaded_total", "Events acknowledged by the server."))
+averages_received = registry.register(Counter(
+    "fog_client_averages_received_total", "Averages received from the server."))
+sync_failures = registry.register(Counter(
+    "fog_client_sync_failures_total", "Sync cycles that failed.", ("error",)))
+stream_connected = registry.register(Gauge(
+    "fog_client_stream_connected", "1 while events are uploaded over the streaming connection."))
+buffer_flush_duration = registry.register(Histogram(
+    "fog_client_event_buffer_flush_duration_seconds", "Duration of writing a batch of generated events to the db."))
+buffer_pending = registry.register(Gauge(
+    "fog_client_event_buffer_pending_events", "Generated events waiting in memory for the db."))
+retention_deleted = registry.register(Counter(
+    "fog_client_retention_deleted_rows_total", "Rows deleted by the retention policies.", ("table",)))
+retention_archived = registry.register(Counter(
+    "fog_client_retention_archived_rows_total", "Expired rows written to archive files before their deletion.",
+    ("table",)))
+retention_duration = registry.register(Histogram(
+    "fog_client_retention_duration_seconds", "Duration of applying all retention policies and the vacuum."))
+vacuum_freed_pages = registry.register(Counter(
+    "fog_client_vacuum_freed_pages_total", "Free database pages returned to the file system."))
+
+
+def write_file(path: str):
+    """Write the metrics in prometheus text format, e.g. for the node exporter's textfile collector."""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.write(registry.render())
+    # readers never see a half written file
+    os.replace(tmp_path, path)
@@ -0,0 +1,218 @@
+import multiprocessing
+import queue
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytz
+from sqlalchemy import func, literal_column, select
+
+from client.db import models
+
+ROWID = literal_column("rowid")
+EPOCH = datetime(1970, 1, 1)
+
+
+def unindexed(column):
+    """The column behind a unary plus, which sqlite does not look up in an index, of any type."""
+    return literal_column(f"+{column.table.name}.{column.name}", column.type)
+
+
+def epoch_seconds(timestamps: list[datetime]) -> np.ndarray:
+    # the database returns naive UTC timestamps
+    return np.fromiter(((timestamp.replace(tzinfo=None) - EPOCH).total_seconds() for timestamp in timestamps),
+                       dtype=np.float64, count=len(timestamps))
+
+
+class PlotFeed:
+    """Reads only the rows of the plotted sensors added since the previous poll, using the rowids as high-water marks.
+
+    The first poll sets the marks to the newest rowids of the tables and reads the rows up to them that are inside
+    the plotted time window, so later polls never read the rows before it.
+    """
+
+    def __init__(self, sensor_uuids: list[str], window_seconds: float):
+        self.sensor_uuids = sensor_uuids
+        self.window_seconds = window_seconds
+        self.event_rowid = None
+        self.average_rowid = None
+
+    def events_query(self, cutoff: datetime, after: int | None, up_to: int | None = None):
+        """New events after the rowid `after`, or without `after` those since the cutoff up to `up_to`."""
+        query = select(ROWID, models.Event.sensor_uuid, models.Event.time, models.Event.value)
+        if after is None:
+            return query.where(models.Event.sensor_uuid.in_(self.sensor_uuids), models.Event.time >= cutoff,
+                               ROWID <= up_to)
+        # a rowid range, the sensor index would read all events of the sensors
+        return query.where(ROWID > after, unindexed(models.Event.sensor_uuid).in_(self.sensor_uuids))
+
+    def averages_query(self, cutoff: datetime, after: int | None, up_to: int | None = None):
+        query = select(ROWID, models.Averages.sensor_uuid, models.Averages.calculation_timestamp,
+                       models.Averages.average)
+        if after is None:
+            return query.where(models.Averages.sensor_uuid.in_(self.sensor_uuids),
+                               models.Averages.calculation_timestamp >= cutoff, ROWID <= up_to)
+        return query.where(ROWID > after, unindexed(models.Averages.sensor_uuid).in_(self.sensor_uuids))
+
+    def untransmitted_query(self, cutoff: datetime):
+        # the few untransmitted rows of the window, not every row of the sensors in it
+        return select(ROWID).where(models.Event.transmitted == False, models.Event.time >= cutoff,
+                                   unindexed(models.Event.sensor_uuid).in_(self.sensor_uuids))
+
+    async def poll(self, session) -> dict:
+        cutoff = datetime.now(pytz.UTC).replace(tzinfo=None) - timedelta(seconds=self.window_seconds)
+        event_rowid, average_rowid = self.event_rowid, self.average_rowid
+        if event_rowid is None:
+            # first poll, only what is inside the plotted time window
+            event_rowid = await session.scalar(select(func.max(ROWID)).select_from(models.Event)) or 0
+            average_rowid = await session.scalar(select(func.max(ROWID)).select_from(models.Averages)) or 0
+            events = await session.execute(self.events_query(cutoff, None, event_rowid))
+            averages = await session.execute(self.averages_query(cutoff, None, average_rowid))
+        else:
+            events = await session.execute(self.events_query(cutoff, event_rowid))
+            averages = await session.execute(self.averages_query(cutoff, average_rowid))
+        events = events.all()
+        averages = averages.all()
+        self.event_rowid = max((row[0] for row in events), default=event_rowid)
+        self.average_rowid = max((row[0] for row in averages), default=average_rowid)
+
+        # the sync flips the transmitted flag of old rows, send which of them are still pending
+        untransmitted = await session.execute(self.untransmitted_query(cutoff))
+        return {
+            "events": self._columns(events),
+            "averages": self._columns(averages),
+            "untransmitted_rowids": np.fromiter(untransmitted.scalars(), dtype=np.int64),
+        }
+
+    def _columns(self, rows) -> dict:
+        columns = {}
+        for sensor_uuid in self.sensor_uuids:
+            sensor_rows = [row for row in rows if row[1] == sensor_uuid]
+            columns[sensor_uuid] = (
+                np.fromiter((row[0] for row in sensor_rows), dtype=np.int64, count=len(sensor_rows)),
+                epoch_seconds([row[2] for row in sensor_rows]),
+                np.fromiter((row[3] for row in sensor_rows), dtype=np.float64, count=len(sensor_rows)),
+            )
+        return columns
+
+
+class SeriesWindow:
+    """NumPy columns of one plotted series, trimmed to the time window."""
+
+    def __init__(self):
+        self.rowids = np.empty(0, dtype=np.int64)
+        self.times = np.empty(0, dtype=np.float64)
+        self.values = np.empty(0, dtype=np.float64)
+
+    def extend(self, rowids: np.ndarray, times: np.ndarray, values: np.ndarray):
+        if len(rowids) == 0:
+            return
+        self.rowids = np.concatenate([self.rowids, rowids])
+        self.times = np.concatenate([self.times, times])
+        self.values = np.concatenate([self.values, values])
+        if len(self.times) > 1 and np.any(np.diff(self.times) < 0):
+            order = np.argsort(self.times, kind="stable")
+            self.rowids, self.times, self.values = self.rowids[order], self.times[order], self.values[order]
+
+    def trim(self, cutoff: float):
+        start = np.searchsorted(self.times, cutoff)
+        if start:
+            self.rowids, self.times, self.values = self.rowids[start:], self.times[start:], self.values[start:]
+
+
+def min_max_decimate(times: np.ndarray, values: np.ndarray, buckets: int) -> tuple[np.ndarray, np.ndarray]:
+    """Reduce a series to the minimum and maximum of each of `buckets` equal sized slices, enough for one pixel each."""
+    if len(times) <= 2 * buckets:
+        return times, values
+    starts = np.linspace(0, len(times), buckets, endpoint=False).astype(np.int64)
+    ends = np.append(starts[1:], len(times)) - 1
+    minimums = np.minimum.reduceat(values, starts)
+    maximums = np.maximum.reduceat(values, starts)
+    decimated_times = np.empty(2 * buckets)
+    decimated_values = np.empty(2 * buckets)
+    decimated_times[0::2], decimated_times[1::2] = times[starts], times[ends]
+    decimated_values[0::2], decimated_values[1::2] = minimums, maximums
+    return decimated_times, decimated_values
+
+
+def run_plot_window(updates: multiprocessing.Queue, sensors: list[tuple[str, str]], window_seconds: float):
+    """Entry point of the plot process, the only place the plotting stack is imported."""
+    import matplotlib
+    matplotlib.use("Qt5Agg")
+    from matplotlib import pyplot as plt
+    from matplotlib.dates import DateFormatter
+
+    plt.ion()
+    fig, axes = plt.subplots(len(sensors), 1, figsize=(12, 12), squeeze=False)
+    fig.suptitle('Client', fontsize=16)
+    plots = {}
+    for ax, (sensor_uuid, title) in zip(axes[:, 0], sensors):
+        ax.set_title(title)
+        ax.set_xlabel('Time')
+        ax.set_ylabel('Value')
+        ax.grid(True)
+        ax.xaxis.set_major_formatter(DateFormatter('%H:%M:%S'))
+        transmitted_line, = ax.plot([], [], label='Transmitted Events', marker='o')
+        non_transmitted_line, = ax.plot([], [], label='Non-Transmitted Events', linestyle='dotted', marker='o')
+        avg_line, = ax.plot([], [], label='Averages', marker='x')
+        ax.legend()
+        plots[sensor_uuid] = (ax, transmitted_line, non_transmitted_line, avg_line, SeriesWindow(), SeriesWindow())
+    plt.tight_layout()
+
+    untransmitted_rowids = np.empty(0, dtype=np.int64)
+    while plt.fignum_exists(fig.number):
+        changed = False
+        try:
+            while True:
+                update = updates.get_nowait()
+                if update is None:
+                    return
+                for sensor_uuid, (_, _, _, _, events, averages) in plots.items():
+                    events.extend(*update["events"][sensor_uuid])
+                    averages.extend(*update["averages"][sensor_uuid])
+                untransmitted_rowids = update["untransmitted_rowids"]
+                changed = True
+        except queue.Empty:
+            pass
+
+        if changed:
+            cutoff = time.time() - window_seconds
+            for ax, transmitted_line, non_transmitted_line, avg_line, events, averages in plots.values():
+                events.trim(cutoff)
+                averages.trim(cutoff)
+                buckets = max(int(ax.bbox.width), 1)
+                pending = np.isin(events.rowids, untransmitted_rowids)
+                # matplotlib dates are days since the unix epoch
+                for line, mask in ((transmitted_line, ~pending), (non_transmitted_line, pending)):
+                    times, values = min_max_decimate(events.times[mask], events.values[mask], buckets)
+                    line.set_data(times / 86400.0, values)
+                times, values = min_max_decimate(averages.times, averages.values, buckets)
+                avg_line.set_data(times / 86400.0, values)
+                ax.relim()
+                ax.autoscale_view()
+            fig.canvas.draw_idle()
+        plt.pause(0.2)
+
+
+class PlotProcess:
+    """Renders the plots in a separate process, so a slow redraw never blocks the asyncio loop."""
+
+    def __init__(self, sensors: list[tuple[str, str]], window_seconds: float):
+        context = multiprocessing.get_context("spawn")
+        self.updates = context.Queue()
+        self.process = context.Process(target=run_plot_window, args=(self.updates, sensors, window_seconds),
+                                       daemon=True)
+
+    def start(self):
+        self.process.start()
+
+    def is_alive(self) -> bool:
+        return self.process.is_alive()
+
+    def send(self, update: dict):
+        self.updates.put(update)
+
+    def stop(self):
+        if self.process.is_alive():
+            self.updates.put(None)
+            self.process.join(timeout=5)
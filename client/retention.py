@@ -0,0 +1,167 @@
+import asyncio
+import time
+from datetime import datetime, timedelta
+
+import pytz
+from sqlalchemy import delete, func, literal_column, or_, select
+from sqlalchemy.orm import aliased
+
+from client import metrics
+from client.db import database, models
+
+ROWID = literal_column("rowid")
+# rows deleted per transaction, the event buffer and the sync wait at most this long for the write lock
+DELETE_BATCH_SIZE = 2000
+# expired rows per archive file
+ARCHIVE_FILE_ROWS = 100_000
+# free pages returned to the file system per transaction, 4 MiB with the default page size
+VACUUM_STEP_PAGES = 1024
+# pragma auto_vacuum value of incremental vacuum
+AUTO_VACUUM_INCREMENTAL = 2
+
+
+class RetentionPolicy:
+    """Rows of a table older than max_age that match `expired` are deleted, after archiving them if configured.
+
+    The row with the highest rowid always stays, sqlite would hand its rowid out again otherwise, and the sync
+    cursor and the plot watermarks rely on rowids that only grow.
+    """
+
+    def __init__(self, model, time_column, max_age: timedelta, expired=None):
+        self.table = model.__table__
+        self.time_column = time_column
+        self.max_age = max_age
+        self.expired = expired
+
+    async def boundary(self, session, cutoff: datetime) -> int:
+        """Rowid of the first row at or after the cutoff, the rows before it are older.
+
+        Rows are appended in time order (late ones only by the write buffer delay), so a binary search with a few
+        primary key lookups finds it without an index on the time column.
+        """
+        low, high = (await session.execute(select(func.min(ROWID), func.max(ROWID)).select_from(self.table))).one()
+        if low is None:
+            return 0
+        last_rowid = high
+        high += 1
+        while low < high:
+            middle = (low + high) // 2
+            timestamp = await session.scalar(
+                select(self.time_column).where(ROWID >= middle).order_by(ROWID).limit(1)
+            )
+            if timestamp is None or timestamp >= cutoff:
+                high = middle
+            else:
+                low = middle + 1
+        return min(low, last_rowid)
+
+    def expired_rows(self, boundary: int, after: int, limit: int, columns: bool):
+        query = select(ROWID, *self.table.columns) if columns else select(ROWID).select_from(self.table)
+        query = query.where(ROWID > after, ROWID < boundary)
+        if self.expired is not None:
+            query = query.where(self.expired)
+        return query.order_by(ROWID).limit(limit)
+
+    async def apply(self, now: datetime, archive_dir: str | None = None) -> int:
+        """Delete the expired rows in short transactions and return how many."""
+        async with database.SessionLocal() as session:
+            boundary = await self.boundary(session, now - self.max_age)
+        chunk_size = ARCHIVE_FILE_ROWS if archive_dir else DELETE_BATCH_SIZE
+        after = 0
+        deleted = 0
+        while True:
+            # read a chunk in batches, so no read holds up the event loop long
+            rows = []
+            while len(rows) < chunk_size:
+                async with database.SessionLocal() as session:
+                    batch = (await session.execute(self.expired_rows(
+                        boundary, after, min(DELETE_BATCH_SIZE, chunk_size - len(rows)), archive_dir is not None
+                    ))).all()
+                if not batch:
+                    break
+                rows += batch
+                after = batch[-1][0]
+            if not rows:
+                return deleted
+            if archive_dir:
+                # NumPy is only imported by clients that archive
+                from client import archive
+                # the rows are only deleted once their archive file is complete
+                await asyncio.to_thread(archive.write_archive, archive_dir, self.table, self.time_column.name, rows)
+                metrics.retention_archived.inc(len(rows), (self.table.name,))
+            for start in range(0, len(rows), DELETE_BATCH_SIZE):
+                rowids = [row[0] for row in rows[start:start + DELETE_BATCH_SIZE]]
+                async with database.SessionLocal() as session:
+                    async with session.begin():
+                        await session.execute(delete(self.table).where(ROWID.in_(rowids)))
+                deleted += len(rowids)
+                metrics.retention_deleted.inc(len(rowids), (self.table.name,))
+
+
+def default_policies(event_days: float, average_days: float) -> list[RetentionPolicy]:
+    """Transmitted events and averages older than the given days, 0 keeps a table forever."""
+    policies = []
+    if event_days:
+        # untransmitted events stay until the server acknowledged them, however old they are
+        policies.append(RetentionPolicy(models.Event, models.Event.time, timedelta(days=event_days),
+                                        models.Event.transmitted == True))
+    if average_days:
+        # the newest average of a sensor stays, its sequence is the acknowledgement sent to the server
+        newer = aliased(models.Averages)
+        newest_sequence = (
+            select(func.max(newer.sequence))
+            .where(newer.sensor_uuid == models.Averages.sensor_uuid)
+            .scalar_subquery()
+        )
+        policies.append(RetentionPolicy(models.Averages, models.Averages.calculation_timestamp,
+                                        timedelta(days=average_days),
+                                        or_(models.Averages.sequence == None,
+                                            models.Averages.sequence < newest_sequence)))
+    return policies
+
+
+async def incremental_vacuum() -> int | None:
+    """Return the free pages to the file system in short steps. None if the file has no incremental vacuum."""
+    freed = 0
+    async with database.engine.connect() as connection:
+        if (await connection.exec_driver_sql("PRAGMA auto_vacuum")).scalar() != AUTO_VACUUM_INCREMENTAL:
+            return None
+        raw_connection = await connection.get_raw_connection()
+        while True:
+            free_pages = (await connection.exec_driver_sql("PRAGMA freelist_count")).scalar()
+            if not free_pages:
+                return freed
+            # python's sqlite3 steps a pragma without result columns only once, executescript runs it to the end
+            await raw_connection.driver_connection.executescript(f"PRAGMA incremental_vacuum({VACUUM_STEP_PAGES})")
+            freed += min(free_pages, VACUUM_STEP_PAGES)
+            metrics.vacuum_freed_pages.inc(min(free_pages, VACUUM_STEP_PAGES))
+
+
+class RetentionTask:
+    """Applies the retention policies every interval seconds, starting right away, then vacuums the freed pages."""
+
+    def __init__(self, policies: list[RetentionPolicy], interval: float = 3600.0, archive_dir: str | None = None):
+        self.policies = policies
+        self.interval = interval
+        self.archive_dir = archive_dir
+
+    async def run(self):
+        warned = False
+        while True:
+            start = time.perf_counter()
+            try:
+                # timestamps are stored naive in utc
+                now = datetime.now(pytz.UTC).replace(tzinfo=None)
+                for policy in self.policies:
+                    deleted = await policy.apply(now, self.archive_dir)
+                    if deleted:
+                        print(f"Retention deleted {deleted} rows of {policy.table.name}")
+                if await incremental_vacuum() is None and not warned:
+                    warned = True
+                    print("The client db was created without incremental vacuum, deleted rows are reused but the "
+                          "file does not shrink. Run 'PRAGMA auto_vacuum=INCREMENTAL; VACUUM' on it once while the "
+                          "client is stopped")
+                metrics.retention_duration.observe(time.perf_counter() - start)
+            except Exception as e:
+                print("Failed to apply the retention policies:", str(e))
+            await asyncio.sleep(self.interval)
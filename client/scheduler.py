@@ -0,0 +1,130 @@
+import random
+from datetime import datetime
+from email.utils import parsedate_to_datetime
+
+import pytz
+from sqlalchemy import func, literal_column, select
+from sqlalchemy.dialects.sqlite import insert
+
+from client.db import models
+
+ROWID = literal_column("rowid")
+CURSOR_NAME = "events"
+# sent with every request, so the server's per client limits tell fog nodes behind one address apart
+CLIENT_HEADER = "X-Fog-Client"
+# upload too large, client over its event rate, server overloaded
+REJECTED_STATUS_CODES = (413, 429, 503)
+
+
+class UploadRejected(Exception):
+    """The server's admission control did not accept an upload."""
+
+    def __init__(self, status_code: int, retry_after: float | None):
+        super().__init__(f"Upload rejected with status {status_code}"
+                         + (f", retry after {retry_after:g}s" if retry_after is not None else ""))
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+def retry_after(headers) -> float | None:
+    """Seconds of a Retry-After header, given as seconds or as an http date."""
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(pytz.UTC)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+async def load_cursor(session) -> int:
+    """Rowid up to which all events are transmitted, so the sync never scans them again."""
+    cursor = await session.scalar(select(models.SyncState.last_rowid).where(models.SyncState.name == CURSOR_NAME))
+    if cursor is not None:
+        return cursor
+    # database of a version without cursor, start before the oldest untransmitted event
+    # + 0 keeps sqlite from walking the table in rowid order through all transmitted events,
+    # it reads the partial index of the untransmitted events instead
+    first_untransmitted = await session.scalar(
+        select(func.min(ROWID + 0)).where(models.Event.transmitted == False)
+    )
+    if first_untransmitted is not None:
+        return first_untransmitted - 1
+    return await session.scalar(select(func.coalesce(func.max(ROWID), 0)).select_from(models.Event))
+
+
+async def save_cursor(session, last_rowid: int):
+    # batch sync and streaming upload both move the cursor, it never goes back
+    stmt = insert(models.SyncState).values(name=CURSOR_NAME, last_rowid=last_rowid)
+    await session.execute(stmt.on_conflict_do_update(
+        index_elements=[models.SyncState.name],
+        set_={"last_rowid": func.max(models.SyncState.last_rowid, stmt.excluded.last_rowid)}
+    ))
+
+
+async def read_page(session, cursor: int, page_size: int) -> list[tuple[int, models.Event]]:
+    """The oldest untransmitted events after the cursor."""
+    result = await session.execute(
+        select(ROWID, models.Event)
+        .where(ROWID > cursor, models.Event.transmitted == False)
+        .order_by(ROWID)
+        .limit(page_size)
+    )
+    return result.all()
+
+
+def acked_rowid(cursor: int, page: list[tuple[int, models.Event]], received_event_uuids) -> int:
+    """New cursor after an upload: the last rowid before the first event of the page the server did not ack."""
+    received_event_uuids = set(received_event_uuids)
+    for rowid, event in page:
+        if event.event_uuid not in received_event_uuids:
+            break
+        cursor = rowid
+    return cursor
+
+
+class SyncScheduler:
+    """Delay before the next batch sync.
+
+    While a backlog exists (the last page was full) pages are sent back to back, after a partial page the
+    regular interval applies and every sync without events doubles it up to max_interval. Failures back off
+    exponentially up to max_backoff, with full jitter so reconnecting clients don't hit the server in lockstep.
+    A Retry-After of the server is the earliest time of the next attempt.
+    """
+
+    def __init__(self, interval: float = 15.0, backlog_interval: float = 0.2, max_interval: float = 60.0,
+                 max_backoff: float = 300.0):
+        self.interval = interval
+        self.backlog_interval = backlog_interval
+        self.max_interval = max_interval
+        self.max_backoff = max_backoff
+        self.idle_interval = interval
+        self.failures = 0
+
+    def succeeded(self, sent: int, page_size: int) -> float:
+        self.failures = 0
+        if sent >= page_size:
+            self.idle_interval = self.interval
+            return self.backlog_interval
+        if sent:
+            self.idle_interval = self.interval
+            return self.interval
+        delay = self.idle_interval
+        self.idle_interval = min(self.idle_interval * 2, self.max_interval)
+        return delay
+
+    def failed(self, retry_after: float | None = None) -> float:
+        self.failures += 1
+        cap = min(self.max_backoff, self.interval * 2 ** (self.failures - 1))
+        delay = random.uniform(self.backlog_interval, cap)
+        return delay if retry_after is None else max(delay, retry_after)
+
+    def rejected(self, status_code: int, retry_after: float | None) -> float:
+        if retry_after is not None and status_code in (429, 503):
+            # the server paces the client (or spreads its rejected clients itself), no backoff, a little jitter
+            return retry_after * random.uniform(1.0, 1.2)
+        return self.failed(retry_after)
@@ -0,0 +1,242 @@
+import glob
+import mmap
+import os
+import zlib
+from datetime import timedelta
+
+import numpy as np
+
+from client import wireformat
+from client.db import models
+
+# one event, 72 bytes little endian. The offset is the record's position in the whole log, a record only counts if
+# it is at its own offset and its checksum (crc32 of the bytes before it) matches
+RECORD = np.dtype([
+    ("offset", "<u8"),
+    ("event_uuid", "V16"),
+    ("sensor_uuid", "V16"),
+    ("time", "<i8"),  # microseconds since the epoch, UTC
+    ("value", "<f8"),
+    ("unit", "S12"),
+    ("checksum", "<u4"),
+])
+CHECKSUMMED_BYTES = RECORD.itemsize - 4
+CURSOR_FILE = "cursor"
+DEFAULT_SEGMENT_BYTES = 16 * 1024 * 1024
+# acknowledged segment files kept for reuse, the others are deleted
+SPARE_SEGMENTS = 2
+
+
+class Segment:
+    """A memory mapped segment file holding the records from `first` on."""
+
+    def __init__(self, path: str, first: int):
+        self.path = path
+        self.first = first
+        with open(path, "r+b") as f:
+            self.mmap = mmap.mmap(f.fileno(), 0)
+        self.records = np.frombuffer(self.mmap, dtype=RECORD, count=len(self.mmap) // RECORD.itemsize)
+
+    @property
+    def end(self) -> int:
+        return self.first + len(self.records)
+
+    def valid_records(self) -> int:
+        """Records written completely before a crash, the first one at a wrong offset or with a bad checksum ends
+        the segment. Records of the file's previous use as another segment have wrong offsets."""
+        valid = self.records["offset"] == np.arange(self.first, self.end, dtype=np.uint64)
+        count = len(valid) if valid.all() else int(np.argmin(valid))
+        raw = memoryview(self.mmap)
+        for index in range(count):
+            start = index * RECORD.itemsize
+            if zlib.crc32(raw[start:start + CHECKSUMMED_BYTES]) != self.records["checksum"][index]:
+                count = index
+                break
+        raw.release()
+        return count
+
+    def clear(self, start: int):
+        """Zero the records from the index start on."""
+        np.frombuffer(self.mmap, dtype=np.uint8)[start * RECORD.itemsize:] = 0
+
+    def flush(self):
+        self.mmap.flush()
+
+
+class SegmentLog:
+    """Unsent events as fixed size records in append-only, memory mapped segment files.
+
+    Instead of a transmitted flag per row, a cursor file holds the offset up to which all events are acknowledged.
+    Appending only writes to the end of the newest segment, and segments behind the cursor are reused for new
+    records. `read` returns a NumPy view of the mapped records, valid until they are acknowledged.
+
+    With `sync`, every append is flushed to storage before it returns. Without it, a crash of the machine (not of
+    the process) can lose the last appends; records torn by it are detected by their checksum on the next start.
+    """
+
+    def __init__(self, directory: str, segment_bytes: int = DEFAULT_SEGMENT_BYTES, sync: bool = False):
+        self.directory = directory
+        self.segment_records = segment_bytes // RECORD.itemsize
+        self.sync = sync
+        os.makedirs(directory, exist_ok=True)
+        self.cursor = self.load_cursor()
+        self.segments: list[Segment] = []
+        self.spares: list[str] = []
+        for path in sorted(glob.glob(os.path.join(directory, "*.log"))):
+            first = int(os.path.basename(path).split(".")[0])
+            if not self.segments and first + os.path.getsize(path) // RECORD.itemsize <= self.cursor:
+                self.spares.append(path)
+            else:
+                self.segments.append(Segment(path, first))
+        if self.segments:
+            last = self.segments[-1]
+            written = last.valid_records()
+            # clear a torn tail, so no stale record behind it can become valid with the next append
+            last.clear(written)
+            last.flush()
+            self.end = last.first + written
+        else:
+            self.end = self.cursor
+        self.cursor = min(self.cursor, self.end)
+        self.recycle()
+
+    def load_cursor(self) -> int:
+        try:
+            with open(os.path.join(self.directory, CURSOR_FILE), "rb") as f:
+                return int.from_bytes(f.read(8), "little")
+        except FileNotFoundError:
+            return 0
+
+    def save_cursor(self):
+        path = os.path.join(self.directory, CURSOR_FILE)
+        with open(path + ".tmp", "wb") as f:
+            f.write(self.cursor.to_bytes(8, "little"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+
+    def pending(self) -> int:
+        return self.end - self.cursor
+
+    def new_segment(self, first: int) -> Segment:
+        path = os.path.join(self.directory, f"{first:020d}.log")
+        if self.spares:
+            # the old records are at other offsets, they never count as records of the new segment
+            os.replace(self.spares.pop(), path)
+        else:
+            with open(path, "wb") as f:
+                f.truncate(self.segment_records * RECORD.itemsize)
+        segment = Segment(path, first)
+        self.segments.append(segment)
+        return segment
+
+    def append(self, events: list[dict]):
+        """Append events as generated by the client, dicts with the columns of the events table."""
+        if not events:
+            return
+        records = np.zeros(len(events), dtype=RECORD)
+        records["offset"] = np.arange(self.end, self.end + len(events), dtype=np.uint64)
+        records["event_uuid"] = np.frombuffer(bytes.fromhex("".join(event["event_uuid"] for event in events)), "V16")
+        records["sensor_uuid"] = np.frombuffer(bytes.fromhex("".join(event["sensor_uuid"] for event in events)),
+                                               "V16")
+        records["time"] = [wireformat.epoch_micros(event["time"]) for event in events]
+        records["value"] = [event["value"] for event in events]
+        units = [event["unit"].encode() for event in events]
+        if max(len(unit) for unit in units) > RECORD["unit"].itemsize:
+            raise ValueError(f"Units of the segment log have at most {RECORD['unit'].itemsize} bytes")
+        records["unit"] = units
+        raw = records.view(np.uint8).reshape(len(records), RECORD.itemsize)
+        records["checksum"] = [zlib.crc32(row[:CHECKSUMMED_BYTES]) for row in raw]
+
+        written = 0
+        while written < len(records):
+            segment = self.segments[-1] if self.segments and self.end < self.segments[-1].end \
+                else self.new_segment(self.end)
+            start = self.end - segment.first
+            count = min(len(records) - written, len(segment.records) - start)
+            segment.records[start:start + count] = records[written:written + count]
+            if self.sync:
+                segment.flush()
+            written += count
+            self.end += count
+
+    def read(self, offset: int, limit: int) -> np.ndarray:
+        """Up to `limit` records from the offset on, a view of the mapped segment unless they span two segments."""
+        offset = max(offset, self.cursor)
+        end = min(self.end, offset + limit)
+        parts = [segment.records[max(offset, segment.first) - segment.first:min(end, segment.end) - segment.first]
+                 for segment in self.segments if segment.first < end and offset < segment.end]
+        if not parts:
+            return np.zeros(0, dtype=RECORD)
+        return parts[0] if len(parts) == 1 else np.concatenate(parts)
+
+    def ack(self, offset: int):
+        """All records before the offset are acknowledged by the server."""
+        if offset <= self.cursor:
+            return
+        self.cursor = min(offset, self.end)
+        self.save_cursor()
+        self.recycle()
+
+    def recycle(self):
+        # the newest segment stays mapped for the appends
+        while len(self.segments) > 1 and self.segments[0].end <= self.cursor:
+            segment = self.segments.pop(0)
+            # views returned by read() may still refer to the mapping, it is closed once they are gone
+            self.spares.append(segment.path)
+        while len(self.spares) > SPARE_SEGMENTS:
+            os.remove(self.spares.pop(0))
+
+    def close(self):
+        for segment in self.segments:
+            segment.flush()
+
+    # static, so the client reaches them through its log without importing this module (and NumPy) itself
+    @staticmethod
+    def acked_offset(records: np.ndarray, received_event_uuids) -> int:
+        """New cursor after an upload: the offset of the first record the server did not ack."""
+        received_event_uuids = set(received_event_uuids)
+        for index, event_uuid in enumerate(event_uuids(records)):
+            if event_uuid not in received_event_uuids:
+                return int(records["offset"][index])
+        return int(records["offset"][-1]) + 1
+
+    @staticmethod
+    def to_events(records: np.ndarray) -> list[models.Event]:
+        """The records as (unsaved) event rows, for the json upload."""
+        sensor_uuids = records["sensor_uuid"].tobytes().hex()
+        return [models.Event(
+            event_uuid=event_uuid,
+            sensor_uuid=sensor_uuids[i * 32:(i + 1) * 32],
+            time=wireformat.EPOCH + timedelta(microseconds=int(record["time"])),
+            value=float(record["value"]),
+            unit=record["unit"].decode(),
+            transmitted=False
+        ) for i, (event_uuid, record) in enumerate(zip(event_uuids(records), records))]
+
+    @staticmethod
+    def encode(records: np.ndarray, acked_sequences: dict[str, int] | None = None) -> bytes:
+        """The records as a columnar /sensordata body like wireformat.encode(), sliced out of the array by column."""
+        groups, group_of_record = np.unique(records[["sensor_uuid", "unit"]], return_inverse=True)
+        # stable, the events of a group stay in log order
+        order = np.argsort(group_of_record, kind="stable")
+        starts = np.searchsorted(group_of_record[order], np.arange(len(groups) + 1))
+        parts = [wireformat.HEADER.pack(wireformat.MAGIC_V2 if acked_sequences else wireformat.MAGIC, len(groups))]
+        for index, (sensor_uuid, unit) in enumerate(groups):
+            group = records[order[starts[index]:starts[index + 1]]]
+            parts.append(wireformat.GROUP_HEADER.pack(sensor_uuid.tobytes(), len(unit), len(group)))
+            parts.append(unit)
+            parts.append(group["event_uuid"].tobytes())
+            # the record fields are little endian already
+            parts.append(group["time"].tobytes())
+            parts.append(group["value"].tobytes())
+        if acked_sequences:
+            parts.append(wireformat.ACK_COUNT.pack(len(acked_sequences)))
+            parts += [wireformat.ACK.pack(bytes.fromhex(sensor_uuid), sequence)
+                      for sensor_uuid, sequence in acked_sequences.items()]
+        return b"".join(parts)
+
+
+def event_uuids(records: np.ndarray) -> list[str]:
+    hex_uuids = records["event_uuid"].tobytes().hex()
+    return [hex_uuids[i * 32:(i + 1) * 32] for i in range(len(records))]
@@ -0,0 +1,152 @@
+import asyncio
+import json
+from datetime import datetime
+
+from sqlalchemy import func, insert, select, update
+
+try:
+    import websockets
+except ImportError:
+    websockets = None
+
+from client import metrics, scheduler
+from client.db import database, models
+
+# seconds between checks for new events if no flush notification arrives
+POLL_INTERVAL_SECONDS = 1.0
+
+
+async def acked_sequences(session) -> dict[str, int]:
+    """Highest stored average sequence per sensor, sent with the next upload instead of a separate ack request."""
+    # one index lookup per sensor instead of grouping all stored averages
+    acked_sequence = (
+        select(func.max(models.Averages.sequence))
+        .where(models.Averages.sensor_uuid == models.Sensor.sensor_uuid)
+        .scalar_subquery()
+    )
+    result = await session.execute(select(models.Sensor.sensor_uuid, acked_sequence))
+    return {sensor_uuid: sequence for sensor_uuid, sequence in result if sequence is not None}
+
+
+class StreamUploader:
+    """Keeps a websocket to /ws/ingest open and uploads events as soon as they are written to the db.
+
+    Events stay untransmitted until the server acks their batch, so after a reconnect the upload resumes at the
+    sync cursor, and the server resends the averages after the stored sequences.
+    While the stream is down, `connected` is False and the periodic batch sync takes over.
+    """
+
+    def __init__(self, url: str, sensor_uuids: list[str], max_batch_size: int = 500, window: int = 4,
+                 reconnect_seconds: float = 5.0):
+        self.url = url
+        self.sensor_uuids = sensor_uuids
+        self.max_batch_size = max_batch_size
+        self.window = window
+        self.reconnect_seconds = reconnect_seconds
+        self.connected = False
+        self.events_written = asyncio.Event()
+
+    @staticmethod
+    def available() -> bool:
+        return websockets is not None
+
+    def notify(self):
+        """Called after the event buffer wrote new events."""
+        self.events_written.set()
+
+    async def run(self):
+        while True:
+            try:
+                async with websockets.connect(self.url) as connection:
+                    await self.stream(connection)
+            except Exception as e:
+                if self.connected:
+                    print("Streaming upload interrupted, using the batch sync until it reconnects:", str(e))
+            self.connected = False
+            metrics.stream_connected.set(0)
+            await asyncio.sleep(self.reconnect_seconds)
+
+    async def stream(self, connection):
+        async with database.SessionLocal() as session:
+            acked = await acked_sequences(session)
+            # resume after the events the server acked, the cursor is shared with the batch sync
+            last_rowid = await scheduler.load_cursor(session)
+        await connection.send(json.dumps({"type": "hello", "sensor_uuids": self.sensor_uuids,
+                                          "acked_sequences": acked}))
+        ready = json.loads(await connection.recv())
+        if ready.get("type") != "ready":
+            raise RuntimeError(f"Unexpected stream message: {ready}")
+        # flow control: never more unacked batches than the server allows
+        credit = asyncio.Semaphore(min(self.window, ready["window"]))
+        batch_size = min(self.max_batch_size, ready["max_batch_size"])
+        self.connected = True
+        metrics.stream_connected.set(1)
+        print("Streaming events to the cloud server")
+        # last rowid of every unacked batch
+        in_flight = {}
+        sender = asyncio.create_task(self.send_events(connection, credit, batch_size, last_rowid, in_flight))
+        try:
+            await self.receive(connection, credit, in_flight)
+        finally:
+            sender.cancel()
+
+    async def send_events(self, connection, credit: asyncio.Semaphore, batch_size: int, last_rowid: int,
+                          in_flight: dict[int, int]):
+        seq = 0
+        while True:
+            self.events_written.clear()
+            async with database.SessionLocal() as session:
+                rows = await scheduler.read_page(session, last_rowid, batch_size)
+            if not rows:
+                try:
+                    await asyncio.wait_for(self.events_written.wait(), POLL_INTERVAL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await credit.acquire()
+            seq += 1
+            last_rowid = rows[-1][0]
+            in_flight[seq] = last_rowid
+            await connection.send(json.dumps({"type": "events", "seq": seq, "events": [
+                {"event_uuid": event.event_uuid, "value": event.value, "unit": event.unit,
+                 "timestamp": event.time.isoformat(), "sensor_uuid": event.sensor_uuid}
+                for _, event in rows
+            ]}))
+
+    async def receive(self, connection, credit: asyncio.Semaphore, in_flight: dict[int, int]):
+        async for message in connection:
+            message = json.loads(message)
+            if message["type"] == "ack":
+                credit.release()
+                async with database.SessionLocal() as session:
+                    async with session.begin():
+                        await session.execute(
+                            update(models.Event)
+                            .where(models.Event.event_uuid.in_(message["received_event_uuids"]))
+                            .values(transmitted=True)
+                        )
+                        # batches are acked in order, everything up to this batch is transmitted
+                        await scheduler.save_cursor(session, in_flight.pop(message["seq"]))
+                metrics.events_uploaded.inc(len(message["received_event_uuids"]))
+            elif message["type"] == "averages":
+                await self.store_averages(connection, message["averages"])
+            elif message["type"] == "error":
+                # reconnect and resume from the cursor, so the rejected batch is not skipped
+                raise RuntimeError("Streaming upload rejected by the server: " + message["detail"])
+
+    async def store_averages(self, connection, averages: list[dict]):
+        async with database.SessionLocal() as session:
+            async with session.begin():
+                # ignore on conflict in case of averages resent after a reconnect
+                await session.execute(insert(models.Averages).prefix_with("OR IGNORE"), [{
+                    "average_uuid": average["average_uuid"],
+                    "average": average["average"],
+                    "calculation_timestamp": datetime.fromisoformat(average["average_timestamp"]),
+                    "sensor_uuid": average["sensor_uuid"],
+                    "sequence": average["sequence"],
+                } for average in averages])
+        metrics.averages_received.inc(len(averages))
+        acked = {}
+        for average in averages:
+            acked[average["sensor_uuid"]] = max(acked.get(average["sensor_uuid"], 0), average["sequence"])
+        await connection.send(json.dumps({"type": "acked", "acked_sequences": acked}))
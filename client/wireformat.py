@@ -0,0 +1,72 @@
+import gzip
+import struct
+import sys
+from array import array
+from datetime import datetime, timedelta
+
+import pytz
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from client.db import models
+
+# columnar /sensordata body, all numbers little endian:
+#   header: magic, number of groups
+#   per group (one sensor and unit): sensor uuid (16 bytes), unit length, event count, unit (utf-8),
+#   event uuids (16 bytes each), timestamps (int64 microseconds since epoch, UTC), values (float64)
+# version 2 appends the piggybacked acks: number of acks, per ack sensor uuid (16 bytes) and sequence (int64)
+CONTENT_TYPE = "application/vnd.fog.sensordata+columnar"
+MAGIC = b"FOG1"
+MAGIC_V2 = b"FOG2"
+HEADER = struct.Struct("<4sI")
+GROUP_HEADER = struct.Struct("<16sHI")
+ACK_COUNT = struct.Struct("<I")
+ACK = struct.Struct("<16sq")
+EPOCH = datetime(1970, 1, 1, tzinfo=pytz.UTC)
+COMPRESSIONS = ["zstd", "gzip", "none"] if zstandard is not None else ["gzip", "none"]
+
+
+def epoch_micros(time: datetime) -> int:
+    # the database returns naive timestamps, they are always UTC
+    if time.tzinfo is None:
+        time = time.replace(tzinfo=pytz.UTC)
+    return (time - EPOCH) // timedelta(microseconds=1)
+
+
+def encode(events: list[models.Event], acked_sequences: dict[str, int] | None = None) -> bytes:
+    """Encode events, with acks only as version 2, which servers that never sent a sequence don't understand."""
+    groups = {}
+    for event in events:
+        groups.setdefault((event.sensor_uuid, event.unit), []).append(event)
+    parts = [HEADER.pack(MAGIC_V2 if acked_sequences else MAGIC, len(groups))]
+    for (sensor_uuid, unit), group in groups.items():
+        unit = unit.encode()
+        parts.append(GROUP_HEADER.pack(bytes.fromhex(sensor_uuid), len(unit), len(group)))
+        parts.append(unit)
+        parts.append(b"".join(bytes.fromhex(event.event_uuid) for event in group))
+        timestamps = array("q", [epoch_micros(event.time) for event in group])
+        values = array("d", [event.value for event in group])
+        if sys.byteorder == "big":
+            timestamps.byteswap()
+            values.byteswap()
+        parts.append(timestamps.tobytes())
+        parts.append(values.tobytes())
+    if acked_sequences:
+        parts.append(ACK_COUNT.pack(len(acked_sequences)))
+        parts += [ACK.pack(bytes.fromhex(sensor_uuid), sequence) for sensor_uuid, sequence in acked_sequences.items()]
+    return b"".join(parts)
+
+
+def compress(body: bytes, compression: str) -> tuple[bytes, dict]:
+    """Compress a body and return it with the headers describing it."""
+    headers = {"Content-Type": CONTENT_TYPE}
+    if compression == "zstd":
+        headers["Content-Encoding"] = "zstd"
+        return zstandard.ZstdCompressor().compress(body), headers
+    if compression == "gzip":
+        headers["Content-Encoding"] = "gzip"
+        return gzip.compress(body, compresslevel=6), headers
+    return body, headers
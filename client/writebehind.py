@@ -0,0 +1,110 @@
+import asyncio
+import time
+
+from sqlalchemy import insert
+
+from client import metrics
+from client.db import database, models
+
+
+class EventWriteBuffer:
+    """Collects generated events in memory and writes them to the database in one transaction per flush.
+
+    A flush happens when max_batch_size events are pending or max_delay_seconds after the previous flush,
+    so a crash loses at most that window of readings. When capacity events are pending, append waits for a flush.
+    With an event_log (segmentlog.SegmentLog) the events are appended to it instead of the events table.
+    run() is stopped by close() instead of being cancelled, so a flush in progress is never interrupted.
+    """
+
+    def __init__(self, max_batch_size: int = 500, max_delay_seconds: float = 1.0, capacity: int = 10_000,
+                 event_log=None):
+        self.max_batch_size = max_batch_size
+        self.max_delay_seconds = max_delay_seconds
+        self.capacity = capacity
+        self.event_log = event_log
+        self.pending: list[dict] = []
+        self.flush_lock = asyncio.Lock()
+        self.batch_full = asyncio.Event()
+        self.closed = False
+        # called after every successful flush
+        self.flush_listeners: list[callable] = []
+        # counters for tuning
+        self.flushes = 0
+        self.flushed_events = 0
+        self.largest_batch = 0
+        self.flush_seconds_total = 0.0
+        self.flush_seconds_max = 0.0
+
+    async def append(self, event: dict):
+        while len(self.pending) >= self.capacity:
+            # the database cannot keep up, slow the generators down instead of growing without bound
+            if not await self.try_flush():
+                await asyncio.sleep(self.max_delay_seconds)
+        self.pending.append(event)
+        if len(self.pending) >= self.max_batch_size:
+            self.batch_full.set()
+
+    async def write_batch(self, events: list[dict]):
+        """Write a batch generated at once (a fleet tick) right away, in one transaction with anything pending."""
+        self.pending.extend(events)
+        # a failed flush keeps the events for the writer, unless there are too many of them already
+        while not await self.try_flush() and len(self.pending) >= self.capacity:
+            await asyncio.sleep(self.max_delay_seconds)
+
+    async def flush(self):
+        async with self.flush_lock:
+            if not self.pending:
+                return
+            batch, self.pending = self.pending, []
+            start = time.perf_counter()
+            try:
+                if self.event_log is not None:
+                    self.event_log.append(batch)
+                else:
+                    async with database.SessionLocal() as session:
+                        async with session.begin():
+                            await session.execute(insert(models.Event), batch)
+            except Exception:
+                # keep the events for the next attempt
+                self.pending = batch + self.pending
+                raise
+            elapsed = time.perf_counter() - start
+            self.flushes += 1
+            self.flushed_events += len(batch)
+            self.largest_batch = max(self.largest_batch, len(batch))
+            self.flush_seconds_total += elapsed
+            self.flush_seconds_max = max(self.flush_seconds_max, elapsed)
+            metrics.buffer_flush_duration.observe(elapsed)
+        for listener in self.flush_listeners:
+            listener()
+
+    async def try_flush(self) -> bool:
+        try:
+            await self.flush()
+            return True
+        except Exception as e:
+            print("Failed to write sensor events to db:", str(e))
+            return False
+
+    async def run(self):
+        while not self.closed:
+            try:
+                await asyncio.wait_for(self.batch_full.wait(), self.max_delay_seconds)
+            except asyncio.TimeoutError:
+                pass
+            self.batch_full.clear()
+            await self.try_flush()
+
+    async def close(self):
+        """Stop run() after its current flush and write everything still pending, call on shutdown."""
+        self.closed = True
+        self.batch_full.set()
+        # waits for the lock, so a flush in progress finishes first
+        await self.flush()
+
+    def stats(self) -> str:
+        mean_batch = self.flushed_events / self.flushes if self.flushes else 0
+        mean_latency = self.flush_seconds_total / self.flushes if self.flushes else 0
+        return (f"flushes={self.flushes} events={self.flushed_events} pending={len(self.pending)} "
+                f"mean_batch={mean_batch:.1f} max_batch={self.largest_batch} "
+                f"mean_flush_ms={mean_latency * 1000:.2f} max_flush_ms={self.flush_seconds_max * 1000:.2f}")
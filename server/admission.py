@@ -0,0 +1,198 @@
+import asyncio
+import math
+import os
+import random
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+
+from fastapi import HTTPException
+from starlette.requests import HTTPConnection, Request
+
+import metrics
+
+# events of one upload, larger ones are rejected with 413 and the client sends smaller pages
+MAX_REQUEST_EVENTS = int(os.environ.get("SERVER_MAX_REQUEST_EVENTS", "10000"))
+# size of an upload body as sent, checked against its content length before the body is read
+MAX_REQUEST_BYTES = int(os.environ.get("SERVER_MAX_REQUEST_BYTES", str(16 * 1024 * 1024)))
+# sustained events per second of one client and the burst it may upload at once, a rate of 0 disables the limit
+CLIENT_EVENT_RATE = float(os.environ.get("SERVER_CLIENT_EVENT_RATE", "5000"))
+CLIENT_EVENT_BURST = float(os.environ.get("SERVER_CLIENT_EVENT_BURST", "50000"))
+# uploads a worker process handles at once, 0 disables the limit. Up to MAX_INGEST_QUEUED more wait at most
+# INGEST_QUEUE_SECONDS for one of them to finish, so the writer stays busy; the others are rejected with 503
+MAX_INGEST_IN_FLIGHT = int(os.environ.get("SERVER_MAX_INGEST_IN_FLIGHT", "8"))
+MAX_INGEST_QUEUED = int(os.environ.get("SERVER_MAX_INGEST_QUEUED", "16"))
+INGEST_QUEUE_SECONDS = float(os.environ.get("SERVER_INGEST_QUEUE_SECONDS", "0.5"))
+# a 503 asks the client to come back within this many seconds, spread so the rejected clients don't return together
+OVERLOAD_RETRY_AFTER = 3.0
+# token buckets kept, the least recently used client is evicted first
+MAX_CLIENTS = 10_000
+# clients identify themselves with this header, without it the remote address is the client
+CLIENT_HEADER = "X-Fog-Client"
+
+
+class TokenBucket:
+    """Events a client may upload, refilled at `rate` per second up to `burst`.
+
+    An upload is admitted while the bucket is not in debt and charged once its events are decoded, which may take
+    the bucket below zero. So the size of an upload need not be known before its body is read, and the long-run
+    rate still holds: the client's next upload waits until the debt is paid off.
+    """
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait(self, now: float) -> float:
+        """Seconds until the bucket is out of debt, 0 if an upload may start now."""
+        self.refill(now)
+        return max(0.0, -self.tokens / self.rate)
+
+    def charge(self, events: int, now: float):
+        self.refill(now)
+        self.tokens -= events
+
+
+def reject(status_code: int, reason: str, detail: str, retry_after: float | None = None):
+    metrics.ingest_rejected.inc(labels=(reason,))
+    headers = {"Retry-After": str(max(1, math.ceil(retry_after)))} if retry_after is not None else None
+    raise HTTPException(status_code=status_code, detail=detail, headers=headers)
+
+
+class AdmissionControl:
+    """Decides which uploads are handled, so a burst of them (clients reconnecting after an outage with their
+    backlog) is spread over time instead of queueing in front of the sqlite write lock.
+
+    Uploads are rejected with 413 if they are too large, 429 with a Retry-After of the client's debt if the client
+    exceeds its event rate, and 503 with a randomized Retry-After if the process handles max_in_flight uploads and
+    no slot frees up for them in time. The limits are per worker process.
+    """
+
+    def __init__(self, max_request_events: int = MAX_REQUEST_EVENTS, max_request_bytes: int = MAX_REQUEST_BYTES,
+                 client_rate: float = CLIENT_EVENT_RATE, client_burst: float = CLIENT_EVENT_BURST,
+                 max_in_flight: int = MAX_INGEST_IN_FLIGHT, max_queued: int = MAX_INGEST_QUEUED,
+                 queue_seconds: float = INGEST_QUEUE_SECONDS):
+        self.max_request_events = max_request_events
+        self.max_request_bytes = max_request_bytes
+        self.client_rate = client_rate
+        self.client_burst = client_burst
+        self.max_in_flight = max_in_flight
+        self.max_queued = max_queued
+        self.queue_seconds = queue_seconds
+        self.buckets: OrderedDict[str, TokenBucket] = OrderedDict()
+        self.in_flight = 0
+        # uploads waiting for a slot, oldest first. A finished upload hands its slot to the first of them
+        self.queued: deque[asyncio.Future] = deque()
+
+    @staticmethod
+    def client_key(connection: HTTPConnection) -> str:
+        client = connection.headers.get(CLIENT_HEADER)
+        if client:
+            return client
+        return connection.client.host if connection.client else "unknown"
+
+    def bucket(self, connection: HTTPConnection, now: float) -> TokenBucket | None:
+        if not self.client_rate:
+            return None
+        key = self.client_key(connection)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(self.client_rate, self.client_burst, now)
+            while len(self.buckets) > MAX_CLIENTS:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(key)
+        return bucket
+
+    async def acquire(self) -> bool:
+        if not self.max_in_flight or self.in_flight < self.max_in_flight:
+            self.in_flight += 1
+            return True
+        if len(self.queued) >= self.max_queued:
+            return False
+        slot = asyncio.get_running_loop().create_future()
+        self.queued.append(slot)
+        try:
+            await asyncio.wait_for(slot, self.queue_seconds)
+            return True
+        except asyncio.TimeoutError:
+            # handed over just as the wait timed out
+            return slot.done() and not slot.cancelled()
+        except BaseException:
+            # the client went away, pass on a slot handed over in the meantime
+            if slot.done() and not slot.cancelled():
+                self.release()
+            raise
+        finally:
+            if slot in self.queued:
+                self.queued.remove(slot)
+
+    def release(self):
+        while self.queued:
+            slot = self.queued.popleft()
+            if not slot.done():
+                slot.set_result(None)
+                return
+        self.in_flight -= 1
+
+    @asynccontextmanager
+    async def admit(self, connection: HTTPConnection):
+        """Hold an ingest slot while an upload is handled, rejecting it before its body is read if need be."""
+        content_length = connection.headers.get("content-length", "")
+        if content_length.isdigit() and int(content_length) > self.max_request_bytes:
+            reject(413, "too_large", f"Uploads are limited to {self.max_request_bytes} bytes")
+        bucket = self.bucket(connection, time.monotonic())
+        if bucket is not None:
+            wait = bucket.wait(time.monotonic())
+            if wait > 0:
+                reject(429, "rate_limited", f"Upload rate of {self.client_rate:g} events/s exceeded", wait)
+        if not await self.acquire():
+            reject(503, "overloaded", "Too many uploads in progress", random.uniform(1, OVERLOAD_RETRY_AFTER))
+        try:
+            yield
+        finally:
+            self.release()
+
+    async def read_body(self, request: Request) -> bytes:
+        """The body of an admitted upload, rejected with 413 as soon as more than max_request_bytes arrived.
+
+        The content length is checked by admit() already, this catches chunked bodies without one. The json handler
+        reads the body again, starlette returns the one stored here.
+        """
+        chunks = []
+        size = 0
+        async for chunk in request.stream():
+            size += len(chunk)
+            if size > self.max_request_bytes:
+                reject(413, "too_large", f"Uploads are limited to {self.max_request_bytes} bytes")
+            chunks.append(chunk)
+        request._body = b"".join(chunks)
+        return request._body
+
+    def charge(self, connection: HTTPConnection, events: int):
+        """Check the number of events of an admitted upload and charge them to its client."""
+        if events > self.max_request_events:
+            reject(413, "too_large", f"Uploads are limited to {self.max_request_events} events")
+        bucket = self.bucket(connection, time.monotonic())
+        if bucket is not None:
+            bucket.charge(events, time.monotonic())
+
+    async def throttle(self, connection: HTTPConnection, events: int):
+        """Charge a batch of a streaming upload, waiting out the client's debt instead of rejecting the batch.
+
+        The stream's window of unacknowledged batches turns the delayed acks into backpressure on the client.
+        """
+        bucket = self.bucket(connection, time.monotonic())
+        if bucket is None:
+            return
+        wait = bucket.wait(time.monotonic())
+        if wait > 0:
+            metrics.ingest_throttled_seconds.inc(wait)
+            await asyncio.sleep(wait)
+        bucket.charge(events, time.monotonic())
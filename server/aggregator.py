@@ -0,0 +1,149 @@
+import asyncio
+import uuid
+from datetime import datetime
+
+import pytz
+from sqlalchemy import bindparam, func, insert, select
+
+import db.models as models
+
+import metrics
+import rolling
+import writer
+
+# sensors whose averages are stored in one transaction
+BATCH_SIZE = 100
+DEFAULT_CONCURRENCY = 2
+
+NEXT_SEQUENCE = (
+    select(func.coalesce(func.max(models.Averages.sequence), 0) + 1)
+    .where(models.Averages.sensor_uuid == bindparam("sequence_sensor_uuid"))
+)
+# the sequence is assigned inside the insert, so concurrent writers can't hand out the same one twice
+INSERT_AVERAGE = insert(models.Averages.__table__).values(sequence=NEXT_SEQUENCE.scalar_subquery())
+
+
+class StoredListener:
+    """Collects the sensors that got new averages until the listener gets to them."""
+
+    def __init__(self):
+        self.sensor_uuids: set[str] = set()
+        self.changed = asyncio.Event()
+
+    def notify(self, sensor_uuids):
+        self.sensor_uuids.update(sensor_uuids)
+        self.changed.set()
+
+    async def wait(self) -> set[str]:
+        await self.changed.wait()
+        self.changed.clear()
+        sensor_uuids, self.sensor_uuids = self.sensor_uuids, set()
+        return sensor_uuids
+
+
+class AverageAggregator:
+    """Stores the rolling averages of sensors with new events in the background, after the ingest responded.
+
+    A sensor is queued at most once, so all requests that arrive while it waits result in a single average.
+    With `reload_windows` the windows are read from the database before every average, for servers with several
+    worker processes whose in-memory windows only contain their own events.
+    """
+
+    def __init__(self, rolling_averages: rolling.RollingAverages, write_pipeline: writer.GroupCommitWriter,
+                 concurrency: int = DEFAULT_CONCURRENCY, reload_windows: bool = False):
+        self.rolling_averages = rolling_averages
+        self.write_pipeline = write_pipeline
+        self.concurrency = concurrency
+        self.reload_windows = reload_windows
+        self.queue: asyncio.Queue[str] = asyncio.Queue()
+        self.dirty: set[str] = set()
+        self.workers: list[asyncio.Task] = []
+        self.listeners: set[StoredListener] = set()
+        # called with the new averages right after their commit
+        self.stored_callbacks: list[callable] = []
+
+    def start(self):
+        self.workers = [asyncio.create_task(self.work()) for _ in range(self.concurrency)]
+
+    def mark_dirty(self, sensor_uuids):
+        for sensor_uuid in sensor_uuids:
+            if sensor_uuid not in self.dirty:
+                self.dirty.add(sensor_uuid)
+                self.queue.put_nowait(sensor_uuid)
+
+    def listen(self) -> StoredListener:
+        listener = StoredListener()
+        self.listeners.add(listener)
+        return listener
+
+    def unlisten(self, listener: StoredListener):
+        self.listeners.discard(listener)
+
+    def pending(self) -> int:
+        return len(self.dirty)
+
+    def take_batch(self, first: str) -> list[str]:
+        batch = [first]
+        while len(batch) < BATCH_SIZE and not self.queue.empty():
+            batch.append(self.queue.get_nowait())
+        # events arriving from now on need another average
+        self.dirty.difference_update(batch)
+        return batch
+
+    async def work(self):
+        while True:
+            batch = self.take_batch(await self.queue.get())
+            try:
+                await self.store_averages(batch)
+            except Exception as e:
+                print("Failed to store averages:", str(e))
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    def calculate(self, sensor_uuids: list[str]) -> list[dict]:
+        calculation_timestamp = datetime.now(pytz.UTC)
+        new_averages = []
+        for sensor_uuid in sensor_uuids:
+            avg = self.rolling_averages.average(sensor_uuid)
+            if avg is None:
+                continue
+            new_averages.append({
+                "average_uuid": uuid.uuid4().hex,
+                "sensor_uuid": sensor_uuid,
+                "calculation_timestamp": calculation_timestamp,
+                "average": avg,
+                "transmitted": False,
+                "sequence_sensor_uuid": sensor_uuid
+            })
+        return new_averages
+
+    async def store_averages(self, sensor_uuids: list[str]):
+        async def write(session) -> list[dict]:
+            if self.reload_windows:
+                await self.rolling_averages.reload(session, sensor_uuids)
+            # calculated by the writer, so the windows contain every event committed before
+            new_averages = self.calculate(sensor_uuids)
+            if new_averages:
+                await session.execute(INSERT_AVERAGE, new_averages)
+            return new_averages
+
+        def committed(new_averages: list[dict]):
+            if not new_averages:
+                return
+            metrics.averages_produced.inc(len(new_averages))
+            for callback in self.stored_callbacks:
+                callback(new_averages)
+            stored_sensor_uuids = [average["sensor_uuid"] for average in new_averages]
+            for listener in self.listeners:
+                listener.notify(stored_sensor_uuids)
+
+        await self.write_pipeline.submit(write, committed)
+
+    async def close(self):
+        """Store the averages of all queued sensors, then stop the workers. Call on shutdown."""
+        await self.queue.join()
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
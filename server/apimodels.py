@@ -1,4 +1,14 @@
-from pydantic import BaseModel
+from typing import Annotated
+
+from pydantic import BaseModel, Field, StringConstraints
+
+# sensors registered with one /createSensors request at most
+MAX_SENSOR_BATCH_SIZE = 10000
+# sensors of one /sensors/latest request at most, without a list it returns all sensors
+MAX_LATEST_SENSORS = 10000
+# uuids as the server and the clients create them (uuid4().hex), the compact schema stores their 16 bytes
+UUID_PATTERN = "^[0-9a-f]{32}$"
+Uuid = Annotated[str, StringConstraints(pattern=UUID_PATTERN)]
 
 
 class SensorRemote(BaseModel):
@@ -11,16 +21,22 @@ class SensorRegisterRemote(BaseModel):
     name: str
 
 
+class SensorBatchRegisterRemote(BaseModel):
+    sensors: list[SensorRegisterRemote] = Field(max_length=MAX_SENSOR_BATCH_SIZE)
+
+
 class EventRemote(BaseModel):
-    event_uuid: str
+    event_uuid: Uuid
     value: float
     unit: str
     timestamp: str
-    sensor_uuid: str
+    sensor_uuid: Uuid
 
 
 class SensorEventDataRequest(BaseModel):
     events: list[EventRemote]
+    # piggybacked acknowledgement: per sensor uuid the highest average sequence the client has stored
+    acked_sequences: dict[Uuid, int] = {}
 
 
 class AverageRemote(BaseModel):
@@ -28,12 +44,86 @@ class AverageRemote(BaseModel):
     average_uuid: str
     average_timestamp: str
     sensor_uuid: str
+    sequence: int | None = None
+
+
+class AggregateRemote(BaseModel):
+    sensor_uuid: str
+    window: str
+    # newest event in the window
+    window_end: str | None
+    calculation_timestamp: str
+    # statistic name -> value, None while the window is empty
+    statistics: dict[str, float | None]
 
 
 class AveragesResponse(BaseModel):
     averages: list[AverageRemote]
     received_event_uuids: list[str]
+    # latest window statistics of the request's sensors
+    aggregates: list[AggregateRemote] = []
 
 
 class AverageReceivedAck(BaseModel):
-    received: list[str]
+    received: list[Uuid]
+
+
+class StreamHello(BaseModel):
+    # first message on /ws/ingest, the server resends the averages after the acked sequences of these sensors
+    sensor_uuids: list[Uuid] = []
+    acked_sequences: dict[Uuid, int] = {}
+
+
+class StreamEvents(SensorEventDataRequest):
+    seq: int
+
+
+class StreamAcked(BaseModel):
+    acked_sequences: dict[Uuid, int]
+
+
+class SeriesPoint(BaseModel):
+    timestamp: str
+    count: int
+    average: float
+    min: float
+    max: float
+    last: float
+
+
+class SeriesResponse(BaseModel):
+    sensor_uuid: str
+    resolution: int
+    points: list[SeriesPoint]
+
+
+class LatestStateRequest(BaseModel):
+    # None for all registered sensors
+    sensor_uuids: list[Uuid] | None = Field(None, max_length=MAX_LATEST_SENSORS)
+
+
+class LatestEvent(BaseModel):
+    event_uuid: str
+    value: float
+    unit: str
+    timestamp: str
+
+
+class LatestAverage(BaseModel):
+    average_uuid: str
+    average: float
+    average_timestamp: str
+
+
+class SensorLatestState(BaseModel):
+    sensor_uuid: str
+    event: LatestEvent | None
+    average: LatestAverage | None
+    # when this server process last stored events of the sensor, None if not since its start
+    ingested_at: str | None
+
+
+class LatestStateResponse(BaseModel):
+    sensors: list[SensorLatestState]
+    # requested sensors that are not registered
+    unknown_sensor_uuids: list[str] = []
@@ -0,0 +1,32 @@
+import gzip
+import hashlib
+
+from starlette.requests import Request
+from starlette.responses import Response
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """Whether the request's If-None-Match contains the etag, the client's copy is current then."""
+    tags = request.headers.get("if-none-match")
+    return tags is not None and (tags.strip() == "*" or etag in (tag.strip().removeprefix("W/")
+                                                                  for tag in tags.split(",")))
+
+
+class StaticAsset:
+    """A file read and gzip compressed once at startup, served from memory with an ETag."""
+
+    def __init__(self, path: str, media_type: str):
+        with open(path, "rb") as f:
+            self.content = f.read()
+        self.media_type = media_type
+        self.compressed = gzip.compress(self.content, compresslevel=9)
+        self.etag = f'"{hashlib.sha1(self.content).hexdigest()}"'
+
+    def response(self, request: Request) -> Response:
+        headers = {"ETag": self.etag, "Vary": "Accept-Encoding", "Cache-Control": "no-cache"}
+        if etag_matches(request, self.etag):
+            return Response(status_code=304, headers=headers)
+        if "gzip" in request.headers.get("accept-encoding", ""):
+            return Response(self.compressed, media_type=self.media_type,
+                            headers=dict(headers, **{"Content-Encoding": "gzip"}))
+        return Response(self.content, media_type=self.media_type, headers=headers)
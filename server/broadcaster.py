@@ -0,0 +1,227 @@
+import asyncio
+
+from sqlalchemy import func, literal_column
+from sqlalchemy.future import select
+
+import db.models as models
+import db.database as database
+
+# how often a sensor's producer looks for new rows
+POLL_INTERVAL_SECONDS = 2
+# rows of each kind a new subscriber receives before it only gets deltas
+SNAPSHOT_SIZE = 500
+# messages buffered per subscriber, a subscriber that falls further behind gets a new snapshot instead
+SUBSCRIBER_QUEUE_SIZE = 32
+
+ROWID = literal_column("rowid")
+# position of a row among the rows of its sensor, the order they were committed in. Events are found by rowid in
+# ix_events_sensor, averages by their sequence in ix_averages_sensor_sequence
+EVENT_POSITION = ROWID
+AVERAGE_POSITION = models.Averages.sequence
+
+
+def snapshot_query(model, timestamp, position, sensor_uuid: str):
+    """The newest rows of a sensor with their positions, walking its (sensor_uuid, timestamp) index backwards."""
+    return (
+        select(model, position)
+        .where(model.sensor_uuid == sensor_uuid)
+        .order_by(timestamp.desc())
+        .limit(SNAPSHOT_SIZE)
+    )
+
+
+def delta_query(model, position, sensor_uuid: str, after: int):
+    """The rows of a sensor stored after the position `after`, in the order they were stored."""
+    return select(model, position).where(model.sensor_uuid == sensor_uuid, position > after).order_by(position)
+
+
+def event_message(event: models.Event) -> dict:
+    return {"timestamp": event.timestamp.isoformat(), "value": event.value}
+
+
+def average_message(average: models.Averages) -> dict:
+    return {"average_uuid": average.average_uuid, "timestamp": average.calculation_timestamp.isoformat(),
+            "value": average.average, "transmitted": average.transmitted}
+
+
+class Subscription:
+    def __init__(self):
+        self.queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        self.resnapshots = 0
+
+    def push(self, message: dict) -> bool:
+        """Queue a delta, False if the subscriber is too far behind and needs a new snapshot."""
+        if self.queue.full():
+            # a delta can't be dropped without losing its rows, the snapshot replaces everything queued
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.resnapshots += 1
+            return False
+        self.queue.put_nowait(message)
+        return True
+
+
+class SensorBroadcaster:
+    """Polls the new rows of one sensor once per interval and fans them out to all subscribers.
+
+    The lock is held while the watermarks move and the deltas are pushed, while a subscriber takes its snapshot
+    and while the producer decides to stop, so every row reaches a subscriber exactly once: in its snapshot or in
+    a delta. A stopped broadcaster is closed, subscribing to it returns None.
+    """
+
+    def __init__(self, sensor_uuid: str, on_idle):
+        self.sensor_uuid = sensor_uuid
+        self.subscriptions: set[Subscription] = set()
+        # positions of the newest rows already fanned out
+        self.event_position = 0
+        self.average_position = 0
+        self.untransmitted_averages: set[str] = set()
+        self.on_idle = on_idle
+        self.lock = asyncio.Lock()
+        self.task = None
+        self.closed = False
+
+    async def subscribe(self) -> tuple[Subscription, dict] | None:
+        async with self.lock:
+            if self.closed:
+                return None
+            async with database.SessionLocal() as session:
+                if self.task is None:
+                    await self.load_watermarks(session)
+                    self.task = asyncio.create_task(self.produce())
+                # everything up to the current watermarks is in the snapshot, everything after arrives as delta
+                snapshot = await self.snapshot(session, self.event_position, self.average_position)
+            subscription = Subscription()
+            self.subscriptions.add(subscription)
+        return subscription, snapshot
+
+    def unsubscribe(self, subscription: Subscription):
+        self.subscriptions.discard(subscription)
+
+    async def load_watermarks(self, session):
+        event_position = await session.execute(
+            select(func.max(EVENT_POSITION)).select_from(models.Event)
+            .where(models.Event.sensor_uuid == self.sensor_uuid)
+        )
+        average_position = await session.execute(
+            select(func.max(AVERAGE_POSITION)).where(models.Averages.sensor_uuid == self.sensor_uuid)
+        )
+        untransmitted = await session.execute(
+            select(models.Averages.average_uuid)
+            .where(models.Averages.sensor_uuid == self.sensor_uuid, models.Averages.transmitted == False)
+        )
+        self.event_position = event_position.scalar() or 0
+        self.average_position = average_position.scalar() or 0
+        self.untransmitted_averages = set(untransmitted.scalars().all())
+
+    async def snapshot(self, session, event_position: int, average_position: int) -> dict:
+        events = await session.execute(
+            snapshot_query(models.Event, models.Event.timestamp, EVENT_POSITION, self.sensor_uuid)
+        )
+        averages = await session.execute(
+            snapshot_query(models.Averages, models.Averages.calculation_timestamp, AVERAGE_POSITION, self.sensor_uuid)
+        )
+        # rows above the watermarks are sent as the next delta, filtered here so the query can walk the time index
+        return {
+            "type": "snapshot",
+            "events": [event_message(event) for event, position in events if position <= event_position],
+            # averages of versions before the sequence have none, they are older than all others
+            "averages": [average_message(average) for average, position in averages
+                         if (position or 0) <= average_position],
+        }
+
+    async def poll(self, session) -> dict | None:
+        events_result = await session.execute(
+            delta_query(models.Event, EVENT_POSITION, self.sensor_uuid, self.event_position)
+        )
+        averages_result = await session.execute(
+            delta_query(models.Averages, AVERAGE_POSITION, self.sensor_uuid, self.average_position)
+        )
+        events = events_result.all()
+        averages = averages_result.all()
+        untransmitted = self.untransmitted_averages | {average.average_uuid for average, _ in averages
+                                                       if not average.transmitted}
+
+        # averages are acknowledged by updating existing rows, which the watermarks cannot see
+        transmitted = []
+        if untransmitted:
+            pending_result = await session.execute(
+                select(models.Averages.average_uuid)
+                .where(models.Averages.sensor_uuid == self.sensor_uuid, models.Averages.transmitted == False)
+            )
+            pending = set(pending_result.scalars().all())
+            transmitted = list(untransmitted - pending)
+            untransmitted &= pending
+
+        # moved once every query succeeded, a failed poll is repeated from the same watermarks
+        if events:
+            self.event_position = events[-1][1]
+        if averages:
+            self.average_position = averages[-1][1]
+        self.untransmitted_averages = untransmitted
+        if not events and not averages and not transmitted:
+            return None
+        return {
+            "type": "delta",
+            "events": [event_message(event) for event, _ in events],
+            "averages": [average_message(average) for average, _ in averages],
+            "transmitted_averages": transmitted,
+        }
+
+    async def produce(self):
+        try:
+            while True:
+                await asyncio.sleep(POLL_INTERVAL_SECONDS)
+                async with self.lock:
+                    if not self.subscriptions:
+                        self.closed = True
+                        self.on_idle(self)
+                        return
+                    try:
+                        async with database.SessionLocal() as session:
+                            delta = await self.poll(session)
+                            if delta is None:
+                                continue
+                            behind = [subscription for subscription in self.subscriptions
+                                      if not subscription.push(delta)]
+                            if behind:
+                                snapshot = await self.snapshot(session, self.event_position, self.average_position)
+                                for subscription in behind:
+                                    subscription.queue.put_nowait(snapshot)
+                    except Exception as e:
+                        print("Broadcaster poll error: " + str(e))
+        finally:
+            self.task = None
+
+
+class BroadcastHub:
+    """One broadcaster per sensor that has at least one websocket subscriber."""
+
+    def __init__(self):
+        self.broadcasters: dict[str, SensorBroadcaster] = {}
+
+    def broadcaster(self, sensor_uuid: str) -> SensorBroadcaster:
+        if sensor_uuid not in self.broadcasters:
+            self.broadcasters[sensor_uuid] = SensorBroadcaster(sensor_uuid, self._remove)
+        return self.broadcasters[sensor_uuid]
+
+    async def subscribe(self, sensor_uuid: str) -> tuple[SensorBroadcaster, Subscription, dict]:
+        while True:
+            broadcaster = self.broadcaster(sensor_uuid)
+            subscribed = await broadcaster.subscribe()
+            # closed while the subscriber waited for its lock, the next one is already registered
+            if subscribed is not None:
+                return broadcaster, *subscribed
+
+    def _remove(self, broadcaster: SensorBroadcaster):
+        if self.broadcasters.get(broadcaster.sensor_uuid) is broadcaster:
+            del self.broadcasters[broadcaster.sensor_uuid]
+
+    def subscriber_count(self) -> int:
+        return sum(len(broadcaster.subscriptions) for broadcaster in self.broadcasters.values())
+
+    async def close(self):
+        tasks = [broadcaster.task for broadcaster in self.broadcasters.values() if broadcaster.task]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -1,28 +1,78 @@
-from sqlalchemy import Boolean, Column, ForeignKey, Integer, String, DateTime, Uuid, Float
+from sqlalchemy import Boolean, Column, ForeignKey, Integer, String, Uuid, Float, Index, JSON
 
-from server.db.database import Base
+from server.db.database import Base, SCHEMA
+from server.db.types import SCHEMA_TYPES
+
+# hex text and datetime text, or blobs and integers with the compact schema
+UuidType, Timestamp = SCHEMA_TYPES[SCHEMA]
+COMPACT = SCHEMA == "compact"
 
 
 class Event(Base):
     __tablename__ = "events"
-    event_uuid = Column(String, primary_key=True)
+    event_uuid = Column(UuidType, primary_key=True)
     value = Column(Integer)
     unit = Column(String)
-    timestamp = Column(DateTime)
-    sensor_uuid = Column(String, ForeignKey("sensors.sensor_uuid"))
+    timestamp = Column(Timestamp)
+    sensor_uuid = Column(UuidType, ForeignKey("sensors.sensor_uuid"))
+
+    __table_args__ = (
+        # newest events of a sensor (rolling window warm up, websocket snapshot)
+        Index("ix_events_sensor_timestamp", "sensor_uuid", "timestamp"),
+        # events of a sensor above a rowid watermark (websocket deltas)
+        Index("ix_events_sensor", "sensor_uuid"),
+    )
 
 
 class Sensor(Base):
     __tablename__ = "sensors"
-    sensor_uuid = Column(String, primary_key=True)
+    sensor_uuid = Column(UuidType, primary_key=True)
     sensor_type = Column(String)
     sensor_name = Column(String)
 
 
 class Averages(Base):
     __tablename__ = "averages"
-    average_uuid = Column(String, primary_key=True)
+    average_uuid = Column(UuidType, primary_key=True)
     average = Column(Float)
-    calculation_timestamp = Column(DateTime)
+    calculation_timestamp = Column(Timestamp)
     transmitted = Column(Boolean)
-    sensor_uuid = Column(String, ForeignKey("sensors.sensor_uuid"))
+    sensor_uuid = Column(UuidType, ForeignKey("sensors.sensor_uuid"))
+    # per sensor position of the average, clients acknowledge all averages up to a sequence at once
+    sequence = Column(Integer)
+
+    __table_args__ = (
+        # averages of a sensor by time (websocket snapshot)
+        Index("ix_averages_sensor_timestamp", "sensor_uuid", "calculation_timestamp"),
+        # next sequence of a sensor
+        Index("ix_averages_sensor_sequence", "sensor_uuid", "sequence"),
+        # untransmitted averages of a sensor, only contains the few rows still waiting for an ack,
+        # an ack up to a sequence touches only those. transmitted is always false in here, as a column it makes
+        # the index match one more term than the others on sensor_uuid, so sqlite picks it without statistics
+        Index("ix_averages_untransmitted_sensor", "sensor_uuid", "transmitted", "sequence",
+              sqlite_where=transmitted == False),
+    )
+
+
+class Rollup(Base):
+    __tablename__ = "rollups"
+    sensor_uuid = Column(UuidType, ForeignKey("sensors.sensor_uuid"), primary_key=True)
+    resolution = Column(Integer, primary_key=True)  # bucket length in seconds
+    bucket_start = Column(Timestamp, primary_key=True)
+    count = Column(Integer)
+    sum = Column(Float)
+    min = Column(Float)
+    max = Column(Float)
+    last = Column(Float)
+    last_timestamp = Column(Timestamp)
+
+
+class Aggregate(Base):
+    """Latest statistics over a window of a sensor's newest events, see window_stats.py."""
+    __tablename__ = "aggregates"
+    sensor_uuid = Column(UuidType, ForeignKey("sensors.sensor_uuid"), primary_key=True)
+    window = Column(String, primary_key=True)  # name in window_stats.WINDOWS
+    # statistic name -> value, the values are null while the window is empty
+    statistics = Column(JSON)
+    window_end = Column(Timestamp)  # timestamp of the newest event in the window
+    calculation_timestamp = Column(Timestamp)
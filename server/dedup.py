@@ -0,0 +1,57 @@
+from collections import OrderedDict
+
+from sqlalchemy import literal_column
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+
+import db.models as models
+
+import metrics
+
+# event uuids remembered per process, about 200 bytes each
+DEFAULT_CAPACITY = 100_000
+
+
+def newest_events_query(limit: int):
+    """The uuids of the newest stored events, walking the table backwards by rowid without sorting."""
+    return select(models.Event.event_uuid).order_by(literal_column("rowid").desc()).limit(limit)
+
+
+class RecentEvents:
+    """The uuids of the most recently stored events, least recently seen evicted first.
+
+    Only committed events are added, so a hit is always an event that is stored and can be acked without touching
+    sqlite. A miss is no proof of a new event: it may have been evicted or stored by another worker process, so
+    misses still go through `INSERT OR IGNORE`.
+    """
+
+    def __init__(self, capacity: int = DEFAULT_CAPACITY):
+        self.capacity = capacity
+        self.event_uuids: OrderedDict[str, None] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self.event_uuids)
+
+    async def warm(self, db: AsyncSession):
+        """Load the newest stored events, so retransmissions right after a restart are caught as well."""
+        result = await db.execute(newest_events_query(self.capacity))
+        # oldest first, so the newest are evicted last
+        self.add(reversed(result.scalars().all()))
+
+    def add(self, event_uuids):
+        for event_uuid in event_uuids:
+            self.event_uuids[event_uuid] = None
+            self.event_uuids.move_to_end(event_uuid)
+        while len(self.event_uuids) > self.capacity:
+            self.event_uuids.popitem(last=False)
+
+    def new_rows(self, rows: list[dict]) -> list[dict]:
+        """The rows whose events are not known to be stored."""
+        new_rows = []
+        for row in rows:
+            if row["event_uuid"] in self.event_uuids:
+                self.event_uuids.move_to_end(row["event_uuid"])
+            else:
+                new_rows.append(row)
+        metrics.dedup_cache_hits.inc(len(rows) - len(new_rows))
+        return new_rows
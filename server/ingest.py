@@ -0,0 +1,38 @@
+from datetime import datetime
+
+from sqlalchemy import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import db.models as models
+
+import apimodels
+
+
+def event_rows(events: list[apimodels.EventRemote]) -> list[dict]:
+    """Convert a request batch to insert parameters, parsing all timestamps in one pass."""
+    parse_timestamp = datetime.fromisoformat
+    rows = {}
+    for event in events:
+        # a batch may contain the same event twice if the client retried mid-request
+        if event.event_uuid in rows:
+            continue
+        rows[event.event_uuid] = {
+            "event_uuid": event.event_uuid,
+            "value": event.value,
+            "unit": event.unit,
+            "sensor_uuid": event.sensor_uuid,
+            "timestamp": parse_timestamp(event.timestamp),
+        }
+    return list(rows.values())
+
+
+async def insert_events(db: AsyncSession, rows: list[dict]) -> set[str]:
+    """Insert all rows with multi-row statements and return the uuids that were not stored before."""
+    if not rows:
+        return set()
+    # ignore on conflict in case of retransmitted events because of lost acks
+    result = await db.execute(
+        insert(models.Event).prefix_with("OR IGNORE").returning(models.Event.event_uuid),
+        rows
+    )
+    return set(result.scalars().all())
@@ -0,0 +1,115 @@
+from datetime import datetime
+
+import pytz
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+from sqlalchemy.orm import aliased
+
+import db.models as models
+
+
+def utc(timestamp: datetime) -> datetime:
+    # the database returns naive UTC timestamps
+    return timestamp.astimezone(pytz.UTC) if timestamp.tzinfo else timestamp.replace(tzinfo=pytz.UTC)
+
+
+def newest_event_query(sensor_uuids: list[str] | None):
+    """The newest event of every sensor, one lookup in ix_events_sensor_timestamp per sensor."""
+    newer = aliased(models.Event)
+    newest = (
+        select(newer.event_uuid)
+        .where(newer.sensor_uuid == models.Sensor.sensor_uuid)
+        .order_by(newer.timestamp.desc())
+        .limit(1)
+        .correlate(models.Sensor)
+        .scalar_subquery()
+    )
+    query = select(models.Event).join(models.Sensor, models.Event.event_uuid == newest)
+    return query if sensor_uuids is None else query.where(models.Sensor.sensor_uuid.in_(sensor_uuids))
+
+
+def newest_average_query(sensor_uuids: list[str] | None):
+    """The newest average of every sensor, one lookup in ix_averages_sensor_timestamp per sensor."""
+    newer = aliased(models.Averages)
+    newest = (
+        select(newer.average_uuid)
+        .where(newer.sensor_uuid == models.Sensor.sensor_uuid)
+        .order_by(newer.calculation_timestamp.desc())
+        .limit(1)
+        .correlate(models.Sensor)
+        .scalar_subquery()
+    )
+    query = select(models.Averages).join(models.Sensor, models.Averages.average_uuid == newest)
+    return query if sensor_uuids is None else query.where(models.Sensor.sensor_uuid.in_(sensor_uuids))
+
+
+class LatestState:
+    """The newest event, the newest average and the time of the last ingest per sensor, in memory.
+
+    Updated by the ingest and the aggregator right after their commits, so reading the state of thousands of sensors
+    is a dict lookup per sensor. The entries are kept as the dicts of the response, their timestamps are formatted
+    once when they are stored instead of on every read. Late events older than the stored one don't replace it.
+    The time of the last ingest is that of this process, it is not known for the events loaded at startup.
+    """
+
+    def __init__(self):
+        # sensor uuid -> (timestamp, response dict)
+        self.events: dict[str, tuple[datetime, dict]] = {}
+        self.averages: dict[str, tuple[datetime, dict]] = {}
+        self.ingested: dict[str, str] = {}
+
+    async def load(self, db: AsyncSession, sensor_uuids: list[str] | None = None):
+        """Load the newest event and average of the sensors (all without sensor_uuids) from the database."""
+        for event in (await db.execute(newest_event_query(sensor_uuids))).scalars():
+            # the value column is declared as integer, sqlite returns what was stored
+            self.set_event(event.sensor_uuid, utc(event.timestamp), event.event_uuid, float(event.value), event.unit)
+        for average in (await db.execute(newest_average_query(sensor_uuids))).scalars():
+            self.set_average(average.sensor_uuid, utc(average.calculation_timestamp), average.average_uuid,
+                             average.average)
+
+    def set_event(self, sensor_uuid: str, timestamp: datetime, event_uuid: str, value: float, unit: str):
+        current = self.events.get(sensor_uuid)
+        if current is None or timestamp >= current[0]:
+            self.events[sensor_uuid] = (timestamp, {"event_uuid": event_uuid, "value": value, "unit": unit,
+                                                    "timestamp": timestamp.isoformat()})
+
+    def set_average(self, sensor_uuid: str, timestamp: datetime, average_uuid: str, average: float):
+        current = self.averages.get(sensor_uuid)
+        if current is None or timestamp >= current[0]:
+            self.averages[sensor_uuid] = (timestamp, {"average_uuid": average_uuid, "average": average,
+                                                      "average_timestamp": timestamp.isoformat()})
+
+    def add_events(self, rows: list[dict], ingested_at: datetime):
+        """Committed event rows, as inserted by ingest.insert_events()."""
+        newest = {}
+        for row in rows:
+            timestamp = utc(row["timestamp"])
+            current = newest.get(row["sensor_uuid"])
+            if current is None or timestamp >= current[0]:
+                newest[row["sensor_uuid"]] = (timestamp, row)
+        ingested_at = ingested_at.isoformat()
+        for sensor_uuid, (timestamp, row) in newest.items():
+            self.set_event(sensor_uuid, timestamp, row["event_uuid"], row["value"], row["unit"])
+            self.ingested[sensor_uuid] = ingested_at
+
+    def add_averages(self, averages: list[dict]):
+        """Committed averages, as calculated by aggregator.AverageAggregator."""
+        for average in averages:
+            self.set_average(average["sensor_uuid"], utc(average["calculation_timestamp"]), average["average_uuid"],
+                             average["average"])
+
+    def read(self, sensor_uuids: list[str]) -> list[dict]:
+        events = self.events
+        averages = self.averages
+        ingested = self.ingested
+        states = []
+        for sensor_uuid in sensor_uuids:
+            event = events.get(sensor_uuid)
+            average = averages.get(sensor_uuid)
+            states.append({
+                "sensor_uuid": sensor_uuid,
+                "event": event[1] if event is not None else None,
+                "average": average[1] if average is not None else None,
+                "ingested_at": ingested.get(sensor_uuid),
+            })
+        return states
@@ -0,0 +1,187 @@
+import bisect
+import threading
+import time
+
+from sqlalchemy import event
+
+# latency buckets in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# write jobs per group commit
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+
+def _format_labels(labelnames: tuple, labels: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(labelnames, labels)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.values = {}
+
+    def inc(self, amount: float = 1, labels: tuple = ()):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        lines += [f"{self.name}{_format_labels(self.labelnames, labels)} {value}"
+                  for labels, value in self.values.items()]
+        return lines
+
+
+class Gauge:
+    """A value that is set directly, or read from `function` on every scrape."""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), function=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.function = function
+        self.values = {}
+
+    def set(self, value: float, labels: tuple = ()):
+        self.values[labels] = value
+
+    def inc(self, amount: float = 1, labels: tuple = ()):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, amount: float = 1, labels: tuple = ()):
+        self.inc(-amount, labels)
+
+    def render(self) -> list[str]:
+        if self.function is not None:
+            self.values[()] = self.function()
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge"]
+        lines += [f"{self.name}{_format_labels(self.labelnames, labels)} {value}"
+                  for labels, value in self.values.items()]
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        # per label set: [counts per bucket + overflow, sum]
+        self.values = {}
+        # observations from the aiosqlite threads and the event loop must not interleave
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, labels: tuple = ()):
+        with self.lock:
+            series = self.values.get(labels)
+            if series is None:
+                series = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            snapshot = [(labels, list(counts), total) for labels, (counts, total) in self.values.items()]
+        for labels, counts, total in snapshot:
+            label_text = _format_labels(self.labelnames, labels)
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                bucket_labels = _format_labels(self.labelnames, labels, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{self.name}_sum{label_text} {total}")
+            lines.append(f"{self.name}_count{label_text} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(line for metric in self.metrics for line in metric.render()) + "\n"
+
+
+registry = Registry()
+
+request_latency = registry.register(Histogram(
+    "fog_http_request_duration_seconds", "HTTP request latency per route.", ("method", "route", "status")))
+events_ingested = registry.register(Counter(
+    "fog_events_ingested_total", "Sensor events stored for the first time."))
+events_deduplicated = registry.register(Counter(
+    "fog_events_deduplicated_total", "Retransmitted sensor events that were already stored."))
+dedup_cache_hits = registry.register(Counter(
+    "fog_dedup_cache_hits_total", "Retransmitted sensor events acked from the recent event cache without sqlite."))
+events_rejected = registry.register(Counter(
+    "fog_events_rejected_total", "Sensor events rejected because their sensor is not registered."))
+ingest_rejected = registry.register(Counter(
+    "fog_ingest_rejected_total", "Uploads rejected by the admission control.", ("reason",)))
+ingest_throttled_seconds = registry.register(Counter(
+    "fog_ingest_throttled_seconds_total", "Time streaming uploads waited for their client's event rate."))
+ingest_in_flight = registry.register(Gauge(
+    "fog_ingest_in_flight", "Uploads being handled by this process."))
+averages_produced = registry.register(Counter(
+    "fog_averages_produced_total", "Averages calculated and stored."))
+averages_queued = registry.register(Gauge(
+    "fog_averages_queued_sensors", "Sensors with new events waiting for the background aggregator."))
+averages_pending = registry.register(Gauge(
+    "fog_averages_pending", "Averages not yet acknowledged by the clients."))
+statement_duration = registry.register(Histogram(
+    "fog_db_statement_duration_seconds", "SQL statement latency including the aiosqlite queue wait.", ("statement",)))
+websocket_subscribers = registry.register(Gauge(
+    "fog_websocket_subscribers", "Open dashboard websocket connections."))
+ingest_streams = registry.register(Gauge(
+    "fog_ingest_streams", "Open streaming upload connections."))
+aiosqlite_queue_wait = registry.register(Histogram(
+    "fog_db_aiosqlite_queue_wait_seconds", "Time between submitting a statement and sqlite starting to execute it."))
+writer_batch_size = registry.register(Histogram(
+    "fog_writer_batch_size", "Write jobs committed together in one transaction.", buckets=BATCH_SIZE_BUCKETS))
+writer_commit_duration = registry.register(Histogram(
+    "fog_writer_commit_duration_seconds", "Duration of a group commit transaction, from begin to commit."))
+writer_queued = registry.register(Gauge(
+    "fog_writer_queued_jobs", "Write jobs waiting for the next group commit."))
+window_statistics_queued = registry.register(Gauge(
+    "fog_window_statistics_queued_sensors", "Sensors with new events waiting for their window statistics."))
+window_statistics_duration = registry.register(Histogram(
+    "fog_window_statistics_duration_seconds", "Time to load and compute the window statistics of a batch of sensors."))
+
+
+def instrument_engine(engine):
+    """Time every statement of an async engine, and how long it waited for the aiosqlite thread."""
+    sync_engine = engine.sync_engine
+
+    @event.listens_for(sync_engine, "connect")
+    def trace_statement_start(dbapi_connection, connection_record):
+        # sqlite calls the trace callback from the aiosqlite thread when a statement starts executing
+        started = connection_record.info["metrics_started"] = [None]
+
+        def trace(statement):
+            if started[0] is None:
+                started[0] = time.perf_counter()
+
+        dbapi_connection.await_(dbapi_connection.driver_connection.set_trace_callback(trace))
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        started = conn.connection._connection_record.info.get("metrics_started")
+        if started is not None:
+            started[0] = None
+        conn.info["metrics_submitted"] = time.perf_counter()
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        now = time.perf_counter()
+        submitted = conn.info.pop("metrics_submitted", None)
+        if submitted is None:
+            return
+        statement_duration.observe(now - submitted, (statement.lstrip().split(" ", 1)[0].upper(),))
+        started = conn.connection._connection_record.info.get("metrics_started")
+        if started is not None and started[0] is not None:
+            aiosqlite_queue_wait.observe(max(started[0] - submitted, 0.0))
@@ -0,0 +1,77 @@
+from sqlalchemy import literal_column
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+
+import db.models as models
+
+ROWID = literal_column("rowid")
+# session.info key of the highest rowid read_new() returned in the session's transaction
+READ_ROWID = "registry_read_rowid"
+
+
+def new_sensors_query(rowid: int):
+    """The sensors stored after `rowid`, a range scan of the rowid."""
+    return (
+        select(ROWID, models.Sensor.sensor_uuid, models.Sensor.sensor_type, models.Sensor.sensor_name)
+        .where(ROWID > rowid)
+        .order_by(ROWID)
+    )
+
+
+class SensorRegistry:
+    """All registered sensors in memory, in registration (rowid) order.
+
+    Sensors are never updated or deleted, so the highest rowid loaded identifies the whole list of a database. With
+    the uuid of the newest sensor, which differs in a recreated database of as many sensors, it is the ETag of
+    `/sensors`. New sensors are read with a rowid range scan after every registration, which also picks up sensors
+    registered by other worker processes in between. The registrations of one group commit batch continue the scan
+    where the previous one stopped, so every new row is read once per batch.
+    """
+
+    def __init__(self):
+        self.sensors: list[dict] = []
+        self.positions: dict[str, int] = {}
+        self.last_rowid = 0
+
+    def __len__(self) -> int:
+        return len(self.sensors)
+
+    def __contains__(self, sensor_uuid: str) -> bool:
+        return sensor_uuid in self.positions
+
+    @property
+    def etag(self) -> str:
+        newest = self.sensors[-1]["sensor_uuid"] if self.sensors else ""
+        return f'"sensors-{self.last_rowid}-{newest}"'
+
+    async def read_new(self, db: AsyncSession) -> list[tuple]:
+        """Sensors stored after the last loaded one, (rowid, uuid, type, name) in rowid order.
+
+        Within a transaction, only the sensors after those an earlier call returned: the rows are added once it is
+        committed, in the order of the calls. A failed transaction takes its session, and the position, with it.
+        """
+        rowid = max(db.info.get(READ_ROWID, 0), self.last_rowid)
+        rows = (await db.execute(new_sensors_query(rowid))).all()
+        if rows:
+            db.info[READ_ROWID] = rows[-1][0]
+        return rows
+
+    def add(self, rows: list[tuple]):
+        """Add the rows of read_new(), rows that were added before already are skipped."""
+        for rowid, sensor_uuid, sensor_type, sensor_name in rows:
+            if rowid <= self.last_rowid:
+                continue
+            self.positions[sensor_uuid] = len(self.sensors)
+            self.sensors.append({"sensor_uuid": sensor_uuid, "sensor_type": sensor_type, "sensor_name": sensor_name})
+            self.last_rowid = rowid
+
+    async def refresh(self, db: AsyncSession):
+        self.add(await self.read_new(db))
+
+    def page(self, after: str | None, skip: int, limit: int) -> list[dict]:
+        """Keyset page: the sensors registered after the sensor `after`, or offset paging without it."""
+        start = skip if after is None else self.positions[after] + 1
+        return self.sensors[start:start + limit]
+
+    def unknown(self, sensor_uuids) -> set[str]:
+        return {sensor_uuid for sensor_uuid in sensor_uuids if sensor_uuid not in self.positions}
@@ -0,0 +1,124 @@
+import bisect
+from collections import deque
+from datetime import datetime
+
+from sqlalchemy import union_all
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+
+import db.models as models
+
+# number of most recent events the average of a sensor is calculated over, per sensor type
+WINDOW_SIZES = {
+    "temperature": 10,
+    "humidity": 10,
+}
+DEFAULT_WINDOW_SIZE = 10
+# sensors whose newest events are read in one statement, sqlite allows at most 500 selects in a compound select
+WARM_BATCH_SIZE = 200
+
+
+def newest_events_query(window_sizes: dict[str, int]):
+    """The newest events of the sensors, as many as their window size.
+
+    One index range in ix_events_sensor_timestamp per sensor, a window function would read all events of the sensors.
+    """
+    newest = [
+        select(models.Event.event_uuid, models.Event.sensor_uuid, models.Event.timestamp, models.Event.value)
+        .where(models.Event.sensor_uuid == sensor_uuid)
+        .order_by(models.Event.timestamp.desc())
+        .limit(size)
+        .subquery()
+        for sensor_uuid, size in window_sizes.items()
+    ]
+    return union_all(*[select(subquery) for subquery in newest])
+
+
+class RollingWindow:
+    """The most recent events of one sensor ordered by timestamp, with a running sum of their values."""
+
+    def __init__(self, size: int):
+        self.size = size
+        self.entries = deque()  # (timestamp, event_uuid, value), oldest first
+        self.event_uuids = set()
+        self.total = 0.0
+
+    def add(self, event_uuid: str, timestamp: datetime, value: float) -> bool:
+        if event_uuid in self.event_uuids:
+            return False
+        # the database stores naive timestamps, compare the same way it orders them
+        entry = (timestamp.replace(tzinfo=None), event_uuid, value)
+        if len(self.entries) >= self.size and entry < self.entries[0]:
+            # older than everything in a full window, cannot change the average
+            return False
+        if not self.entries or entry >= self.entries[-1]:
+            self.entries.append(entry)
+        else:
+            # late event, insert at its position in time
+            self.entries.insert(bisect.bisect_right(self.entries, entry), entry)
+        self.event_uuids.add(event_uuid)
+        self.total += value
+        while len(self.entries) > self.size:
+            _, evicted_uuid, evicted_value = self.entries.popleft()
+            self.event_uuids.discard(evicted_uuid)
+            self.total -= evicted_value
+        return True
+
+    def average(self) -> float | None:
+        if not self.entries:
+            return None
+        return self.total / len(self.entries)
+
+
+class RollingAverages:
+    """Rolling windows of all sensors, kept up to date on ingest instead of re-querying the events table."""
+
+    def __init__(self, window_sizes: dict[str, int] = None, default_window_size: int = DEFAULT_WINDOW_SIZE):
+        self.window_sizes = WINDOW_SIZES if window_sizes is None else window_sizes
+        self.default_window_size = default_window_size
+        self.windows: dict[str, RollingWindow] = {}
+
+    def window_size(self, sensor_type: str | None) -> int:
+        return self.window_sizes.get(sensor_type, self.default_window_size)
+
+    def register_sensor(self, sensor_uuid: str, sensor_type: str | None):
+        if sensor_uuid not in self.windows:
+            self.windows[sensor_uuid] = RollingWindow(self.window_size(sensor_type))
+
+    def add_events(self, rows):
+        for row in rows:
+            # sensors registered by another process get the default window size
+            self.register_sensor(row["sensor_uuid"], None)
+            self.windows[row["sensor_uuid"]].add(row["event_uuid"], row["timestamp"], row["value"])
+
+    def average(self, sensor_uuid: str) -> float | None:
+        window = self.windows.get(sensor_uuid)
+        return window.average() if window else None
+
+    async def load(self, db: AsyncSession, sensor_uuids: list[str]):
+        for start in range(0, len(sensor_uuids), WARM_BATCH_SIZE):
+            batch = sensor_uuids[start:start + WARM_BATCH_SIZE]
+            result = await db.execute(newest_events_query({
+                sensor_uuid: self.windows[sensor_uuid].size for sensor_uuid in batch
+            }))
+            self.add_events(row._mapping for row in result)
+
+    async def warm(self, db: AsyncSession):
+        sensors = await db.execute(select(models.Sensor.sensor_uuid, models.Sensor.sensor_type))
+        for sensor_uuid, sensor_type in sensors:
+            self.windows[sensor_uuid] = RollingWindow(self.window_size(sensor_type))
+        await self.load(db, list(self.windows))
+
+    async def reload(self, db: AsyncSession, sensor_uuids: list[str]):
+        """Replace the windows of the sensors with their newest stored events.
+
+        With several worker processes, every process only sees the events it ingested itself.
+        """
+        result = await db.execute(
+            select(models.Sensor.sensor_uuid, models.Sensor.sensor_type)
+            .where(models.Sensor.sensor_uuid.in_(sensor_uuids))
+        )
+        sensor_types = dict(result.all())
+        for sensor_uuid in sensor_uuids:
+            self.windows[sensor_uuid] = RollingWindow(self.window_size(sensor_types.get(sensor_uuid)))
+        await self.load(db, sensor_uuids)
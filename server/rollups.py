@@ -0,0 +1,125 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import case, func, text
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncSession
+from sqlalchemy.future import select
+
+import db.models as models
+
+import apimodels
+
+# bucket lengths in seconds: minute, hour, day
+RESOLUTIONS = [60, 3600, 86400]
+EPOCH = datetime(1970, 1, 1)
+# sql of an event's epoch seconds and of a bucket start from epoch seconds, in the format of the storage schema
+if models.COMPACT:
+    EPOCH_SECONDS_SQL = "timestamp / 1000000"
+    BUCKET_START_SQL = "{} * 1000000"
+else:
+    EPOCH_SECONDS_SQL = "CAST(strftime('%s', timestamp) AS INTEGER)"
+    BUCKET_START_SQL = "strftime('%Y-%m-%d %H:%M:%S.000000', {}, 'unixepoch')"
+
+
+def bucket_start(timestamp: datetime, resolution: int) -> datetime:
+    # buckets are aligned to the epoch, timestamps are stored naive like the events
+    timestamp = timestamp.replace(tzinfo=None)
+    seconds = int((timestamp - EPOCH).total_seconds())
+    return EPOCH + timedelta(seconds=seconds - seconds % resolution)
+
+
+def bucket_rows(rows) -> list[dict]:
+    """Aggregate events per sensor, resolution and bucket, so every bucket is one upsert."""
+    buckets = {}
+    for row in rows:
+        timestamp = row["timestamp"].replace(tzinfo=None)
+        value = row["value"]
+        for resolution in RESOLUTIONS:
+            key = (row["sensor_uuid"], resolution, bucket_start(timestamp, resolution))
+            bucket = buckets.get(key)
+            if bucket is None:
+                buckets[key] = {
+                    "sensor_uuid": key[0], "resolution": resolution, "bucket_start": key[2],
+                    "count": 1, "sum": value, "min": value, "max": value,
+                    "last": value, "last_timestamp": timestamp,
+                }
+                continue
+            bucket["count"] += 1
+            bucket["sum"] += value
+            bucket["min"] = min(bucket["min"], value)
+            bucket["max"] = max(bucket["max"], value)
+            if timestamp >= bucket["last_timestamp"]:
+                bucket["last"] = value
+                bucket["last_timestamp"] = timestamp
+    return list(buckets.values())
+
+
+async def apply_events(db: AsyncSession, rows):
+    """Add newly stored events to their buckets, including buckets of the past for late events."""
+    buckets = bucket_rows(rows)
+    if not buckets:
+        return
+    stmt = insert(models.Rollup)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[models.Rollup.sensor_uuid, models.Rollup.resolution, models.Rollup.bucket_start],
+        set_={
+            "count": models.Rollup.count + stmt.excluded.count,
+            "sum": models.Rollup.sum + stmt.excluded.sum,
+            "min": func.min(models.Rollup.min, stmt.excluded.min),
+            "max": func.max(models.Rollup.max, stmt.excluded.max),
+            "last": case((stmt.excluded.last_timestamp >= models.Rollup.last_timestamp, stmt.excluded.last),
+                         else_=models.Rollup.last),
+            "last_timestamp": func.max(models.Rollup.last_timestamp, stmt.excluded.last_timestamp),
+        }
+    )
+    await db.execute(stmt, buckets)
+
+
+async def backfill(db: AsyncConnection):
+    """Build the rollups of events stored before the rollups table existed, in the caller's transaction."""
+    if await db.scalar(select(models.Rollup.sensor_uuid).limit(1)) is not None:
+        return
+    for resolution in RESOLUTIONS:
+        bucket = f"{EPOCH_SECONDS_SQL} / {resolution}"
+        # sqlite's bare column with max() is the value of the newest event in the bucket
+        await db.execute(text(f"""
+            INSERT INTO rollups (sensor_uuid, resolution, bucket_start, count, sum, min, max, last, last_timestamp)
+            SELECT sensor_uuid, {resolution}, {BUCKET_START_SQL.format(f"{bucket} * {resolution}")},
+                   count(*), sum(value), min(value), max(value), value, max(timestamp)
+            FROM events
+            GROUP BY sensor_uuid, {bucket}
+        """))
+
+
+def pick_resolution(requested: int) -> int | None:
+    """Coarsest rollup that is at least as fine as the requested resolution, None means raw events."""
+    suitable = [resolution for resolution in RESOLUTIONS if resolution <= requested]
+    return max(suitable) if suitable else None
+
+
+async def query_series(db: AsyncSession, sensor_uuid: str, start: datetime, end: datetime,
+                       resolution: int | None) -> list[apimodels.SeriesPoint]:
+    if resolution is None:
+        events = await db.execute(
+            select(models.Event.timestamp, models.Event.value)
+            .where(models.Event.sensor_uuid == sensor_uuid,
+                   models.Event.timestamp >= start, models.Event.timestamp < end)
+            .order_by(models.Event.timestamp)
+        )
+        return [
+            apimodels.SeriesPoint(timestamp=timestamp.isoformat(), count=1, average=value, min=value, max=value,
+                                  last=value)
+            for timestamp, value in events
+        ]
+
+    buckets = await db.execute(
+        select(models.Rollup)
+        .where(models.Rollup.sensor_uuid == sensor_uuid, models.Rollup.resolution == resolution,
+               models.Rollup.bucket_start >= bucket_start(start, resolution), models.Rollup.bucket_start < end)
+        .order_by(models.Rollup.bucket_start)
+    )
+    return [
+        apimodels.SeriesPoint(timestamp=bucket.bucket_start.isoformat(), count=bucket.count,
+                              average=bucket.sum / bucket.count, min=bucket.min, max=bucket.max, last=bucket.last)
+        for bucket in buckets.scalars()
+    ]
@@ -1,16 +1,20 @@
+import argparse
 import asyncio
-import functools
+import time
 import uuid
-from datetime import datetime
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
 
 import pytz
 import uvicorn
-from fastapi import FastAPI, Request, Response, Depends, Query
-from sqlalchemy import insert, update
+from fastapi import FastAPI, Request, Response, Depends, Path, Query, APIRouter, HTTPException
+from fastapi.encoders import jsonable_encoder
+from fastapi.routing import APIRoute
+from sqlalchemy import bindparam, func, insert, update
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
-from starlette.responses import HTMLResponse
-from starlette.websockets import WebSocket
+from starlette.responses import HTMLResponse, JSONResponse, PlainTextResponse
+from starlette.websockets import WebSocket, WebSocketDisconnect
 
 import sys
 import os
@@ -22,11 +26,69 @@ import db.models as models
 import db.database as database
 
 from db import schemas
+from db import migrations
 
+import admission
+import aggregator
 import apimodels
+import assets
+import broadcaster
+import dedup
+import ingest
+import latest
+import metrics
+import registry
+import rolling
+import rollups
+import window_stats
+import wireformat
+import writer
 
-app = FastAPI()
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# batches a streaming client may send before it waits for their acks, and their maximum size
+STREAM_WINDOW = 8
+STREAM_MAX_BATCH_SIZE = 1000
+# worker processes sharing the database, set by __main__ or by whoever starts uvicorn with --workers
+WORKERS = int(os.environ.get("SERVER_WORKERS", "1"))
+rolling_averages = rolling.RollingAverages()
+sensor_registry = registry.SensorRegistry()
+latest_state = latest.LatestState()
+index_page = assets.StaticAsset(os.path.join(BASE_DIR, "index.html"), "text/html; charset=utf-8")
+recent_events = dedup.RecentEvents()
+broadcast_hub = broadcaster.BroadcastHub()
+# every mutation of this process goes through the writer, the request sessions only read
+write_pipeline = writer.GroupCommitWriter()
+average_aggregator = aggregator.AverageAggregator(rolling_averages, write_pipeline, reload_windows=WORKERS > 1)
+window_statistics = window_stats.WindowStatistics(write_pipeline, cache_latest=WORKERS == 1)
+admission_control = admission.AdmissionControl()
+average_aggregator.stored_callbacks.append(latest_state.add_averages)
+metrics.instrument_engine(database.engine)
+metrics.websocket_subscribers.function = broadcast_hub.subscriber_count
+metrics.averages_queued.function = average_aggregator.pending
+metrics.writer_queued.function = write_pipeline.pending
+metrics.window_statistics_queued.function = window_statistics.pending
+metrics.ingest_in_flight.function = lambda: admission_control.in_flight
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await create_tables()
+    async with database.SessionLocal() as session:
+        await rolling_averages.warm(session)
+        await recent_events.warm(session)
+        await sensor_registry.refresh(session)
+        await latest_state.load(session)
+    write_pipeline.start()
+    average_aggregator.start()
+    window_statistics.start()
+    yield
+    await average_aggregator.close()
+    await window_statistics.close()
+    await write_pipeline.close()
+    await broadcast_hub.close()
+
+
+app = FastAPI(lifespan=lifespan)
 
 
 async def get_db(request: Request):
@@ -45,123 +107,259 @@ async def db_session_middleware(request: Request, call_next):
     return response
 
 
-@app.get("/", tags=["root"])
-async def root_html_page() -> HTMLResponse:
-    file_path = os.path.join(BASE_DIR, 'index.html')
-    with open(file_path) as f:
-        return HTMLResponse(f.read())
+@app.middleware("http")
+async def request_metrics_middleware(request: Request, call_next):
+    start = time.perf_counter()
+    response = await call_next(request)
+    # label with the route template, not the path, so sensor uuids don't create a series each
+    route = request.scope.get("route")
+    metrics.request_latency.observe(time.perf_counter() - start,
+                                    (request.method, route.path if route else "unmatched", response.status_code))
+    return response
+
+
+@app.get("/metrics", response_class=PlainTextResponse, tags=["metrics"])
+async def get_metrics(db: AsyncSession = Depends(get_db)):
+    metrics.averages_pending.set(
+        await db.scalar(select(func.count()).select_from(models.Averages).where(models.Averages.transmitted == False))
+    )
+    return PlainTextResponse(metrics.registry.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/", tags=["root"], response_class=HTMLResponse)
+async def root_html_page(request: Request) -> Response:
+    return index_page.response(request)
+
+
+async def send_deltas(websocket: WebSocket, subscription: broadcaster.Subscription):
+    while True:
+        await websocket.send_json(await subscription.queue.get())
 
 
 @app.websocket("/ws")
-async def websocket_endpoint(websocket: WebSocket, sensor_uuid: str = Query(...)):
+async def websocket_endpoint(websocket: WebSocket, sensor_uuid: str = Query(..., pattern=apimodels.UUID_PATTERN)):
     await websocket.accept()
-    db_session = database.SessionLocal()
+    sensor_broadcaster = subscription = None
     try:
-        while True:
-            sensor_events_query_result = await db_session.execute(
-                select(models.Event)
-                .where(models.Event.sensor_uuid == sensor_uuid)
-                .order_by(models.Event.timestamp.desc())
-            )
-            sensor_events = [{"timestamp": row.Event.timestamp.isoformat(), "value": row.Event.value} for row in
-                             sensor_events_query_result.fetchall()]
-
-            # Fetch averages data
-            averages_query_result = await db_session.execute(
-                select(models.Averages)
-                .where(models.Averages.sensor_uuid == sensor_uuid)
-                .order_by(models.Averages.calculation_timestamp.desc())
-            )
-            averages = [
-                {"timestamp": row.Averages.calculation_timestamp.isoformat(), "value": row.Averages.average,
-                 "transmitted": row.Averages.transmitted} for row in averages_query_result.fetchall()]
-
-            await websocket.send_json({"events": sensor_events, "averages": averages})
-            await asyncio.sleep(2)
+        # one bounded snapshot, afterwards only the rows the sensor's broadcaster fans out
+        sensor_broadcaster, subscription, snapshot = await broadcast_hub.subscribe(sensor_uuid)
+        await websocket.send_json(snapshot)
+        sender = asyncio.create_task(send_deltas(websocket, subscription))
+        try:
+            # the page never sends anything, receiving only notices the disconnect
+            while (await websocket.receive())["type"] != "websocket.disconnect":
+                pass
+        finally:
+            sender.cancel()
     except Exception as e:
         print("Websocket connection error: " + str(e))
     finally:
+        if subscription:
+            sensor_broadcaster.unsubscribe(subscription)
         try:
             await websocket.close()
         except Exception as e:
             pass
-        await db_session.close()
         print("Websocket connection closed")
 
 
-@app.get("/sensors", response_model=list[schemas.Sensor])
-async def get_sensors(skip: int = 0, limit: int = 100, db: AsyncSession = Depends(get_db)):
-    result = await db.execute(select(models.Sensor).offset(skip).limit(limit))
-    return result.scalars().all()
+@app.get("/sensors", response_model=list[schemas.Sensor],
+         description="Sensors in registration order. Pass the uuid of the last sensor of a page as `after` to get "
+                     "the next page, and the ETag of a previous response as If-None-Match to get a 304 if no "
+                     "sensor was registered since.")
+async def get_sensors(request: Request, response: Response, skip: int = 0, limit: int = 100,
+                      after: str | None = None, db: AsyncSession = Depends(get_db)):
+    if WORKERS > 1:
+        # sensors registered by the other worker processes
+        await sensor_registry.refresh(db)
+    if assets.etag_matches(request, sensor_registry.etag):
+        return Response(status_code=304, headers={"ETag": sensor_registry.etag})
+    if after is not None and after not in sensor_registry:
+        raise HTTPException(status_code=404, detail=f"Unknown sensor {after}")
+    response.headers["ETag"] = sensor_registry.etag
+    return sensor_registry.page(after, skip, limit)
+
+
+@app.post("/sensors/latest", response_model=apimodels.LatestStateResponse,
+          description="Newest event, newest average and time of the last ingest of the given sensors, or of all "
+                      "sensors in registration order without `sensor_uuids`. Served from memory.")
+async def get_latest_state(request: apimodels.LatestStateRequest) -> Response:
+    if WORKERS > 1:
+        # sensors registered and events stored by the other worker processes
+        async with database.SessionLocal() as session:
+            await sensor_registry.refresh(session)
+            await latest_state.load(session, request.sensor_uuids)
+    if request.sensor_uuids is None:
+        sensor_uuids = [sensor["sensor_uuid"] for sensor in sensor_registry.sensors]
+        unknown = []
+    else:
+        sensor_uuids = [sensor_uuid for sensor_uuid in request.sensor_uuids if sensor_uuid in sensor_registry]
+        unknown = [sensor_uuid for sensor_uuid in request.sensor_uuids if sensor_uuid not in sensor_registry]
+    # the cached entries are response dicts already, skip the validation of thousands of models
+    return JSONResponse({"sensors": latest_state.read(sensor_uuids), "unknown_sensor_uuids": unknown})
+
+
+def naive_utc(value: datetime) -> datetime:
+    """The timestamps are stored naive in UTC, a time without an offset is taken as UTC, not as the host's time."""
+    return value.replace(tzinfo=None) if value.tzinfo is None else value.astimezone(pytz.UTC).replace(tzinfo=None)
+
+
+@app.get("/sensors/{sensor_uuid}/series", response_model=apimodels.SeriesResponse)
+async def get_sensor_series(sensor_uuid: str = Path(pattern=apimodels.UUID_PATTERN),
+                            start: datetime | None = Query(None, alias="from"),
+                            end: datetime | None = Query(None, alias="to"),
+                            resolution: int = Query(60, gt=0, description="Requested bucket length in seconds."),
+                            db: AsyncSession = Depends(get_db)):
+    end = naive_utc(end) if end else datetime.now(pytz.UTC).replace(tzinfo=None)
+    start = naive_utc(start) if start else end - timedelta(days=1)
+    rollup_resolution = rollups.pick_resolution(resolution)
+    points = await rollups.query_series(db, sensor_uuid, start, end, rollup_resolution)
+    return apimodels.SeriesResponse(sensor_uuid=sensor_uuid, resolution=rollup_resolution or 0, points=points)
 
 
 @app.post("/createSensor", response_model=apimodels.SensorRemote)
-async def create_sensor(new_sensor: apimodels.SensorRegisterRemote, db: AsyncSession = Depends(get_db)):
+async def create_sensor(new_sensor: apimodels.SensorRegisterRemote):
     sensor_uuid = uuid.uuid4().hex
-    await db.execute(
-        insert(models.Sensor).values(
-            sensor_uuid=sensor_uuid,
-            sensor_type=new_sensor.type,
-            sensor_name=new_sensor.name
+
+    async def write(db: AsyncSession) -> list[tuple]:
+        await db.execute(
+            insert(models.Sensor).values(
+                sensor_uuid=sensor_uuid,
+                sensor_type=new_sensor.type,
+                sensor_name=new_sensor.name
+            )
         )
-    )
-    await db.commit()
+        return await sensor_registry.read_new(db)
+
+    def committed(new_sensors: list[tuple]):
+        sensor_registry.add(new_sensors)
+        rolling_averages.register_sensor(sensor_uuid, new_sensor.type)
+
+    await write_pipeline.submit(write, committed)
     return apimodels.SensorRemote(uuid=sensor_uuid, type=new_sensor.type, name=new_sensor.name)
 
 
-@app.post("/receivedAverages")
-async def post_received_averages(received: apimodels.AverageReceivedAck, db: AsyncSession = Depends(get_db)):
-    await db.execute(
-        update(models.Averages)
-        .where(models.Averages.average_uuid.in_(received.received))
-        .values(transmitted=True)
-    )
-    await db.commit()
-    return {"message": "Received averages updated"}
+@app.post("/createSensors", response_model=list[apimodels.SensorRemote],
+          description=f"Registers up to {apimodels.MAX_SENSOR_BATCH_SIZE} sensors in one transaction.")
+async def create_sensors(new_sensors: apimodels.SensorBatchRegisterRemote):
+    sensors = [apimodels.SensorRemote(uuid=uuid.uuid4().hex, type=sensor.type, name=sensor.name)
+               for sensor in new_sensors.sensors]
 
+    async def write(db: AsyncSession) -> list[tuple]:
+        if sensors:
+            await db.execute(insert(models.Sensor), [
+                {"sensor_uuid": sensor.uuid, "sensor_type": sensor.type, "sensor_name": sensor.name}
+                for sensor in sensors
+            ])
+        return await sensor_registry.read_new(db)
 
-@app.post("/sensordata", response_model=apimodels.AveragesResponse)
-async def post_sensor_data(request: apimodels.SensorEventDataRequest, db: AsyncSession = Depends(get_db)):
-    # insert sensor events into database
-    for event in request.events:
-        time = datetime.fromisoformat(event.timestamp)
-        # ignore on conflict in case of retransmitted events because of lost acks
-        stmt = insert(models.Event).values(
-            event_uuid=event.event_uuid,
-            value=event.value,
-            unit=event.unit,
-            sensor_uuid=event.sensor_uuid,
-            timestamp=time
-        ).prefix_with("OR IGNORE")
-        await db.execute(stmt)
-    await db.commit()
-    # find all sensor uuids in this request
-    sensor_uuids = list(set([event.sensor_uuid for event in request.events]))
-    # for each sensor uuid, calculate average and store in database
-    for sensor_uuid in sensor_uuids:
-        result = await db.execute(
-            select(models.Event)
-            .where(models.Event.sensor_uuid == sensor_uuid)
-            .order_by(models.Event.timestamp.desc()).limit(10)
-        )
-        last10values = result.scalars().all()
+    def committed(new_sensors: list[tuple]):
+        sensor_registry.add(new_sensors)
+        for sensor in sensors:
+            rolling_averages.register_sensor(sensor.uuid, sensor.type)
 
-        if len(last10values) == 0:
-            continue
+    await write_pipeline.submit(write, committed)
+    return sensors
 
-        avg = functools.reduce(lambda x, y: x + y, map(lambda x: x.value, last10values)) / len(last10values)
 
+@app.post("/receivedAverages")
+async def post_received_averages(received: apimodels.AverageReceivedAck):
+    async def write(db: AsyncSession):
         await db.execute(
-            insert(models.Averages).values(
-                average_uuid=uuid.uuid4().hex,
-                sensor_uuid=sensor_uuid,
-                calculation_timestamp=datetime.now(pytz.UTC),
-                average=avg,
-                transmitted=False
-            )
+            update(models.Averages)
+            .where(models.Averages.average_uuid.in_(received.received))
+            .values(transmitted=True)
         )
 
-    await db.commit()
+    await write_pipeline.submit(write)
+    return {"message": "Received averages updated"}
+
+
+async def apply_acked_sequences(db: AsyncSession, acked_sequences: dict[str, int]):
+    """Mark the averages a client acknowledged with its previous upload, one statement per sensor."""
+    if not acked_sequences:
+        return
+    # core update of the table, the orm would treat a parameter list as a bulk update by primary key
+    averages = models.Averages.__table__
+    await db.execute(
+        update(averages)
+        .where(averages.c.sensor_uuid == bindparam("acked_sensor_uuid"),
+               averages.c.transmitted == False,
+               averages.c.sequence <= bindparam("acked_sequence"))
+        .values(transmitted=True),
+        [{"acked_sensor_uuid": sensor_uuid, "acked_sequence": sequence}
+         for sensor_uuid, sequence in acked_sequences.items()]
+    )
+
+
+async def store_acked_sequences(acked_sequences: dict[str, int]):
+    if acked_sequences:
+        await write_pipeline.submit(lambda db: apply_acked_sequences(db, acked_sequences))
+
+
+async def unknown_sensors(rows: list[dict]) -> set[str]:
+    """Sensors of the events that are not registered, checked against the registry instead of the database."""
+    unknown = sensor_registry.unknown({row["sensor_uuid"] for row in rows})
+    if unknown and WORKERS > 1:
+        # registered by another worker process since the last refresh
+        async with database.SessionLocal() as session:
+            await sensor_registry.refresh(session)
+        unknown = sensor_registry.unknown(unknown)
+    if unknown:
+        metrics.events_rejected.inc(len(rows))
+    return unknown
+
+
+async def store_events(rows: list[dict], acked_sequences: dict[str, int]):
+    """Store the events and the acks of an upload in the writer's next group commit."""
+    # retransmitted events known to be stored are acked again without reaching sqlite
+    unknown_rows = recent_events.new_rows(rows)
+    if not unknown_rows:
+        metrics.events_deduplicated.inc(len(rows))
+        await store_acked_sequences(acked_sequences)
+        return
+
+    async def write(db: AsyncSession) -> list[dict]:
+        await apply_acked_sequences(db, acked_sequences)
+        # insert sensor events into database
+        inserted_event_uuids = await ingest.insert_events(db, unknown_rows)
+        # only events that were not stored before may move the rollups and rolling windows
+        new_rows = [row for row in unknown_rows if row["event_uuid"] in inserted_event_uuids]
+        await rollups.apply_events(db, new_rows)
+        return new_rows
+
+    def committed(new_rows: list[dict]):
+        metrics.events_ingested.inc(len(new_rows))
+        metrics.events_deduplicated.inc(len(rows) - len(new_rows))
+        recent_events.add(row["event_uuid"] for row in unknown_rows)
+        latest_state.add_events(new_rows, datetime.now(pytz.UTC))
+        # the events are durable, the averages are stored in the background and reach the client on its next sync
+        rolling_averages.add_events(new_rows)
+        sensor_uuids = {row["sensor_uuid"] for row in new_rows}
+        average_aggregator.mark_dirty(sensor_uuids)
+        window_statistics.mark_dirty(sensor_uuids)
+
+    await write_pipeline.submit(write, committed)
+
+
+def average_remote(average: models.Averages) -> apimodels.AverageRemote:
+    return apimodels.AverageRemote(
+        average=average.average,
+        average_uuid=average.average_uuid,
+        average_timestamp=average.calculation_timestamp.isoformat(),
+        sensor_uuid=average.sensor_uuid,
+        sequence=average.sequence
+    )
+
+
+async def store_sensor_data(rows: list[dict], db: AsyncSession,
+                            acked_sequences: dict[str, int]) -> apimodels.AveragesResponse:
+    unknown = await unknown_sensors(rows)
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown sensors: {', '.join(sorted(unknown))}")
+    await store_events(rows, acked_sequences)
+    # the request's session starts reading after the commit, so it sees the acks and events
+    sensor_uuids = list(set([row["sensor_uuid"] for row in rows]))
 
     # get all untransmitted averages for sensors in request
     items = await db.execute(
@@ -169,26 +367,160 @@ async def post_sensor_data(request: apimodels.SensorEventDataRequest, db: AsyncS
         .where(models.Averages.transmitted == False, models.Averages.sensor_uuid.in_(sensor_uuids))
     )
     averages = items.scalars().all()
-
-    # map to remote model
-    avgs_remote = [
-        apimodels.AverageRemote(
-            average=average.average,
-            average_uuid=average.average_uuid,
-            average_timestamp=average.calculation_timestamp.isoformat(),
-            sensor_uuid=average.sensor_uuid
-        )
-        for average in averages
-    ]
-    return apimodels.AveragesResponse(averages=avgs_remote,
-                                      received_event_uuids=[event.event_uuid for event in request.events])
+    return apimodels.AveragesResponse(averages=[average_remote(average) for average in averages],
+                                      received_event_uuids=[row["event_uuid"] for row in rows],
+                                      aggregates=await window_statistics.query(db, sensor_uuids))
+
+
+class SensorDataRoute(APIRoute):
+    """Sends columnar request bodies to their own decoder and everything else to the regular json handler."""
+
+    def get_route_handler(self):
+        json_handler = super().get_route_handler()
+
+        async def route_handler(request: Request) -> Response:
+            # both formats hold an ingest slot while the body is read and stored
+            async with admission_control.admit(request):
+                body = await admission_control.read_body(request)
+                if not wireformat.is_columnar(request.headers.get("content-type")):
+                    return await json_handler(request)
+                content_encoding = request.headers.get("content-encoding")
+                if not wireformat.supports_encoding(content_encoding):
+                    raise HTTPException(status_code=415, detail=f"Unsupported content encoding: {content_encoding}")
+                try:
+                    body = wireformat.decompress(body, content_encoding,
+                                                 wireformat.max_body_size(admission_control.max_request_events))
+                    rows, acked_sequences = wireformat.decode(body)
+                except wireformat.BodyTooLarge as e:
+                    admission.reject(413, "too_large", str(e))
+                except Exception as e:
+                    raise HTTPException(status_code=400, detail="Invalid columnar sensor data: " + str(e))
+                admission_control.charge(request, len(rows))
+                response = await store_sensor_data(rows, request.state.db, acked_sequences)
+                return JSONResponse(jsonable_encoder(response))
+
+        return route_handler
+
+
+sensordata_router = APIRouter(route_class=SensorDataRoute)
+
+
+@sensordata_router.post("/sensordata", response_model=apimodels.AveragesResponse,
+                        description=f"Accepts json or, with content type {wireformat.CONTENT_TYPE}, "
+                                    "the columnar format of wireformat.py (optionally gzip/zstd encoded).")
+async def post_sensor_data(request: apimodels.SensorEventDataRequest, http_request: Request,
+                           db: AsyncSession = Depends(get_db)):
+    rows = ingest.event_rows(request.events)
+    admission_control.charge(http_request, len(rows))
+    return await store_sensor_data(rows, db, request.acked_sequences)
+
+
+app.include_router(sensordata_router)
+
+
+async def send_stream_messages(websocket: WebSocket, outbox: asyncio.Queue):
+    while True:
+        await websocket.send_json(await outbox.get())
+
+
+async def push_averages(outbox: asyncio.Queue, listener: aggregator.StoredListener, sent_sequences: dict[str, int]):
+    """Send the averages of the stream's sensors as soon as the aggregator stored them."""
+    sensor_uuids = set(sent_sequences)
+    while True:
+        if sensor_uuids:
+            async with database.SessionLocal() as session:
+                result = await session.execute(
+                    select(models.Averages)
+                    .where(models.Averages.transmitted == False, models.Averages.sensor_uuid.in_(sensor_uuids))
+                    .order_by(models.Averages.sequence)
+                )
+            averages = [average for average in result.scalars()
+                        if average.sequence is not None and average.sequence > sent_sequences[average.sensor_uuid]]
+            if averages:
+                for average in averages:
+                    sent_sequences[average.sensor_uuid] = average.sequence
+                await outbox.put({"type": "averages",
+                                  "averages": [average_remote(average).model_dump() for average in averages]})
+        sensor_uuids = {sensor_uuid for sensor_uuid in await listener.wait() if sensor_uuid in sent_sequences}
+
+
+@app.websocket("/ws/ingest")
+async def ingest_stream_endpoint(websocket: WebSocket):
+    """Streaming upload: events are acked per batch, averages are pushed as they are stored.
+
+    Client messages: hello (once), events (seq, events, optional acked_sequences), acked (acked_sequences).
+    Server messages: ready (window, max_batch_size), ack (seq, received_event_uuids), averages, error.
+    """
+    await websocket.accept()
+    # a full outbox stops reading from the client, so a slow reader slows down the uploads too
+    outbox = asyncio.Queue(maxsize=STREAM_WINDOW * 2)
+    listener = average_aggregator.listen()
+    metrics.ingest_streams.inc()
+    tasks = []
+    try:
+        hello = apimodels.StreamHello.model_validate(await websocket.receive_json())
+        # resume: everything after the acknowledged sequences is sent again
+        sent_sequences = {sensor_uuid: hello.acked_sequences.get(sensor_uuid, 0) for sensor_uuid in hello.sensor_uuids}
+        await store_acked_sequences(hello.acked_sequences)
+        await websocket.send_json({"type": "ready", "window": STREAM_WINDOW, "max_batch_size": STREAM_MAX_BATCH_SIZE})
+        tasks = [asyncio.create_task(send_stream_messages(websocket, outbox)),
+                 asyncio.create_task(push_averages(outbox, listener, sent_sequences))]
+        while True:
+            message = await websocket.receive_json()
+            if message.get("type") == "acked":
+                await store_acked_sequences(apimodels.StreamAcked.model_validate(message).acked_sequences)
+                continue
+            batch = apimodels.StreamEvents.model_validate(message)
+            if len(batch.events) > STREAM_MAX_BATCH_SIZE:
+                await outbox.put({"type": "error", "seq": batch.seq,
+                                  "detail": f"More than {STREAM_MAX_BATCH_SIZE} events in one batch"})
+                continue
+            rows = ingest.event_rows(batch.events)
+            unknown = await unknown_sensors(rows)
+            if unknown:
+                await outbox.put({"type": "error", "seq": batch.seq,
+                                  "detail": f"Unknown sensors: {', '.join(sorted(unknown))}"})
+                continue
+            await admission_control.throttle(websocket, len(rows))
+            await store_events(rows, batch.acked_sequences)
+            new_sensor_uuids = {row["sensor_uuid"] for row in rows} - sent_sequences.keys()
+            if new_sensor_uuids:
+                # averages of sensors the hello didn't mention, from the first one
+                sent_sequences.update({sensor_uuid: 0 for sensor_uuid in new_sensor_uuids})
+                listener.notify(new_sensor_uuids)
+            await outbox.put({"type": "ack", "seq": batch.seq,
+                              "received_event_uuids": [row["event_uuid"] for row in rows]})
+    except WebSocketDisconnect:
+        pass
+    except Exception as e:
+        print("Ingest stream error: " + str(e))
+        try:
+            await websocket.send_json({"type": "error", "detail": str(e)})
+            await websocket.close()
+        except Exception:
+            pass
+    finally:
+        for task in tasks:
+            task.cancel()
+        average_aggregator.unlisten(listener)
+        metrics.ingest_streams.dec()
 
 
 async def create_tables():
     async with database.engine.begin() as conn:
-        await conn.run_sync(models.Base.metadata.create_all)
+        # worker processes start at the same time, the first one migrates and the others wait for the lock
+        await conn.exec_driver_sql(writer.BEGIN_IMMEDIATE)
+        await conn.run_sync(migrations.upgrade_schema, models.Base.metadata)
+        await rollups.backfill(conn)
 
 
 if __name__ == "__main__":
-    asyncio.run(create_tables())
-    uvicorn.run("server_main:app", host="0.0.0.0", port=8000, reload=True)
+    parser = argparse.ArgumentParser(description="Fog computing cloud server.")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Worker processes, more than one disables the auto reload.")
+    args = parser.parse_args()
+    # the worker processes inherit the environment
+    os.environ["SERVER_WORKERS"] = str(args.workers)
+    uvicorn.run("server_main:app", host=args.host, port=args.port, workers=args.workers, reload=args.workers == 1)
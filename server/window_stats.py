@@ -0,0 +1,336 @@
+import asyncio
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytz
+from sqlalchemy import BigInteger, bindparam, func, literal_column, type_coerce, union_all
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.future import select
+
+import db.models as models
+import db.database as database
+
+import apimodels
+import metrics
+import writer
+
+# sensors per compound select and per write job, sqlite allows at most 500 terms in a compound select
+BATCH_SIZE = 100
+# parameter of the unused sensor positions of a statement, matches no events
+NO_SENSOR = ""
+# seconds between updates, the statistics of a sensor are computed at most once per interval however fast it reports
+DEFAULT_INTERVAL = 2.0
+# largest share of the time spent updating, with many busy sensors the interval grows instead
+MAX_DUTY_CYCLE = 0.2
+# weight of the newest event in the exponentially weighted moving average
+EWMA_ALPHA = 0.3
+# julian day of the unix epoch, sqlite's julianday() is the time format of the loaded events
+UNIX_EPOCH_JULIAN_DAY = 2440587.5
+MICROSECONDS_PER_DAY = 86400 * 1000000
+
+
+def stored_micros(timestamp):
+    # the integers of the compact schema, without converting literals to datetimes
+    return type_coerce(timestamp, BigInteger)
+
+
+def julian_day(timestamp):
+    if models.COMPACT:
+        return stored_micros(timestamp) / float(MICROSECONDS_PER_DAY) + UNIX_EPOCH_JULIAN_DAY
+    return func.julianday(timestamp)
+
+
+def window_event():
+    return select(julian_day(models.Event.timestamp).label("day"), models.Event.value.label("value"))
+
+
+class CountWindow:
+    """The newest `size` events of a sensor."""
+
+    def __init__(self, size: int):
+        self.size = size
+
+    def query(self, sensor_uuid):
+        return (
+            window_event()
+            .where(models.Event.sensor_uuid == sensor_uuid)
+            .order_by(models.Event.timestamp.desc())
+            .limit(self.size)
+        )
+
+
+class TimeWindow:
+    """The events of a sensor up to `seconds` before its newest event.
+
+    The window ends at the newest event instead of now, so a backlog uploaded after an outage is aggregated like
+    events that arrived in time.
+    """
+
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+
+    def query(self, sensor_uuid):
+        # the start in the format the timestamps are stored in, precise to the millisecond with the text schema
+        if models.COMPACT:
+            newest = stored_micros(func.max(models.Event.timestamp))
+            start = newest - int(self.seconds * 1000000)
+        else:
+            start = func.strftime("%Y-%m-%d %H:%M:%f", func.max(models.Event.timestamp), f"-{self.seconds} seconds")
+        start = select(start).where(models.Event.sensor_uuid == sensor_uuid).scalar_subquery()
+        return window_event().where(models.Event.sensor_uuid == sensor_uuid, models.Event.timestamp >= start)
+
+
+# window name -> window, sent to the clients with the aggregates
+WINDOWS = {
+    "last_10": CountWindow(10),
+    "last_5min": TimeWindow(300),
+}
+# pNN is the NNth percentile
+STATISTICS = ("count", "mean", "min", "max", "stddev", "p50", "p95", "ewma")
+
+
+def window_statement(window, sensors: int):
+    """One index range per sensor, the sensor uuids are the parameters sensor_0 to sensor_<sensors - 1>.
+
+    sqlite concatenates the events of a sensor into one row: parsing the text with numpy costs a fraction of
+    fetching a row per event, and the concatenation runs in the aiosqlite thread instead of the event loop.
+    """
+    queries = []
+    for position in range(sensors):
+        events = window.query(bindparam(f"sensor_{position}")).subquery()
+        # both concatenations see the rows in the same order, so days and values stay aligned
+        queries.append(
+            select(literal_column(str(position)), func.group_concat(events.c.day), func.group_concat(events.c.value))
+            .select_from(events)
+        )
+    return union_all(*queries)
+
+
+async def load_events(db: AsyncSession, statement,
+                      sensor_uuids: list[str]) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Sensor positions, julian day timestamps and values of the window's events.
+
+    Statements are built for BATCH_SIZE sensors, smaller batches fill the remaining positions with NO_SENSOR.
+    """
+    parameters = {f"sensor_{position}": NO_SENSOR for position in range(BATCH_SIZE)}
+    parameters.update({f"sensor_{position}": sensor_uuid for position, sensor_uuid in enumerate(sensor_uuids)})
+    result = await db.execute(statement, parameters)
+    positions, days, values = [], [], []
+    for position, sensor_days, sensor_values in result:
+        if sensor_days is None:
+            continue
+        days.append(np.fromstring(sensor_days, sep=","))
+        values.append(np.fromstring(sensor_values, sep=","))
+        positions.append(np.full(len(days[-1]), position, dtype=np.intp))
+    if not positions:
+        return np.empty(0, dtype=np.intp), np.empty(0), np.empty(0)
+    return np.concatenate(positions), np.concatenate(days), np.concatenate(values)
+
+
+def value_matrix(sensors: int, positions: np.ndarray, days: np.ndarray,
+                 values: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """One row per sensor with its values oldest first, padded with nan, the counts and the newest julian days."""
+    order = np.lexsort((days, positions))
+    positions, days, values = positions[order], days[order], values[order]
+    counts = np.bincount(positions, minlength=sensors)
+    offsets = np.cumsum(counts) - counts
+    matrix = np.full((sensors, counts.max(initial=0)), np.nan)
+    matrix[positions, np.arange(len(positions)) - offsets[positions]] = values
+    newest = np.full(sensors, np.nan)
+    filled = counts > 0
+    newest[filled] = days[offsets[filled] + counts[filled] - 1]
+    return matrix, counts, newest
+
+
+def percentiles(matrix: np.ndarray, counts: np.ndarray, quantiles: list[float]) -> list[np.ndarray]:
+    # np.nanpercentile loops over the rows, sorting once moves the padding to the end of every row and the
+    # percentiles become a linear interpolation between two columns, the same as numpy's default method
+    ordered = np.sort(matrix, axis=1)
+    rows = np.arange(len(matrix))
+    results = []
+    for quantile in quantiles:
+        position = quantile / 100 * (counts - 1)
+        lower = np.floor(position).astype(np.intp)
+        upper = np.minimum(lower + 1, counts - 1)
+        fraction = position - lower
+        results.append(ordered[rows, lower] * (1 - fraction) + ordered[rows, upper] * fraction)
+    return results
+
+
+def ewma(matrix: np.ndarray, counts: np.ndarray, alpha: float) -> np.ndarray:
+    # weight (1 - alpha)^age per event, the newest event has age 0, the padding gets no weight
+    ages = counts[:, None] - 1 - np.arange(matrix.shape[1])[None, :]
+    weights = np.where(ages >= 0, (1 - alpha) ** np.maximum(ages, 0), 0.0)
+    return np.nansum(matrix * weights, axis=1) / weights.sum(axis=1)
+
+
+def calculate(matrix: np.ndarray, counts: np.ndarray, statistics, ewma_alpha: float = EWMA_ALPHA) -> dict:
+    """All statistics for every row of the matrix at once, every row must contain at least one value."""
+    results = {}
+    percentile_statistics = [statistic for statistic in statistics if statistic.startswith("p")]
+    if percentile_statistics:
+        quantiles = [float(statistic[1:]) for statistic in percentile_statistics]
+        results.update(zip(percentile_statistics, percentiles(matrix, counts, quantiles)))
+    for statistic in statistics:
+        if statistic == "count":
+            results[statistic] = counts.astype(np.float64)
+        elif statistic == "mean":
+            results[statistic] = np.nanmean(matrix, axis=1)
+        elif statistic == "min":
+            results[statistic] = np.nanmin(matrix, axis=1)
+        elif statistic == "max":
+            results[statistic] = np.nanmax(matrix, axis=1)
+        elif statistic == "stddev":
+            results[statistic] = np.nanstd(matrix, axis=1)
+        elif statistic == "ewma":
+            results[statistic] = ewma(matrix, counts, ewma_alpha)
+        elif statistic not in results:
+            raise ValueError(f"Unknown statistic: {statistic}")
+    return results
+
+
+def aggregate_remote(aggregate) -> apimodels.AggregateRemote:
+    return apimodels.AggregateRemote(
+        sensor_uuid=aggregate["sensor_uuid"],
+        window=aggregate["window"],
+        window_end=aggregate["window_end"].isoformat() if aggregate["window_end"] else None,
+        calculation_timestamp=aggregate["calculation_timestamp"].isoformat(),
+        statistics=aggregate["statistics"]
+    )
+
+
+def julian_day_datetime(day: float) -> datetime:
+    # the concatenated julian days are precise to about a millisecond
+    return datetime(1970, 1, 1) + timedelta(milliseconds=round((day - UNIX_EPOCH_JULIAN_DAY) * 86400000))
+
+
+class WindowStatistics:
+    """Statistics over count or time based windows of the sensors with new events, for alerting.
+
+    Every `interval` seconds the events of all marked sensors are loaded into one NumPy matrix per window and every
+    statistic is computed for all of them at once. The latest values replace the previous ones in the aggregates
+    table. The events are read from the database, so the statistics include the events of other worker processes.
+    With `cache_latest` the stored values are also kept in memory for the responses, only for a single process,
+    with several worker processes another one may have stored newer values.
+    """
+
+    def __init__(self, write_pipeline: writer.GroupCommitWriter, windows: dict = None, statistics=STATISTICS,
+                 ewma_alpha: float = EWMA_ALPHA, interval: float = DEFAULT_INTERVAL, cache_latest: bool = False):
+        self.write_pipeline = write_pipeline
+        self.windows = WINDOWS if windows is None else windows
+        self.statistics = statistics
+        self.ewma_alpha = ewma_alpha
+        self.interval = interval
+        self.dirty: set[str] = set()
+        self.task: asyncio.Task | None = None
+        # statement per window, building it and its cache key costs more than running it
+        self.statements = {name: window_statement(window, BATCH_SIZE) for name, window in self.windows.items()}
+        self.cache_latest = cache_latest
+        self.latest: dict[str, list[apimodels.AggregateRemote]] = {}
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    def mark_dirty(self, sensor_uuids):
+        self.dirty.update(sensor_uuids)
+
+    def pending(self) -> int:
+        return len(self.dirty)
+
+    async def run(self):
+        delay = self.interval
+        while True:
+            await asyncio.sleep(delay)
+            started = time.perf_counter()
+            await self.update()
+            duration = time.perf_counter() - started
+            delay = max(self.interval, duration * (1 / MAX_DUTY_CYCLE - 1))
+
+    async def update(self):
+        sensor_uuids, self.dirty = sorted(self.dirty), set()
+        for start in range(0, len(sensor_uuids), BATCH_SIZE):
+            batch = sensor_uuids[start:start + BATCH_SIZE]
+            try:
+                started = time.perf_counter()
+                # read outside the write transaction, events committed meanwhile mark the sensors again
+                async with database.SessionLocal() as session:
+                    aggregates = await self.compute(session, batch)
+                metrics.window_statistics_duration.observe(time.perf_counter() - started)
+                await self.write_pipeline.submit(lambda db: store(db, aggregates), lambda _: self.remember(aggregates))
+            except Exception as e:
+                print("Failed to update window statistics:", str(e))
+
+    def remember(self, aggregates: list[dict]):
+        if not self.cache_latest:
+            return
+        latest = {}
+        for aggregate in aggregates:
+            latest.setdefault(aggregate["sensor_uuid"], []).append(aggregate_remote(aggregate))
+        self.latest.update(latest)
+
+    async def query(self, db: AsyncSession, sensor_uuids) -> list[apimodels.AggregateRemote]:
+        """Latest statistics of the sensors, from memory if cached, else from the aggregates table."""
+        aggregates = []
+        missing = []
+        for sensor_uuid in sensor_uuids:
+            cached = self.latest.get(sensor_uuid)
+            if cached is None:
+                missing.append(sensor_uuid)
+            else:
+                aggregates.extend(cached)
+        if missing:
+            result = await db.execute(
+                select(models.Aggregate.__table__).where(models.Aggregate.sensor_uuid.in_(missing))
+            )
+            aggregates.extend(aggregate_remote(aggregate) for aggregate in result.mappings())
+        return aggregates
+
+    async def compute(self, db: AsyncSession, sensor_uuids: list[str]) -> list[dict]:
+        """Rows for the aggregates table, with a null value for every statistic of an empty window."""
+        calculation_timestamp = datetime.now(pytz.UTC)
+        aggregates = []
+        for name in self.windows:
+            events = await load_events(db, self.statements[name], sensor_uuids)
+            matrix, counts, newest = value_matrix(len(sensor_uuids), *events)
+            filled = counts > 0
+            results = {}
+            if filled.any():
+                results = calculate(matrix[filled], counts[filled], self.statistics, self.ewma_alpha)
+            # per statistic the values of all sensors, None for the sensors without events
+            values = {statistic: [None] * len(sensor_uuids) for statistic in self.statistics}
+            for statistic, statistic_values in results.items():
+                for position, value in zip(np.flatnonzero(filled), statistic_values.tolist()):
+                    values[statistic][position] = value
+            for position, sensor_uuid in enumerate(sensor_uuids):
+                aggregates.append({
+                    "sensor_uuid": sensor_uuid,
+                    "window": name,
+                    "statistics": {statistic: values[statistic][position] for statistic in self.statistics},
+                    "window_end": julian_day_datetime(newest[position]) if filled[position] else None,
+                    "calculation_timestamp": calculation_timestamp,
+                })
+        return aggregates
+
+    async def close(self):
+        """Update the statistics of the marked sensors, then stop. Call on shutdown, before closing the writer."""
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        await self.update()
+
+
+async def store(db: AsyncSession, aggregates: list[dict]):
+    if not aggregates:
+        return
+    stmt = insert(models.Aggregate)
+    await db.execute(stmt.on_conflict_do_update(
+        index_elements=[models.Aggregate.sensor_uuid, models.Aggregate.window],
+        set_={
+            "statistics": stmt.excluded.statistics,
+            "window_end": stmt.excluded.window_end,
+            "calculation_timestamp": stmt.excluded.calculation_timestamp,
+        }
+    ), aggregates)
@@ -0,0 +1,133 @@
+import gzip
+import io
+import struct
+import sys
+from array import array
+from datetime import datetime, timedelta
+
+import pytz
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# columnar /sensordata body, all numbers little endian:
+#   header: magic, number of groups
+#   per group (one sensor and unit): sensor uuid (16 bytes), unit length, event count, unit (utf-8),
+#   event uuids (16 bytes each), timestamps (int64 microseconds since epoch, UTC), values (float64)
+# version 2 appends the piggybacked acks: number of acks, per ack sensor uuid (16 bytes) and sequence (int64)
+CONTENT_TYPE = "application/vnd.fog.sensordata+columnar"
+MAGIC = b"FOG1"
+MAGIC_V2 = b"FOG2"
+HEADER = struct.Struct("<4sI")
+GROUP_HEADER = struct.Struct("<16sHI")
+ACK_COUNT = struct.Struct("<I")
+ACK = struct.Struct("<16sq")
+EPOCH = datetime(1970, 1, 1, tzinfo=pytz.UTC)
+# decoded bytes of an upload per event it may contain: the event in a group of its own with a long unit, and an ack
+MAX_BYTES_PER_EVENT = 512
+# read from a compressed body at once
+DECOMPRESS_CHUNK_SIZE = 64 * 1024
+
+
+class BodyTooLarge(ValueError):
+    pass
+
+
+def is_columnar(content_type: str | None) -> bool:
+    return content_type is not None and content_type.split(";")[0].strip() == CONTENT_TYPE
+
+
+def supports_encoding(content_encoding: str | None) -> bool:
+    return content_encoding in (None, "", "identity", "gzip") or (content_encoding == "zstd" and zstandard is not None)
+
+
+def max_body_size(max_events: int) -> int:
+    return HEADER.size + max_events * MAX_BYTES_PER_EVENT
+
+
+def decompress(body: bytes, content_encoding: str | None, max_size: int) -> bytes:
+    """The decoded body, BodyTooLarge as soon as it grows beyond max_size bytes.
+
+    Compressed bodies are read in chunks, so a small body that expands to gigabytes is rejected after max_size.
+    """
+    if not content_encoding or content_encoding == "identity":
+        if len(body) > max_size:
+            raise BodyTooLarge(f"Sensor data bodies are limited to {max_size} bytes")
+        return body
+    if content_encoding == "gzip":
+        reader = gzip.GzipFile(fileobj=io.BytesIO(body))
+    elif content_encoding == "zstd" and zstandard is not None:
+        # reads all frames, like gzip reads all members
+        reader = zstandard.ZstdDecompressor().stream_reader(io.BytesIO(body), read_across_frames=True)
+    else:
+        raise ValueError(f"Unsupported content encoding: {content_encoding}")
+    chunks = []
+    size = 0
+    with reader:
+        while chunk := reader.read(DECOMPRESS_CHUNK_SIZE):
+            size += len(chunk)
+            if size > max_size:
+                raise BodyTooLarge(f"Sensor data bodies are limited to {max_size} bytes decompressed")
+            chunks.append(chunk)
+    return b"".join(chunks)
+
+
+def _column(typecode: str, body: bytes, offset: int, count: int) -> array:
+    column = array(typecode)
+    column.frombytes(body[offset:offset + column.itemsize * count])
+    if sys.byteorder == "big":
+        column.byteswap()
+    return column
+
+
+def decode(body: bytes) -> tuple[list[dict], dict[str, int]]:
+    """Decode a columnar body straight into event insert parameters, without per-event request models.
+
+    Returns the rows and the acknowledged average sequence per sensor.
+    """
+    magic, group_count = HEADER.unpack_from(body, 0)
+    if magic not in (MAGIC, MAGIC_V2):
+        raise ValueError("Not a columnar sensor data body")
+    offset = HEADER.size
+    rows = {}
+    for _ in range(group_count):
+        sensor_uuid, unit_length, count = GROUP_HEADER.unpack_from(body, offset)
+        offset += GROUP_HEADER.size
+        unit = body[offset:offset + unit_length].decode()
+        offset += unit_length
+        event_uuids = body[offset:offset + 16 * count]
+        offset += 16 * count
+        timestamps = _column("q", body, offset, count)
+        offset += timestamps.itemsize * count
+        values = _column("d", body, offset, count)
+        offset += values.itemsize * count
+        if len(event_uuids) != 16 * count or len(values) != count:
+            raise ValueError("Truncated columnar sensor data body")
+
+        sensor_uuid = sensor_uuid.hex()
+        for index in range(count):
+            event_uuid = event_uuids[16 * index:16 * index + 16].hex()
+            # a batch may contain the same event twice if the client retried mid-request
+            if event_uuid in rows:
+                continue
+            rows[event_uuid] = {
+                "event_uuid": event_uuid,
+                "value": values[index],
+                "unit": unit,
+                "sensor_uuid": sensor_uuid,
+                "timestamp": EPOCH + timedelta(microseconds=timestamps[index]),
+            }
+    acked_sequences = {}
+    if magic == MAGIC_V2:
+        ack_count, = ACK_COUNT.unpack_from(body, offset)
+        offset += ACK_COUNT.size
+        for _ in range(ack_count):
+            sensor_uuid, sequence = ACK.unpack_from(body, offset)
+            offset += ACK.size
+            acked_sequences[sensor_uuid.hex()] = sequence
+    if offset != len(body):
+        raise ValueError("Trailing bytes after columnar sensor data body")
+    return list(rows.values()), acked_sequences
+
@@ -0,0 +1,118 @@
+import asyncio
+import time
+
+from sqlalchemy import text
+
+import db.database as database
+
+import metrics
+
+# write jobs committed in one transaction at most
+MAX_BATCH_SIZE = 256
+
+# takes the write lock when the transaction starts, so a transaction that reads before it writes can't fail with
+# a busy snapshot when another worker process committed in between
+BEGIN_IMMEDIATE = "BEGIN IMMEDIATE"
+
+
+class WriteJob:
+    def __init__(self, operation, committed):
+        self.operation = operation
+        self.committed = committed
+        self.future = asyncio.get_running_loop().create_future()
+
+
+class GroupCommitWriter:
+    """Runs all mutations of the process on a single task, many of them per transaction.
+
+    `submit(operation)` queues an async function of the writer's session, which executes its statements without
+    committing. Everything queued while a batch commits goes into the next transaction, so under load one commit
+    serves many requests instead of every request waiting for the sqlite write lock on its own. The caller resumes
+    with the operation's result once its batch is committed. If a batch fails, its jobs are retried one transaction
+    each, so a bad request only fails itself.
+    """
+
+    def __init__(self, session_factory=database.SessionLocal, max_batch_size: int = MAX_BATCH_SIZE):
+        self.session_factory = session_factory
+        self.max_batch_size = max_batch_size
+        self.queue: asyncio.Queue[WriteJob] = asyncio.Queue()
+        self.task: asyncio.Task | None = None
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    def pending(self) -> int:
+        return self.queue.qsize()
+
+    async def submit(self, operation, committed=None):
+        """Execute `operation(session)` in the next batch and return its result after the commit.
+
+        `committed(result)` runs right after the commit, before any later batch, and even if the caller was
+        cancelled in the meantime. Use it to update in-memory state that has to follow the database.
+        """
+        job = WriteJob(operation, committed)
+        if self.task is None:
+            # not started (no lifespan, e.g. scripts), commit on the caller's task
+            await self.commit([job])
+        else:
+            self.queue.put_nowait(job)
+        return await job.future
+
+    async def run(self):
+        while True:
+            batch = [await self.queue.get()]
+            while len(batch) < self.max_batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            try:
+                await self.commit(batch)
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    async def commit(self, batch: list[WriteJob]):
+        start = time.perf_counter()
+        try:
+            results = await self.execute(batch)
+        except Exception as e:
+            if len(batch) == 1:
+                self.resolve(batch[0], exception=e)
+                return
+            print("Group commit failed, retrying its jobs one by one:", str(e))
+            for job in batch:
+                await self.commit([job])
+            return
+        metrics.writer_commit_duration.observe(time.perf_counter() - start)
+        metrics.writer_batch_size.observe(len(batch))
+        for job, result in zip(batch, results):
+            self.resolve(job, result=result)
+
+    async def execute(self, batch: list[WriteJob]) -> list:
+        async with self.session_factory() as session:
+            await session.execute(text(BEGIN_IMMEDIATE))
+            results = [await job.operation(session) for job in batch]
+            await session.commit()
+        return results
+
+    @staticmethod
+    def resolve(job: WriteJob, result=None, exception: Exception = None):
+        if exception is None and job.committed is not None:
+            try:
+                job.committed(result)
+            except Exception as e:
+                exception = e
+        if job.future.done():
+            # the caller was cancelled
+            return
+        if exception is None:
+            job.future.set_result(result)
+        else:
+            job.future.set_exception(exception)
+
+    async def close(self):
+        """Commit all queued jobs, then stop the writer. Call on shutdown, after everything that submits jobs."""
+        if self.task is None:
+            return
+        await self.queue.join()
+        self.task.cancel()
+        await asyncio.gather(self.task, return_exceptions=True)
+        self.task = None